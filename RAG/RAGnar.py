@@ -1,251 +1,548 @@
 # Author: Neekesh Panchal, Computer Science and Neuroscience Graduate, September 2024
 
-import sys
 import os
-import openai
-import PyPDF2
-import faiss
-import markdown2
+import sys
+import json
+import math
+import time
+import uuid
 import sqlite3
-import pandas as pd
-import docx
-import re  # For regex operations
-from sentence_transformers import SentenceTransformer
+import threading
+from datetime import datetime
+import markdown2
 from PyQt5.QtWidgets import (
     QApplication, QWidget, QVBoxLayout, QHBoxLayout, QTextEdit, QPushButton,
-    QLabel, QFileDialog, QMessageBox, QScrollArea, QSizePolicy, QSplitter, QTextBrowser,
-    QFrame, QGraphicsDropShadowEffect, QToolButton
+    QLabel, QFileDialog, QMessageBox, QSplitter, QFrame, QToolButton, QProgressBar, QTableView, QHeaderView,
+    QListView, QAbstractItemView, QStyledItemDelegate, QStyle, QAction
+)
+from PyQt5.QtCore import (
+    Qt, QThread, pyqtSignal, QRect, QTimer, QAbstractTableModel, QAbstractListModel, QModelIndex, QSize, QPoint, QEvent, QUrl
 )
-from PyQt5.QtCore import Qt, QThread, pyqtSignal, QEasingCurve, QRect, QCoreApplication, QPropertyAnimation
-from PyQt5.QtGui import QFont, QPalette, QColor, QIcon
-
-# Load OpenAI API key
-openai.api_key = "YOUR_OPENAI_API_KEY"  # Replace with your actual API key
-
-# Model to use
-MODEL = "gpt-4"  # You can use a different model if available
-
-# Load the sentence transformer model for semantic search
-retriever_model = SentenceTransformer('all-MiniLM-L6-v2')
-
-# Document Retriever Class
-class DocumentRetriever:
-    def __init__(self, documents):
-        self.documents = documents
-        self.index = self.create_index()
-
-    def create_index(self):
-        # Create a FAISS index for fast document retrieval
-        document_embeddings = retriever_model.encode(self.documents)
-        index = faiss.IndexFlatL2(document_embeddings.shape[1])
-        index.add(document_embeddings)
-        return index
-
-    def retrieve(self, query, k=3):
-        # Retrieve the top-k documents most relevant to the query
-        query_embedding = retriever_model.encode([query])
-        distances, indices = self.index.search(query_embedding, k)
-        retrieved_documents = [self.documents[i] for i in indices[0]]
-        return retrieved_documents
-
-# Functions to extract text from different file types
-def extract_text_from_pdfs(folder_path):
-    pdf_texts = []
-    for file_name in os.listdir(folder_path):
-        if file_name.endswith('.pdf'):
-            pdf_path = os.path.join(folder_path, file_name)
-            with open(pdf_path, 'rb') as pdf_file:
-                reader = PyPDF2.PdfReader(pdf_file)
-                text = ""
-                for page in reader.pages:
-                    text += page.extract_text()
-                pdf_texts.append(text)
-    return pdf_texts
-
-def extract_text_from_docx(folder_path):
-    docx_texts = []
-    for file_name in os.listdir(folder_path):
-        if file_name.endswith('.docx'):
-            docx_path = os.path.join(folder_path, file_name)
-            doc = docx.Document(docx_path)
-            text = "\n".join([para.text for para in doc.paragraphs])
-            docx_texts.append(text)
-    return docx_texts
-
-def extract_text_from_csv(folder_path):
-    csv_texts = []
-    for file_name in os.listdir(folder_path):
-        if file_name.endswith('.csv'):
-            csv_path = os.path.join(folder_path, file_name)
-            df = pd.read_csv(csv_path)
-            text = df.to_string()
-            csv_texts.append(text)
-    return csv_texts
+from PyQt5.QtGui import (
+    QFont, QFontMetrics, QPalette, QColor, QIcon, QPainter, QTextDocument, QAbstractTextDocumentLayout, QDesktopServices, QKeySequence
+)
+
+from ragnar_core import (
+    LRUCache, load_knowledge_base, DatabaseSchema, get_read_only_database, extract_sql, index_tradeoff_report, format_index_report,
+    warm_up_in_background, get_tracer, trace_context, span, format_trace, import_csv_files, CSV_DATABASE_PATH
+)
+from ragnar_engine import QueryEngine, EngineThread, FakeChatClient
+
+# Stream answers token by token into the chat; the bubble's markdown is re-rendered at most this often
+STREAM_RESPONSES = True
+STREAM_RENDER_INTERVAL_MS = 100
+
+# The embedding model and document parsers load on first use. With WARM_UP_ON_START they load in the background as
+# soon as the window shows; otherwise loading starts in the background when Semantic Search mode is selected.
+WARM_UP_ON_START = False
+
+# Chat transcript. At most TRANSCRIPT_MEMORY_MESSAGES messages are held in memory; the whole session is kept in
+# TRANSCRIPT_PATH and messages are read back, TRANSCRIPT_LOAD_BATCH at a time, when scrolling to either end.
+TRANSCRIPT_PATH = os.path.join(os.path.expanduser("~"), ".ragnar", "transcripts.sqlite")
+TRANSCRIPT_RETENTION = 30 * 24 * 3600  # Seconds before old sessions are deleted
+TRANSCRIPT_MEMORY_MESSAGES = 500
+TRANSCRIPT_LOAD_BATCH = 50
+MESSAGE_TEXT_WIDTH = 400  # Widest message text, in pixels; narrower when the window is
+RENDER_CACHE_SIZE = 256  # Laid-out messages kept for repainting; row heights are cached for every message in memory
 
 class ApiWorker(QThread):
     result_signal = pyqtSignal(str)
+    token_signal = pyqtSignal(str)  # Partial text while streaming; result_signal still carries the full reply
     error_signal = pyqtSignal(str)
 
-    def __init__(self, user_text, mode, retriever=None, db_schema=None):
+    def __init__(self, user_text, mode, engine_thread, stream=STREAM_RESPONSES):
         super().__init__()
         self.user_text = user_text
         self.mode = mode
-        self.retriever = retriever
-        self.db_schema = db_schema
+        self.engine_thread = engine_thread
+        self.stream = stream
+        # The app finishes the trace once the answer is rendered and any SQL in it has run
+        tracer = get_tracer()
+        self.trace = tracer.start("query", mode=mode.lstrip('!'), question_chars=len(user_text)) if tracer is not None else None
 
     def run(self):
+        # The query itself runs on the engine's event loop; this thread just waits for it
         try:
-            if self.mode == '!semantic':
-                context = ""
-                if self.retriever:
-                    retrieved_docs = self.retriever.retrieve(self.user_text)
-                    context = " ".join(retrieved_docs)
-
-                messages = [
-                    {"role": "system", "content": "You are a helpful assistant that provides answers based on the retrieved context."},
-                    {"role": "system", "content": f"Context: {context}"},
-                    {"role": "user", "content": self.user_text}
-                ]
-
-                response = openai.ChatCompletion.create(
-                    model=MODEL,
-                    messages=messages,
-                    max_tokens=300,
-                    temperature=0.7
-                )
-
-                assistant_response = response.choices[0].message.content.strip()
-                self.result_signal.emit(assistant_response)
-
-            elif self.mode == '!text2sql':
-                schema_description = self.db_schema if self.db_schema else ""
-                messages = [
-                    {"role": "system", "content": "You are an assistant that helps convert natural language queries into SQL based on the provided database schema. When appropriate, output the SQL query in a code block labeled as sql. Do not include any explanations in the code block. If the user asks a general question or something not related to SQL, you can answer normally."},
-                    {"role": "system", "content": f"Database Schema:\n{schema_description}"},
-                    {"role": "user", "content": self.user_text}
-                ]
-
-                response = openai.ChatCompletion.create(
-                    model=MODEL,
-                    messages=messages,
-                    max_tokens=500,
-                    temperature=0.7
-                )
-
-                assistant_response = response.choices[0].message.content.strip()
-                self.result_signal.emit(assistant_response)
-            else:
-                self.error_signal.emit("Invalid mode selected.")
+            result = self.engine_thread.query(self.mode, self.user_text, on_token=self.token_signal.emit if self.stream else None, trace=self.trace)
+            self.result_signal.emit(result["answer"])
         except Exception as e:
             self.error_signal.emit(str(e))
 
-class ChatMessage(QWidget):
-    def __init__(self, name, message, is_user):
+class IndexWorker(QThread):
+    # Loads a knowledge base off the GUI thread, reporting progress and supporting cancellation
+    progress_signal = pyqtSignal(int, int, int, float)  # files done, files total, passages embedded, ETA seconds (-1 if unknown)
+    result_signal = pyqtSignal(object, object)  # retriever (or None), changes
+    error_signal = pyqtSignal(str)
+
+    def __init__(self, folder_path):
         super().__init__()
-        self.name = name
-        self.message = message
-        self.is_user = is_user
-        self.init_ui()
-        self.animate_entry()
+        self.folder_path = folder_path
+        self.cancel_event = threading.Event()
 
-    def init_ui(self):
-        layout = QHBoxLayout()
-        layout.setSpacing(10)
-
-        # Avatar setup
-        avatar_label = QLabel()
-        avatar_label.setFixedSize(40, 40)
-        if self.is_user:
-            avatar_pixmap = QIcon("user_avatar.png").pixmap(40, 40)  # Replace with actual avatar image path
+    def cancel(self):
+        self.cancel_event.set()
+
+    def run(self):
+        try:
+            retriever, changes = load_knowledge_base(self.folder_path, progress=self.report_progress, cancel_event=self.cancel_event)
+            self.result_signal.emit(retriever, changes)
+        except Exception as e:
+            self.error_signal.emit(str(e))
+
+    def report_progress(self, files_done, files_total, passages_embedded, eta):
+        self.progress_signal.emit(files_done, files_total, passages_embedded, -1.0 if eta is None else float(eta))
+
+class SqlWorker(QThread):
+    # Runs one database call (a query or a page fetch) off the GUI thread, recording its spans into trace if given
+    result_signal = pyqtSignal(object)
+    error_signal = pyqtSignal(str)
+
+    def __init__(self, task, trace=None):
+        super().__init__()
+        self.task = task
+        self.trace = trace
+
+    def run(self):
+        try:
+            with trace_context(self.trace):
+                result = self.task()
+            self.result_signal.emit(result)
+        except Exception as e:
+            self.error_signal.emit(str(e))
+
+class ResultTableModel(QAbstractTableModel):
+    # One page of query results; the view only asks for the cells it draws
+    def __init__(self):
+        super().__init__()
+        self.columns = []
+        self.rows = []
+        self.offset = 0
+
+    def set_page(self, columns, rows, offset):
+        self.beginResetModel()
+        self.columns, self.rows, self.offset = columns, rows, offset
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.columns)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and index.isValid():
+            value = self.rows[index.row()][index.column()]
+            return "NULL" if value is None else str(value)
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return self.columns[section] if section < len(self.columns) else None
+        return str(self.offset + section + 1)
+
+class ResultView(QFrame):
+    # Paged view of the latest Text-to-SQL result. Pages are read from the query's cursor on demand, off the GUI
+    # thread, so only the rows on screen are ever turned into cells.
+    def __init__(self):
+        super().__init__()
+        self.result = None
+        self.page_number = 0
+        self.worker = None
+        self.setStyleSheet("background-color: #FFFFFF;")
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(10, 5, 10, 5)
+        self.warning_label = QLabel("")
+        self.warning_label.setWordWrap(True)
+        self.warning_label.setStyleSheet("color: #B26A00;")
+        layout.addWidget(self.warning_label)
+        self.model = ResultTableModel()
+        self.table = QTableView()
+        self.table.setModel(self.model)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Interactive)
+        layout.addWidget(self.table)
+        controls = QHBoxLayout()
+        self.prev_button = QPushButton("Previous")
+        self.prev_button.clicked.connect(lambda: self.go_to_page(self.page_number - 1))
+        self.status_label = QLabel("")
+        self.next_button = QPushButton("Next")
+        self.next_button.clicked.connect(lambda: self.go_to_page(self.page_number + 1))
+        controls.addWidget(self.prev_button)
+        controls.addWidget(self.status_label, 1, Qt.AlignCenter)
+        controls.addWidget(self.next_button)
+        layout.addLayout(controls)
+
+    def show_result(self, result):
+        self.result = result
+        self.warning_label.setText("\n".join(result.warnings))
+        self.warning_label.setVisible(bool(result.warnings))
+        self.show_page(0, result.page(0))
+        self.show()
+
+    def go_to_page(self, number):
+        if self.result is None or number < 0 or not self.result.has_page(number) or (self.worker is not None and self.worker.isRunning()):
+            return
+        result = self.result
+        self.prev_button.setDisabled(True)
+        self.next_button.setDisabled(True)
+        self.status_label.setText("Loading...")
+        self.worker = SqlWorker(lambda: result.page(number))
+        self.worker.result_signal.connect(lambda rows: self.show_page(number, rows) if result is self.result else None)
+        self.worker.error_signal.connect(self.show_error)
+        self.worker.start()
+
+    def show_page(self, number, rows):
+        self.page_number = number
+        offset = number * self.result.database.page_size
+        self.model.set_page(self.result.columns, rows, offset)
+        if not rows:
+            self.status_label.setText("No results found.")
         else:
-            avatar_pixmap = QIcon("bot_avatar.png").pixmap(40, 40)  # Replace with actual avatar image path
-        avatar_label.setPixmap(avatar_pixmap)
-        avatar_label.setScaledContents(True)
-
-        # Message bubble
-        bubble_layout = QVBoxLayout()
-        bubble_layout.setSpacing(5)
-
-        # Name label
-        name_label = QLabel(self.name)
-        name_label.setFont(QFont("Arial", 10, QFont.Bold))
-        name_label.setStyleSheet("color: #FFFFFF;")
-
-        # Timestamp
-        from datetime import datetime
-        timestamp_label = QLabel(datetime.now().strftime("%H:%M"))
-        timestamp_label.setFont(QFont("Arial", 8))
-        timestamp_label.setStyleSheet("color: #AAAAAA;")
-
-        # Message content
-        message_browser = QTextBrowser()
-        message_browser.setFont(QFont("Arial", 12))
-        message_browser.setOpenExternalLinks(True)
-        message_browser.setReadOnly(True)
-        message_browser.setFrameStyle(QFrame.NoFrame)
-        message_browser.setStyleSheet("background: transparent;")
-        message_browser.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Minimum)
-
-        html_message = markdown2.markdown(self.message)
-        message_browser.setHtml(html_message)
-
-        # Adjust the height to fit content
-        message_browser.document().setTextWidth(400)
-        document_height = message_browser.document().size().height()
-        message_browser.setFixedHeight(int(document_height + 20))
-
-        # Bubble frame
-        bubble_frame = QFrame()
-        bubble_frame_layout = QVBoxLayout(bubble_frame)
-        bubble_frame_layout.addWidget(name_label)
-        bubble_frame_layout.addWidget(message_browser)
-        bubble_frame_layout.addWidget(timestamp_label, alignment=Qt.AlignRight)
-        bubble_frame.setLayout(bubble_frame_layout)
-        bubble_frame.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Minimum)
-        bubble_frame.setContentsMargins(0, 0, 0, 0)
-
-        # Shadow effect
-        shadow = QGraphicsDropShadowEffect()
-        shadow.setBlurRadius(5)
-        shadow.setXOffset(0)
-        shadow.setYOffset(2)
-        shadow.setColor(QColor(0, 0, 0, 80))
-        bubble_frame.setGraphicsEffect(shadow)
-
-        # Styling
-        if self.is_user:
-            bubble_frame.setStyleSheet("""
-                background-color: #1E88E5;
-                color: #FFFFFF;
-                padding: 10px;
-                border-radius: 10px;
-            """)
-            layout.addStretch()
-            layout.addWidget(bubble_frame)
-            layout.addWidget(avatar_label)
+            total = f"{self.result.row_count:,}" + ("+" if not self.result.exhausted or self.result.truncated else "")
+            self.status_label.setText(f"Rows {offset + 1:,}-{offset + len(rows):,} of {total}")
+        self.prev_button.setDisabled(number == 0)
+        self.next_button.setDisabled(not self.result.has_page(number + 1))
+
+    def show_error(self, error_message):
+        self.status_label.setText(error_message)
+        self.prev_button.setDisabled(self.page_number == 0)
+        self.next_button.setDisabled(True)
+
+    def cancel(self):
+        if self.worker is not None and self.worker.isRunning() and self.result is not None:
+            self.result.database.cancel()
+            self.worker.wait()
+
+class TracePanel(QFrame):
+    # Time per stage of the latest query or indexing run, shown with the "Show Timings" button
+    def __init__(self):
+        super().__init__()
+        self.setStyleSheet("background-color: #FFFFFF;")
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(10, 5, 10, 5)
+        self.text_label = QLabel("No queries traced yet.")
+        self.text_label.setFont(QFont("Courier New", 9))
+        self.text_label.setTextInteractionFlags(Qt.TextSelectableByMouse)
+        layout.addWidget(self.text_label)
+        controls = QHBoxLayout()
+        log_path = get_tracer().log_path if get_tracer() is not None else None
+        self.log_label = QLabel(f"Traces are logged to {log_path}" if log_path else "")
+        self.export_button = QPushButton("Export Metrics")
+        self.export_button.clicked.connect(self.export_metrics)
+        controls.addWidget(self.log_label, 1)
+        controls.addWidget(self.export_button)
+        layout.addLayout(controls)
+
+    def show_trace(self, record):
+        self.text_label.setText(format_trace(record))
+
+    def export_metrics(self):
+        tracer = get_tracer()
+        if tracer is None:
+            return
+        path, _ = QFileDialog.getSaveFileName(self, "Export Metrics", "ragnar_metrics.prom", "Prometheus Text Files (*.prom *.txt)")
+        if path:
+            try:
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(tracer.prometheus())
+            except OSError as e:
+                QMessageBox.warning(self, "Export Failed", str(e))
+
+class TranscriptStore:
+    # Every message of the session on disk, so the transcript model only has to keep the latest ones in memory.
+    # Falls back to memory if the transcript file cannot be opened.
+    def __init__(self, path=TRANSCRIPT_PATH, retention=TRANSCRIPT_RETENTION):
+        self.session = uuid.uuid4().hex
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.conn = sqlite3.connect(path)
+            self.setup(retention)
+        except (OSError, sqlite3.Error):
+            self.conn = sqlite3.connect(":memory:")
+            self.setup(retention)
+
+    def setup(self, retention):
+        self.conn.execute("CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, session TEXT NOT NULL, name TEXT NOT NULL, "
+                          "text TEXT NOT NULL, is_user INTEGER NOT NULL, time TEXT NOT NULL, created REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS messages_session ON messages (session, id)")
+        self.conn.execute("DELETE FROM messages WHERE created < ?", (time.time() - retention,))
+        self.conn.commit()
+
+    def add(self, name, text, is_user, timestamp):
+        cursor = self.conn.execute("INSERT INTO messages (session, name, text, is_user, time, created) VALUES (?, ?, ?, ?, ?, ?)",
+                                   (self.session, name, text, int(is_user), timestamp, time.time()))
+        self.conn.commit()
+        return cursor.lastrowid
+
+    def update(self, message_id, text):
+        self.conn.execute("UPDATE messages SET text = ? WHERE id = ?", (text, message_id))
+        self.conn.commit()
+
+    def before(self, message_id, limit):
+        # Up to limit messages of this session older than message_id, oldest first
+        rows = self.conn.execute("SELECT id, name, text, is_user, time FROM messages WHERE session = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                                 (self.session, message_id, limit)).fetchall()
+        return [self.message(row) for row in reversed(rows)]
+
+    def after(self, message_id, limit):
+        # Up to limit messages of this session newer than message_id, oldest first
+        rows = self.conn.execute("SELECT id, name, text, is_user, time FROM messages WHERE session = ? AND id > ? ORDER BY id LIMIT ?",
+                                 (self.session, message_id, limit)).fetchall()
+        return [self.message(row) for row in rows]
+
+    @staticmethod
+    def message(row):
+        return {"id": row[0], "name": row[1], "text": row[2], "is_user": bool(row[3]), "time": row[4], "version": 0}
+
+    def close(self):
+        self.conn.close()
+
+class TranscriptModel(QAbstractListModel):
+    # A window of at most max_messages messages of the session, as dicts holding "id", "name", "text", "is_user",
+    # "time" and "version". version is bumped whenever the text changes, which invalidates the delegate's cached
+    # rendering. The window follows the latest messages unless the user has scrolled back through earlier ones.
+    def __init__(self, store, max_messages=TRANSCRIPT_MEMORY_MESSAGES):
+        super().__init__()
+        self.store = store
+        self.max_messages = max_messages
+        self.messages = []
+        self.has_earlier = False
+        self.has_later = False
+        # Streamed text is buffered and shown on a timer instead of once per token. It is written to disk once the
+        # message is finished; until then the message is kept in unsaved, even if it scrolls out of the window.
+        self.pending = []
+        self.unsaved = {}
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.setInterval(STREAM_RENDER_INTERVAL_MS)
+        self.flush_timer.timeout.connect(self.flush)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.messages)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == Qt.UserRole:
+            return self.messages[index.row()]
+        if role == Qt.DisplayRole:
+            return self.messages[index.row()]["text"]
+        return None
+
+    def add_message(self, name, text, is_user):
+        # Append a message and return it; the returned dict is the handle for append_text() and set_text()
+        timestamp = datetime.now().strftime("%H:%M")
+        message = {"id": self.store.add(name, text, is_user, timestamp), "name": name, "text": text, "is_user": is_user, "time": timestamp, "version": 0}
+        if self.has_later:
+            # The window was scrolled back; jump to the latest messages, which end with the new one
+            self.beginResetModel()
+            self.messages = [self.unsaved.get(row["id"], row) for row in self.store.before(message["id"], self.max_messages - 1)]
+            self.has_earlier = len(self.messages) == self.max_messages - 1
+            self.has_later = False
+            self.messages.append(message)
+            self.endResetModel()
+            return message
+        self.beginInsertRows(QModelIndex(), len(self.messages), len(self.messages))
+        self.messages.append(message)
+        self.endInsertRows()
+        if len(self.messages) > self.max_messages:
+            # The oldest messages stay on disk and are read back by load_earlier()
+            excess = len(self.messages) - self.max_messages
+            self.beginRemoveRows(QModelIndex(), 0, excess - 1)
+            del self.messages[:excess]
+            self.endRemoveRows()
+            self.has_earlier = True
+        return message
+
+    def append_text(self, message, text):
+        message["text"] += text
+        self.unsaved[message["id"]] = message
+        if message not in self.pending:
+            self.pending.append(message)
+        if not self.flush_timer.isActive():
+            self.flush_timer.start()
+
+    def set_text(self, message, text):
+        # Set the finished text of a message and write it to disk
+        message["text"] = text
+        self.unsaved.pop(message["id"], None)
+        self.store.update(message["id"], text)
+        if message not in self.pending:
+            self.pending.append(message)
+        self.flush()
+
+    def flush(self):
+        # Show buffered text; only set_text() and save() write to disk
+        self.flush_timer.stop()
+        pending, self.pending = self.pending, []
+        for message in pending:
+            message["version"] += 1
+            row = self.row_of(message)
+            if row is not None:
+                self.dataChanged.emit(self.index(row), self.index(row))
+
+    def row_of(self, message):
+        for row in range(len(self.messages) - 1, -1, -1):
+            if self.messages[row] is message:
+                return row
+        return None
+
+    def save(self):
+        # Write messages that are still being streamed, for when the window closes
+        for message in self.unsaved.values():
+            self.store.update(message["id"], message["text"])
+        self.unsaved = {}
+
+    def load_earlier(self, count=TRANSCRIPT_LOAD_BATCH):
+        # Read up to count earlier messages back from disk; returns how many were added at the top.
+        # As many of the latest messages are dropped to keep the window within max_messages.
+        if not self.has_earlier or not self.messages:
+            return 0
+        earlier = [self.unsaved.get(row["id"], row) for row in self.store.before(self.messages[0]["id"], count)]
+        self.has_earlier = len(earlier) == count
+        if earlier:
+            self.beginInsertRows(QModelIndex(), 0, len(earlier) - 1)
+            self.messages[:0] = earlier
+            self.endInsertRows()
+            excess = len(self.messages) - self.max_messages
+            if excess > 0:
+                self.beginRemoveRows(QModelIndex(), len(self.messages) - excess, len(self.messages) - 1)
+                del self.messages[-excess:]
+                self.endRemoveRows()
+                self.has_later = True
+        return len(earlier)
+
+    def load_later(self, count=TRANSCRIPT_LOAD_BATCH):
+        # Read up to count later messages back from disk after scrolling back; returns how many were added at the
+        # bottom. As many of the earliest messages are dropped to keep the window within max_messages.
+        if not self.has_later or not self.messages:
+            return 0
+        later = [self.unsaved.get(row["id"], row) for row in self.store.after(self.messages[-1]["id"], count)]
+        self.has_later = len(later) == count
+        if later:
+            self.beginInsertRows(QModelIndex(), len(self.messages), len(self.messages) + len(later) - 1)
+            self.messages.extend(later)
+            self.endInsertRows()
+            excess = len(self.messages) - self.max_messages
+            if excess > 0:
+                self.beginRemoveRows(QModelIndex(), 0, excess - 1)
+                del self.messages[:excess]
+                self.endRemoveRows()
+                self.has_earlier = True
+        return len(later)
+
+class MessageDelegate(QStyledItemDelegate):
+    # Paints chat bubbles straight from the model, so only messages on screen cost anything. Markdown is converted
+    # once per message version and laid-out documents are cached per width. Row heights are cached separately for
+    # every message in the model, so relayouts of the whole list do not rebuild documents for rows off screen.
+    MARGIN = 10
+    AVATAR_SIZE = 40
+    PADDING = 10
+    RADIUS = 10
+
+    def __init__(self, view):
+        super().__init__(view)
+        self.view = view
+        self.name_font = QFont("Arial", 10, QFont.Bold)
+        self.time_font = QFont("Arial", 8)
+        self.text_font = QFont("Arial", 12)
+        self.avatars = {
+            True: QIcon("user_avatar.png").pixmap(self.AVATAR_SIZE, self.AVATAR_SIZE),  # Replace with actual avatar image path
+            False: QIcon("bot_avatar.png").pixmap(self.AVATAR_SIZE, self.AVATAR_SIZE),  # Replace with actual avatar image path
+        }
+        self.html_cache = LRUCache(TRANSCRIPT_MEMORY_MESSAGES)
+        self.document_cache = LRUCache(RENDER_CACHE_SIZE)
+        self.height_cache = LRUCache(TRANSCRIPT_MEMORY_MESSAGES)
+
+    def text_width(self):
+        available = self.view.viewport().width() - 2 * (self.MARGIN + self.AVATAR_SIZE + self.MARGIN + self.PADDING)
+        return max(100, min(MESSAGE_TEXT_WIDTH, available))
+
+    def document(self, message, text_width):
+        key = (message["id"], message["version"], text_width)
+        document = self.document_cache.get(key)
+        if document is None:
+            html = self.html_cache.get((message["id"], message["version"]))
+            if html is None:
+                html = markdown2.markdown(message["text"])
+                self.html_cache.put((message["id"], message["version"]), html)
+            document = QTextDocument()
+            document.setDefaultFont(self.text_font)
+            document.setDocumentMargin(0)
+            document.setHtml(html)
+            document.setTextWidth(text_width)
+            self.document_cache.put(key, document)
+        return document
+
+    def layout(self, rect, message):
+        # Return (document, bubble rect, avatar rect, document origin) for a message drawn in rect
+        text_width = self.text_width()
+        document = self.document(message, text_width)
+        name_height = QFontMetrics(self.name_font).height()
+        time_height = QFontMetrics(self.time_font).height()
+        content_width = max(math.ceil(document.idealWidth()), QFontMetrics(self.name_font).horizontalAdvance(message["name"]), 40)
+        bubble_width = min(content_width, text_width) + 2 * self.PADDING
+        bubble_height = 2 * self.PADDING + name_height + math.ceil(document.size().height()) + time_height + 8
+        top = rect.top() + self.MARGIN // 2
+        if message["is_user"]:
+            avatar = QRect(rect.right() - self.MARGIN - self.AVATAR_SIZE, top, self.AVATAR_SIZE, self.AVATAR_SIZE)
+            bubble = QRect(avatar.left() - self.MARGIN - bubble_width, top, bubble_width, bubble_height)
         else:
-            bubble_frame.setStyleSheet("""
-                background-color: #424242;
-                color: #FFFFFF;
-                padding: 10px;
-                border-radius: 10px;
-            """)
-            layout.addWidget(avatar_label)
-            layout.addWidget(bubble_frame)
-            layout.addStretch()
-
-        self.setLayout(layout)
-        self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Minimum)
-
-    def animate_entry(self):
-        # Fade-in animation
-        self.setWindowOpacity(0)
-        self.anim = QPropertyAnimation(self, b'windowOpacity')
-        self.anim.setDuration(500)
-        self.anim.setStartValue(0)
-        self.anim.setEndValue(1)
-        self.anim.setEasingCurve(QEasingCurve.InOutQuad)
-        self.anim.start()
+            avatar = QRect(rect.left() + self.MARGIN, top, self.AVATAR_SIZE, self.AVATAR_SIZE)
+            bubble = QRect(avatar.right() + self.MARGIN, top, bubble_width, bubble_height)
+        origin = QPoint(bubble.left() + self.PADDING, bubble.top() + self.PADDING + name_height + 4)
+        return document, bubble, avatar, origin
+
+    def sizeHint(self, option, index):
+        message = index.data(Qt.UserRole)
+        key = (message["id"], message["version"], self.text_width())
+        height = self.height_cache.get(key)
+        if height is None:
+            _, bubble, _, _ = self.layout(QRect(0, 0, self.view.viewport().width(), 0), message)
+            height = bubble.height() + self.MARGIN
+            self.height_cache.put(key, height)
+        return QSize(self.view.viewport().width(), height)
+
+    def paint(self, painter, option, index):
+        message = index.data(Qt.UserRole)
+        document, bubble, avatar, origin = self.layout(option.rect, message)
+        painter.save()
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(QColor(0, 0, 0, 50))  # Shadow
+        painter.drawRoundedRect(bubble.translated(0, 2), self.RADIUS, self.RADIUS)
+        painter.setBrush(QColor("#1E88E5") if message["is_user"] else QColor("#424242"))
+        painter.drawRoundedRect(bubble, self.RADIUS, self.RADIUS)
+        if option.state & QStyle.State_Selected:
+            painter.setPen(QColor("#90CAF9"))
+            painter.setBrush(Qt.NoBrush)
+            painter.drawRoundedRect(bubble, self.RADIUS, self.RADIUS)
+        painter.drawPixmap(avatar, self.avatars[message["is_user"]])
+
+        painter.setPen(QColor("#FFFFFF"))
+        painter.setFont(self.name_font)
+        painter.drawText(QRect(origin.x(), bubble.top() + self.PADDING, bubble.width() - 2 * self.PADDING, origin.y() - bubble.top()),
+                         Qt.AlignLeft | Qt.AlignTop, message["name"])
+        painter.translate(origin)
+        context = QAbstractTextDocumentLayout.PaintContext()
+        context.palette.setColor(QPalette.Text, QColor("#FFFFFF"))
+        document.documentLayout().draw(painter, context)
+        painter.translate(-origin)
+        painter.setPen(QColor("#AAAAAA"))
+        painter.setFont(self.time_font)
+        painter.drawText(bubble.adjusted(self.PADDING, self.PADDING, -self.PADDING, -self.PADDING), Qt.AlignRight | Qt.AlignBottom, message["time"])
+        painter.restore()
+
+    def editorEvent(self, event, model, option, index):
+        # Open links in a message when they are clicked
+        if event.type() == QEvent.MouseButtonRelease and event.button() == Qt.LeftButton:
+            document, _, _, origin = self.layout(option.rect, index.data(Qt.UserRole))
+            anchor = document.documentLayout().anchorAt(event.pos() - origin)
+            if anchor:
+                QDesktopServices.openUrl(QUrl(anchor))
+                return True
+        return False
 
 class RagnarChatbotApp(QWidget):
     def __init__(self):
@@ -254,6 +551,11 @@ class RagnarChatbotApp(QWidget):
         self.retriever = None
         self.db_schema = None
         self.mode = None
+        self.index_worker = None
+        self.index_folder = None
+        self.streaming_message = None
+        self.engine = QueryEngine()
+        self.engine_thread = EngineThread(self.engine)
         self.init_ui()
 
     def init_ui(self):
@@ -316,6 +618,22 @@ class RagnarChatbotApp(QWidget):
         side_layout.addWidget(self.dir_button)
         side_layout.addWidget(self.dir_label)
 
+        # Indexing progress, shown while a knowledge base loads in the background
+        self.index_progress = QProgressBar()
+        self.index_progress.setTextVisible(False)
+        self.index_status_label = QLabel("")
+        self.index_status_label.setStyleSheet("color: #FFFFFF;")
+        self.index_status_label.setWordWrap(True)
+        self.index_button = QPushButton("Cancel Indexing")
+        self.index_button.setStyleSheet(button_style)
+        self.index_button.clicked.connect(self.toggle_indexing)
+        side_layout.addWidget(self.index_progress)
+        side_layout.addWidget(self.index_status_label)
+        side_layout.addWidget(self.index_button)
+        self.index_progress.hide()
+        self.index_status_label.hide()
+        self.index_button.hide()
+
         # Database selection
         self.db_button = QPushButton("Select Database")
         self.db_button.setStyleSheet(button_style)
@@ -325,25 +643,65 @@ class RagnarChatbotApp(QWidget):
         side_layout.addWidget(self.db_button)
         side_layout.addWidget(self.db_label)
 
+        # CSV files imported into a local SQLite database, for Text-to-SQL questions over them
+        self.csv_button = QPushButton("Import CSV Files")
+        self.csv_button.setStyleSheet(button_style)
+        self.csv_button.clicked.connect(self.import_csv)
+        self.csv_worker = None
+        side_layout.addWidget(self.csv_button)
+
         side_layout.addStretch()
 
+        # Per-stage timings of the latest query
+        self.timings_button = QPushButton("Show Timings")
+        self.timings_button.setStyleSheet(button_style)
+        self.timings_button.setCheckable(True)
+        self.timings_button.toggled.connect(self.toggle_timings)
+        self.timings_button.setVisible(get_tracer() is not None)
+        side_layout.addWidget(self.timings_button)
+
         # Chat area
         chat_frame = QFrame()
         chat_layout = QVBoxLayout(chat_frame)
         chat_frame.setStyleSheet("background-color: #F5F5F5;")
 
-        # Scroll area for messages
-        self.chat_area = QVBoxLayout()
-        self.chat_area.setAlignment(Qt.AlignTop)
-        self.chat_area.setSpacing(10)
-
-        scroll_widget = QWidget()
-        scroll_widget.setLayout(self.chat_area)
-        self.scroll_area = QScrollArea()
-        self.scroll_area.setWidgetResizable(True)
-        self.scroll_area.setWidget(scroll_widget)
-        self.scroll_area.setStyleSheet("background-color: transparent; border: none;")
-        chat_layout.addWidget(self.scroll_area)
+        # Messages, drawn by a delegate for only the rows on screen
+        self.transcript = TranscriptModel(TranscriptStore())
+        self.transcript_view = QListView()
+        self.transcript_view.setModel(self.transcript)
+        self.transcript_view.setItemDelegate(MessageDelegate(self.transcript_view))
+        self.transcript_view.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.transcript_view.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.transcript_view.setResizeMode(QListView.Adjust)
+        self.transcript_view.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.transcript_view.setStyleSheet("QListView { background-color: transparent; border: none; } QListView::item:selected { background: transparent; }")
+        self.transcript.dataChanged.connect(lambda *_: self.transcript_view.scheduleDelayedItemsLayout())  # Streamed messages grow
+        copy_action = QAction("Copy Message", self.transcript_view)
+        copy_action.setShortcut(QKeySequence.Copy)
+        copy_action.triggered.connect(self.copy_selected_message)
+        self.transcript_view.addAction(copy_action)
+        self.transcript_view.setContextMenuPolicy(Qt.ActionsContextMenu)
+        # Follow new messages unless the user has scrolled up; load earlier messages at the top and, after scrolling
+        # back, later ones at the bottom
+        self.follow_transcript = True
+        scroll_bar = self.transcript_view.verticalScrollBar()
+        scroll_bar.valueChanged.connect(self.handle_transcript_scroll)
+        scroll_bar.rangeChanged.connect(lambda minimum, maximum: self.scroll_to_bottom() if self.follow_transcript else None)
+
+        # Results of Text-to-SQL queries, shown below the conversation once there are some
+        self.result_view = ResultView()
+        self.result_view.hide()
+        self.sql_worker = None
+        chat_splitter = QSplitter(Qt.Vertical)
+        self.trace_panel = TracePanel()
+        self.trace_panel.hide()
+        chat_splitter.addWidget(self.transcript_view)
+        chat_splitter.addWidget(self.result_view)
+        chat_splitter.addWidget(self.trace_panel)
+        chat_splitter.setStretchFactor(0, 3)
+        chat_splitter.setStretchFactor(1, 2)
+        chat_splitter.setStretchFactor(2, 1)
+        chat_layout.addWidget(chat_splitter)
 
         # Input area
         input_frame = QFrame()
@@ -392,19 +750,32 @@ class RagnarChatbotApp(QWidget):
             self.db_label.hide()
             self.dir_button.show()
             self.dir_label.show()
+            self.csv_button.hide()
         elif self.mode == '!text2sql':
             self.dir_button.hide()
             self.dir_label.hide()
             self.db_button.show()
             self.db_label.show()
+            self.csv_button.show()
         else:
             self.dir_button.hide()
             self.dir_label.hide()
             self.db_button.hide()
             self.db_label.hide()
+            self.csv_button.hide()
+
+    def toggle_timings(self, checked):
+        self.trace_panel.setVisible(checked)
+        self.timings_button.setText("Hide Timings" if checked else "Show Timings")
+
+    def finish_trace(self, trace, error=None):
+        tracer = get_tracer()
+        if trace is not None and tracer is not None:
+            self.trace_panel.show_trace(tracer.finish(trace, error))
 
     def select_semantic_mode(self):
         self.mode = '!semantic'
+        warm_up_in_background()
         self.display_message("System", "Semantic Search mode selected.", is_user=False)
         self.update_ui_state()
 
@@ -417,18 +788,91 @@ class RagnarChatbotApp(QWidget):
         folder_path = QFileDialog.getExistingDirectory(self, "Select Knowledge Base Folder")
         if folder_path:
             self.dir_label.setText(f"Knowledge Base: {folder_path}")
-            pdf_texts = extract_text_from_pdfs(folder_path)
-            docx_texts = extract_text_from_docx(folder_path)
-            csv_texts = extract_text_from_csv(folder_path)
-            all_texts = pdf_texts + docx_texts + csv_texts
-            if all_texts:
-                self.retriever = DocumentRetriever(all_texts)
-                self.display_message("System", "Knowledge base loaded successfully.", is_user=False)
-            else:
-                self.display_message("System", "No valid documents found in the selected folder.", is_user=False)
+            self.start_indexing(folder_path)
         else:
             self.dir_label.setText("No directory selected.")
 
+    def start_indexing(self, folder_path):
+        # Index in the background; the previous knowledge base, if any, stays usable until the new one is ready
+        self.index_folder = folder_path
+        self.index_worker = IndexWorker(folder_path)
+        self.index_worker.progress_signal.connect(self.handle_index_progress)
+        self.index_worker.result_signal.connect(self.handle_index_result)
+        self.index_worker.error_signal.connect(self.handle_index_error)
+        self.dir_button.setDisabled(True)
+        self.index_progress.setRange(0, 0)
+        self.index_status_label.setText("Scanning knowledge base...")
+        self.index_button.setText("Cancel Indexing")
+        self.index_button.setDisabled(False)
+        self.index_progress.show()
+        self.index_status_label.show()
+        self.index_button.show()
+        self.index_worker.start()
+
+    def toggle_indexing(self):
+        if self.index_worker is not None and self.index_worker.isRunning():
+            self.index_worker.cancel()
+            self.index_button.setDisabled(True)
+            self.index_status_label.setText("Cancelling after the current file...")
+        elif self.index_folder:
+            self.start_indexing(self.index_folder)
+
+    def handle_index_progress(self, files_done, files_total, passages_embedded, eta):
+        self.index_progress.setRange(0, max(files_total, 1))
+        self.index_progress.setValue(files_done)
+        status = f"{files_done}/{files_total} files, {passages_embedded} passages embedded"
+        if eta >= 0:
+            minutes, seconds = divmod(int(eta), 60)
+            status += f", about {minutes}m {seconds:02d}s left"
+        self.index_status_label.setText(status)
+
+    def handle_index_result(self, retriever, changes):
+        self.dir_button.setDisabled(False)
+        self.index_progress.hide()
+        summary = ", ".join(f"{len(files)} {change}" for change, files in changes.items() if files)
+        tracer = get_tracer()
+        index_traces = [record for record in tracer.recent_traces() if record["kind"] == "index"] if tracer is not None else []
+        if index_traces:
+            self.trace_panel.show_trace(index_traces[-1])
+        if retriever:
+            self.retriever = retriever
+            self.engine.retriever = retriever
+            self.display_message("System", f"Knowledge base loaded successfully ({summary or 'no changes'}).", is_user=False)
+        else:
+            self.display_message("System", "No valid documents found in the selected folder.", is_user=False)
+        if changes["pending"]:
+            # Cancelled part way: offer to pick up the remaining files
+            self.index_status_label.setText(f"Indexing paused, {len(changes['pending'])} files remaining.")
+            self.index_button.setText("Resume Indexing")
+            self.index_button.setDisabled(False)
+        else:
+            self.index_status_label.hide()
+            self.index_button.hide()
+
+    def handle_index_error(self, error_message):
+        self.dir_button.setDisabled(False)
+        self.index_progress.hide()
+        self.index_status_label.hide()
+        self.index_button.hide()
+        self.display_message("Error", f"Failed to load knowledge base: {error_message}", is_user=False)
+
+    def closeEvent(self, event):
+        # Stop background indexing cleanly so the partial index is saved before exit
+        if self.index_worker is not None and self.index_worker.isRunning():
+            self.index_worker.cancel()
+            self.index_worker.wait()
+        if self.sql_worker is not None and self.sql_worker.isRunning():
+            self.sql_database.cancel()
+            self.sql_worker.wait()
+        if self.csv_worker is not None and self.csv_worker.isRunning():
+            self.csv_worker.wait()
+        self.result_view.cancel()
+        self.engine_thread.stop()
+        self.transcript.flush()
+        self.transcript.save()
+        self.transcript.store.close()
+        super().closeEvent(event)
+
     def select_database(self):
         db_path, _ = QFileDialog.getOpenFileName(self, "Select Database File", "", "SQLite Database Files (*.db *.sqlite)")
         if db_path:
@@ -438,32 +882,64 @@ class RagnarChatbotApp(QWidget):
         else:
             self.db_label.setText("No database selected.")
 
+    def import_csv(self):
+        # Import the chosen CSV files into RAGnar's own database off the GUI thread, then query that database
+        csv_paths, _ = QFileDialog.getOpenFileNames(self, "Select CSV Files", "", "CSV Files (*.csv)")
+        if not csv_paths:
+            return
+        self.csv_button.setDisabled(True)
+        self.display_message("System", f"Importing {len(csv_paths)} CSV files...", is_user=False)
+        self.csv_worker = SqlWorker(lambda: import_csv_files(csv_paths))
+        self.csv_worker.result_signal.connect(self.handle_csv_import)
+        self.csv_worker.error_signal.connect(self.handle_csv_import_error)
+        self.csv_worker.start()
+
+    def handle_csv_import(self, tables):
+        self.csv_button.setDisabled(False)
+        self.db_label.setText(f"Database: {CSV_DATABASE_PATH}")
+        self.db_path = CSV_DATABASE_PATH
+        names = ", ".join(f"{os.path.basename(path)} as {table}" for path, table in tables.items())
+        self.display_message("System", f"Imported {names}.", is_user=False)
+        self.load_db_schema(CSV_DATABASE_PATH)
+
+    def handle_csv_import_error(self, error_message):
+        self.csv_button.setDisabled(False)
+        self.display_message("Error", f"Failed to import CSV files: {error_message}", is_user=False)
+
     def load_db_schema(self, db_path):
         try:
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-            tables = cursor.fetchall()
-            schema = ""
-            for table in tables:
-                table_name = table[0]
-                schema += f"Table: {table_name}\n"
-                cursor.execute(f"PRAGMA table_info({table_name});")
-                columns = cursor.fetchall()
-                for column in columns:
-                    schema += f" - {column[1]} ({column[2]})\n"
-            self.db_schema = schema
-            conn.close()
-            self.display_message("System", "Database schema loaded successfully.", is_user=False)
+            self.db_schema = DatabaseSchema.load(db_path)
+            self.engine.database = self.db_schema
+            self.display_message("System", f"Database schema loaded successfully ({len(self.db_schema)} tables).", is_user=False)
         except Exception as e:
             self.display_message("Error", f"Failed to load database schema: {e}", is_user=False)
 
     def display_message(self, name, message, is_user):
-        # Display a message in the chat area
-        chat_message = ChatMessage(name, message, is_user)
-        self.chat_area.addWidget(chat_message)
-        QCoreApplication.processEvents()
-        self.scroll_area.verticalScrollBar().setValue(self.scroll_area.verticalScrollBar().maximum())
+        # Add a message to the transcript and return it, for streaming more text into it
+        chat_message = self.transcript.add_message(name, message, is_user)
+        self.follow_transcript = True
+        self.scroll_to_bottom()
+        return chat_message
+
+    def scroll_to_bottom(self):
+        self.transcript_view.scrollToBottom()
+
+    def handle_transcript_scroll(self, value):
+        scroll_bar = self.transcript_view.verticalScrollBar()
+        self.follow_transcript = value >= scroll_bar.maximum() - 4 and not self.transcript.has_later
+        if value == scroll_bar.minimum() and self.transcript.has_earlier:
+            added = self.transcript.load_earlier()
+            if added:
+                self.transcript_view.scrollTo(self.transcript.index(added), QAbstractItemView.PositionAtTop)
+        elif value == scroll_bar.maximum() and self.transcript.has_later:
+            added = self.transcript.load_later()
+            if added:
+                self.transcript_view.scrollTo(self.transcript.index(len(self.transcript.messages) - added - 1), QAbstractItemView.PositionAtBottom)
+
+    def copy_selected_message(self):
+        indexes = self.transcript_view.selectedIndexes()
+        if indexes:
+            QApplication.clipboard().setText(indexes[0].data(Qt.UserRole)["text"])
 
     def send_message(self):
         user_text = self.user_input.toPlainText().strip()
@@ -476,66 +952,126 @@ class RagnarChatbotApp(QWidget):
         if self.mode == '!semantic' and not self.retriever:
             QMessageBox.warning(self, "Knowledge Base Not Loaded", "Please select and load a knowledge base first.")
             return
-        if self.mode == '!text2sql' and not hasattr(self, 'db_schema'):
+        if self.mode == '!text2sql' and self.db_schema is None:
             QMessageBox.warning(self, "Database Not Loaded", "Please select and load a database first.")
             return
         self.display_message("You", user_text, is_user=True)
         self.user_input.clear()
         self.user_input.setDisabled(True)
         self.send_button.setDisabled(True)
-        self.worker = ApiWorker(user_text, self.mode, self.retriever, self.db_schema)
+        self.streaming_message = None
+        self.worker = ApiWorker(user_text, self.mode, self.engine_thread)
+        self.worker.token_signal.connect(self.handle_token)
         self.worker.result_signal.connect(self.handle_result)
         self.worker.error_signal.connect(self.handle_error)
         self.worker.start()
 
+    def handle_token(self, text):
+        # The bot bubble appears with the first streamed token and grows as more arrive
+        if self.streaming_message is None:
+            self.streaming_message = self.display_message("RAGnar 0.1", text, is_user=False)
+        else:
+            self.transcript.append_text(self.streaming_message, text)
+
     def handle_result(self, assistant_response):
-        self.display_message("RAGnar 0.1", assistant_response, is_user=False)
+        trace = self.worker.trace
+        with trace_context(trace), span("render", chars=len(assistant_response)):
+            if self.streaming_message is not None:
+                message = self.streaming_message
+                self.transcript.set_text(message, assistant_response)
+                self.streaming_message = None
+            else:
+                message = self.display_message("RAGnar 0.1", assistant_response, is_user=False)
+            # Convert and lay out the markdown now rather than in the next paint, so the time is measured here
+            delegate = self.transcript_view.itemDelegate()
+            delegate.document(message, delegate.text_width())
         self.user_input.setDisabled(False)
         self.send_button.setDisabled(False)
 
         if self.mode == '!text2sql' and hasattr(self, 'db_path'):
-            try:
-                # Extract SQL code from the assistant's response
-                code_blocks = re.findall(r'```sql\s*(.*?)```', assistant_response, re.DOTALL | re.IGNORECASE)
-                if code_blocks:
-                    sql_query = code_blocks[0].strip()
-
-                    # Connect to the SQLite database and execute the SQL query
-                    conn = sqlite3.connect(self.db_path)
-                    cursor = conn.cursor()
-                    cursor.execute(sql_query)
-                    columns = [description[0] for description in cursor.description]  # Get column names
-                    results = cursor.fetchall()
-                    conn.close()
-
-                    # Check if results are found
-                    if results:
-                        # Format the results in an HTML table
-                        result_str = "<table border='1' cellpadding='5' cellspacing='0'>"
-                        result_str += "<tr>" + "".join([f"<th>{col}</th>" for col in columns]) + "</tr>"  # Header row
-                        for row in results:
-                            result_str += "<tr>" + "".join([f"<td>{val}</td>" for val in row]) + "</tr>"  # Data rows
-                        result_str += "</table>"
-
-                        # Display the formatted table in the chat
-                        self.display_message("Results", result_str, is_user=False)
-                    else:
-                        self.display_message("Results", "No results found.", is_user=False)
-
+            # Run any SQL in the reply on the shared read-only connection, off the GUI thread
+            sql_query = extract_sql(assistant_response)
+            if sql_query:
+                self.run_sql(sql_query, trace)
+                return
+        self.finish_trace(trace)
+
+    def run_sql(self, sql_query, trace=None):
+        try:
+            database = get_read_only_database(self.db_path)
+        except Exception as e:
+            self.handle_sql_error(str(e), trace)
+            return
+        if self.sql_worker is not None and self.sql_worker.isRunning():
+            database.cancel()  # A newer query supersedes one still running
+            self.sql_worker.wait()
+        self.result_view.cancel()
+        self.sql_database = database
+        self.sql_worker = SqlWorker(lambda: database.execute(sql_query), trace)
+        self.sql_worker.result_signal.connect(lambda result: self.handle_sql_result(result, trace))
+        self.sql_worker.error_signal.connect(lambda error: self.handle_sql_error(error, trace))
+        self.sql_worker.start()
+
+    def handle_sql_result(self, result, trace=None):
+        with trace_context(trace), span("render.results", rows=len(result.page(0))):
+            if not result.page(0):
+                self.display_message("Results", "\n\n".join(result.warnings + ["No results found."]), is_user=False)
+            else:
+                self.result_view.show_result(result)
+                if result.exhausted and not result.truncated:
+                    summary = f"{result.row_count:,} rows, shown in the results panel below."
                 else:
-                    # No SQL code found in the assistant's response
-                    pass  # Do nothing extra
+                    summary = f"More than {result.row_count:,} rows; page through them in the results panel below."
+                self.display_message("Results", "\n\n".join(result.warnings + [summary]), is_user=False)
+        self.finish_trace(trace)
 
-            except Exception as e:
-                self.display_message("Error", f"Failed to execute SQL query: {e}", is_user=False)
+    def handle_sql_error(self, error_message, trace=None):
+        self.display_message("Error", f"Failed to execute SQL query: {error_message}", is_user=False)
+        self.finish_trace(trace, error_message)
 
     def handle_error(self, error_message):
+        self.finish_trace(self.worker.trace, error_message)
+        self.streaming_message = None
         self.display_message("Error", error_message, is_user=False)
         self.user_input.setDisabled(False)
         self.send_button.setDisabled(False)
 
+def run_startup_probe(folder_path=None):
+    # Started by ragnar_startup_bench.py: show the window, answer one question with the offline fake model and print
+    # wall-clock timestamps as JSON. With a folder the question is a semantic one against that knowledge base
+    # (loading the model and index), otherwise a Text-to-SQL one.
+    app = QApplication(sys.argv[:1])
+    chatbot = RagnarChatbotApp()
+    chatbot.engine.llm = FakeChatClient()
+    chatbot.show()
+    if WARM_UP_ON_START:
+        QTimer.singleShot(0, warm_up_in_background)
+
+    def first_query():
+        marks = {"window_shown": time.time()}
+        if folder_path:
+            chatbot.engine.retriever, _ = load_knowledge_base(folder_path)
+            chatbot.engine_thread.query("semantic", "What is this knowledge base about?")
+        else:
+            chatbot.engine.database = DatabaseSchema([{"name": "probe", "columns": [{"name": "id", "type": "INTEGER", "pk": True}], "foreign_keys": [], "samples": {}}])
+            chatbot.engine_thread.query("text2sql", "Show the first rows of probe")
+        marks["first_query_done"] = time.time()
+        print(json.dumps(marks), flush=True)
+        app.quit()
+
+    QTimer.singleShot(0, first_query)
+    app.exec_()
+
 if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--index-report":
+        print(format_index_report(index_tradeoff_report(sys.argv[2])))
+        sys.exit(0)
+    if len(sys.argv) in (2, 3) and sys.argv[1] == "--startup-probe":
+        run_startup_probe(sys.argv[2] if len(sys.argv) == 3 else None)
+        sys.exit(0)
     app = QApplication(sys.argv)
     chatbot = RagnarChatbotApp()
     chatbot.show()
+    if WARM_UP_ON_START:
+        QTimer.singleShot(0, warm_up_in_background)
     sys.exit(app.exec_())
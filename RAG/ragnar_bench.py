@@ -0,0 +1,375 @@
+# RAGnar benchmark suite: generates a synthetic knowledge base (PDF, DOCX and CSV files) and SQLite database at a
+# chosen scale, then measures the whole pipeline with the offline fake LLM and writes a JSON report.
+#
+#   python ragnar_bench.py --scale small --output bench.json
+#   python ragnar_bench.py --scale medium --output new.json --compare bench.json
+#
+# Measured: extraction throughput, embedding throughput, index build and cached reload time, retrieval and
+# end-to-end query latency (p50/p99), retrieval recall@k and memory. Every document plants unique facts
+# ("Project Zorvak is led by ...") and each query asks for one of them, so recall@k is the share of queries whose
+# source file is among the top-k passages. The corpus is generated from a fixed seed, so reports are comparable.
+# Memory is recorded after each stage; the index build runs in a fresh process so its peak is measured on its own.
+
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import ragnar_core
+from ragnar_core import (
+    DatabaseSchema, iter_knowledge_base_files, iter_chunked_files, iter_batches, load_knowledge_base,
+    EMBED_BATCH_SIZE
+)
+from ragnar_engine import QueryEngine, EngineThread, FakeChatClient
+
+REPORT_VERSION = 2
+SCALES = {
+    "small": {"pdf": 10, "docx": 10, "csv": 5, "words": 1500, "rows": 300, "tables": 20, "table_rows": 1000},
+    "medium": {"pdf": 100, "docx": 100, "csv": 50, "words": 3000, "rows": 2000, "tables": 100, "table_rows": 10000},
+    "large": {"pdf": 1000, "docx": 1000, "csv": 500, "words": 3000, "rows": 5000, "tables": 600, "table_rows": 50000},
+}
+FACTS_PER_DOCUMENT = 3
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "ze", "xa", "qu", "dra", "pel", "tor", "vin", "gar", "sul", "bek"]
+
+# Synthetic corpus
+def make_word(rng, syllables=(2, 3)):
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(*syllables)))
+
+class CorpusWriter:
+    # Writes documents of filler sentences with planted facts, recording a question and the answering file per fact
+    def __init__(self, folder_path, seed=0):
+        self.folder_path = folder_path
+        self.rng = random.Random(seed)
+        self.vocabulary = sorted({make_word(self.rng) for _ in range(3000)})
+        self.used_names = set()
+        self.queries = []  # {"question", "source"}
+
+    def unique_name(self):
+        while True:
+            name = make_word(self.rng, (3, 4)).capitalize()
+            if name not in self.used_names:
+                self.used_names.add(name)
+                return name
+
+    def sentence(self):
+        return " ".join(self.rng.choice(self.vocabulary) for _ in range(self.rng.randint(8, 16))).capitalize() + "."
+
+    def fact(self, file_name):
+        project, person, city = self.unique_name(), self.unique_name(), self.unique_name()
+        self.queries.append({"question": f"Who leads project {project}?", "source": file_name})
+        return f"Project {project} is led by {person} from the city of {city}."
+
+    def paragraphs(self, file_name, words):
+        # Filler paragraphs of about words words in total, with the facts spread through them
+        sentences = [self.sentence() for _ in range(max(1, words // 12))]
+        for _ in range(FACTS_PER_DOCUMENT):
+            sentences.insert(self.rng.randrange(len(sentences) + 1), self.fact(file_name))
+        return [" ".join(sentences[start:start + 6]) for start in range(0, len(sentences), 6)]
+
+    def write_pdf(self, file_name, words):
+        paragraphs = self.paragraphs(file_name, words)
+        pages = [paragraphs[start:start + 4] for start in range(0, len(paragraphs), 4)]
+        write_pdf(os.path.join(self.folder_path, file_name), ["\n".join(page) for page in pages])
+
+    def write_docx(self, file_name, words):
+        import docx
+        document = docx.Document()
+        for paragraph in self.paragraphs(file_name, words):
+            document.add_paragraph(paragraph)
+        document.save(os.path.join(self.folder_path, file_name))
+
+    def write_csv(self, file_name, rows):
+        fact_rows = set(self.rng.sample(range(rows), min(FACTS_PER_DOCUMENT, rows)))
+        with open(os.path.join(self.folder_path, file_name), 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(["order_code", "customer", "status", "amount", "notes"])
+            for row in range(rows):
+                code = self.unique_name() if row in fact_rows else f"{make_word(self.rng)}{row}"
+                status = self.unique_name() if row in fact_rows else self.rng.choice(["shipped", "pending", "returned"])
+                if row in fact_rows:
+                    self.queries.append({"question": f"What is the status of order {code}?", "source": file_name})
+                writer.writerow([code, make_word(self.rng).capitalize(), status, f"{self.rng.uniform(1, 1000):.2f}", self.sentence()])
+
+def pdf_escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def write_pdf(path, pages, line_chars=90, lines_per_page=60):
+    # Minimal text-only PDF writer (Helvetica, one content stream per page) so no PDF authoring library is needed.
+    # Long pages are wrapped and split over several physical pages.
+    physical_pages = []
+    for text in pages:
+        lines = []
+        for paragraph in text.split("\n"):
+            words, line = paragraph.split(), ""
+            for word in words:
+                if line and len(line) + 1 + len(word) > line_chars:
+                    lines.append(line)
+                    line = word
+                else:
+                    line = f"{line} {word}" if line else word
+            lines.append(line)
+        for start in range(0, max(1, len(lines)), lines_per_page):
+            physical_pages.append(lines[start:start + lines_per_page])
+
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for lines in physical_pages:
+        stream = ("BT /F1 10 Tf 12 TL 50 750 Td " + " ".join(f"({pdf_escape(line)}) Tj T*" for line in lines) + " ET").encode('latin-1', 'replace')
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        content_id = len(objects)
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id)
+        page_ids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % page_id for page_id in page_ids), len(page_ids))
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    output += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    output += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, 'wb') as f:
+        f.write(output)
+
+def generate_corpus(folder_path, scale, seed=0):
+    # Write the knowledge base files for scale and return the benchmark queries
+    os.makedirs(folder_path, exist_ok=True)
+    writer = CorpusWriter(folder_path, seed)
+    for number in range(scale["pdf"]):
+        writer.write_pdf(f"report_{number:05d}.pdf", scale["words"])
+    for number in range(scale["docx"]):
+        writer.write_docx(f"memo_{number:05d}.docx", scale["words"])
+    for number in range(scale["csv"]):
+        writer.write_csv(f"orders_{number:05d}.csv", scale["rows"])
+    return writer.queries
+
+def generate_database(db_path, scale, seed=0):
+    # A warehouse-like SQLite database: customers and orders joined by a foreign key, plus many unrelated tables,
+    # and the Text-to-SQL questions to ask of it
+    rng = random.Random(seed)
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("CREATE TABLE customers (id INTEGER PRIMARY KEY, name TEXT, country TEXT)")
+        conn.execute("CREATE TABLE orders (id INTEGER PRIMARY KEY, customer_id INTEGER REFERENCES customers(id), status TEXT, amount REAL)")
+        conn.executemany("INSERT INTO customers VALUES (?, ?, ?)",
+                         ((i, make_word(rng).capitalize(), rng.choice(["Canada", "Peru", "Norway", "Japan"])) for i in range(scale["table_rows"])))
+        conn.executemany("INSERT INTO orders VALUES (?, ?, ?, ?)",
+                         ((i, rng.randrange(scale["table_rows"]), rng.choice(["shipped", "pending"]), rng.uniform(1, 1000)) for i in range(scale["table_rows"])))
+        for number in range(max(0, scale["tables"] - 2)):
+            name = f"{make_word(rng)}_{number}"
+            columns = [make_word(rng) for _ in range(rng.randint(3, 8))]
+            conn.execute(f"CREATE TABLE {name} (id INTEGER PRIMARY KEY, {', '.join(f'{column}_{position} TEXT' for position, column in enumerate(columns))})")
+            conn.executemany(f"INSERT INTO {name} VALUES (?{', ?' * len(columns)})",
+                             ((i, *(make_word(rng) for _ in columns)) for i in range(min(scale["table_rows"], 200))))
+        conn.commit()
+    finally:
+        conn.close()
+    return ["How many orders has each customer from Canada placed?", "What is the total amount of pending orders?",
+            "List the ten customers with the largest orders."]
+
+# Measurements
+def percentiles(samples_ms):
+    if not samples_ms:
+        return {"p50_ms": None, "p99_ms": None, "mean_ms": None}
+    return {"p50_ms": float(np.percentile(samples_ms, 50)), "p99_ms": float(np.percentile(samples_ms, 99)), "mean_ms": float(np.mean(samples_ms))}
+
+def peak_rss_mb():
+    # Peak resident set size of this process and of its finished children (the extraction workers), in MB
+    try:
+        import resource
+    except ImportError:
+        return {"self": None, "children": None}  # Not available on Windows
+    unit = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return {"self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 1e6,
+            "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / 1e6}
+
+def memory_mb():
+    # Current resident set size (read on Linux only) and the peak so far of this process, in MB
+    rss = None
+    try:
+        with open("/proc/self/statm", 'r') as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError, AttributeError):
+        pass
+    return {"rss": rss, "peak": peak_rss_mb()["self"]}
+
+def measure_extraction(folder_path, sample_size):
+    # Only the first sample_size passages are kept, for measure_embedding(); the rest are counted and dropped
+    file_names = list(iter_knowledge_base_files(folder_path))
+    total_bytes = sum(os.path.getsize(os.path.join(folder_path, name)) for name in file_names)
+    started = time.perf_counter()
+    sample, passages, failed = [], 0, 0
+    for _, chunks, error in iter_chunked_files(folder_path, file_names):
+        failed += bool(error)
+        passages += len(chunks)
+        sample.extend(chunk["text"] for chunk in chunks[:sample_size - len(sample)])
+    seconds = time.perf_counter() - started
+    return sample, {"files": len(file_names), "failed": failed, "passages": passages, "seconds": seconds,
+                    "files_per_sec": len(file_names) / seconds, "mb_per_sec": total_bytes / 1e6 / seconds, "memory_mb": memory_mb()}
+
+def measure_embedding(sample):
+    encoder = ragnar_core.get_encoder()  # What indexing uses, without loading a retriever around it
+    encoder.encode(sample[:8])  # Model loading is not part of the throughput
+    started = time.perf_counter()
+    for batch in iter_batches(sample, EMBED_BATCH_SIZE):
+        encoder.encode(batch)
+    seconds = time.perf_counter() - started
+    return {"passages": len(sample), "seconds": seconds, "passages_per_sec": len(sample) / seconds if seconds else None, "memory_mb": memory_mb()}
+
+def build_index(folder_path):
+    # Full index build, run by measure_index() in a fresh process started with --build-index
+    started = time.perf_counter()
+    retriever, changes = load_knowledge_base(folder_path, rebuild=True)
+    return {"build_seconds": time.perf_counter() - started, "passages": len(retriever) if retriever is not None else 0,
+            "failed": len(changes["failed"]), "build_peak_rss_mb": peak_rss_mb()}
+
+def measure_index(folder_path):
+    # The build's peak memory, of its own process and of its extraction workers, is not mixed with the earlier
+    # stages'; the cached reload is then timed here, where the retriever is needed for the query stages
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--build-index", folder_path],
+                            check=True, capture_output=True, text=True).stdout
+    index = json.loads(output.strip().splitlines()[-1])
+    started = time.perf_counter()
+    retriever, _ = load_knowledge_base(folder_path)
+    index["cached_reload_seconds"] = time.perf_counter() - started
+    index["memory_mb"] = memory_mb()
+    return retriever, index
+
+def measure_retrieval(retriever, queries, k):
+    latencies, hits = [], 0
+    for query in queries:
+        started = time.perf_counter()
+        passages = retriever.retrieve(query["question"], k)
+        latencies.append((time.perf_counter() - started) * 1000)
+        hits += any(passage.get("source") == query["source"] for passage in passages)
+    return {"queries": len(queries), f"recall@{k}": hits / len(queries) if queries else None, **percentiles(latencies), "memory_mb": memory_mb()}
+
+def measure_engine(retriever, database, semantic_questions, sql_questions):
+    # End-to-end latency through the query engine with the instant fake LLM, so only RAGnar's own work is timed
+    engine = QueryEngine(llm=FakeChatClient(), retriever=retriever, database=database, response_cache=False)
+    engine_thread = EngineThread(engine)
+    try:
+        results = {}
+        for mode, questions in (("semantic", semantic_questions), ("text2sql", sql_questions)):
+            latencies = []
+            for question in questions:
+                started = time.perf_counter()
+                engine_thread.query(mode, question)
+                latencies.append((time.perf_counter() - started) * 1000)
+            results[mode] = {"queries": len(questions), **percentiles(latencies)}
+        results["memory_mb"] = memory_mb()
+        return results
+    finally:
+        engine_thread.stop()
+
+def run_benchmark(scale_name="small", num_queries=200, k=5, embed_sample=2000, workdir=None, seed=0):
+    scale = SCALES[scale_name]
+    folder_path = workdir or tempfile.mkdtemp(prefix="ragnar_bench_")
+    corpus_path = os.path.join(folder_path, "corpus")
+    db_path = os.path.join(folder_path, "warehouse.sqlite")
+    try:
+        started = time.perf_counter()
+        shutil.rmtree(corpus_path, ignore_errors=True)
+        queries = generate_corpus(corpus_path, scale, seed)
+        sql_questions = generate_database(db_path, scale, seed)
+        generate_seconds = time.perf_counter() - started
+        queries = random.Random(seed).sample(queries, min(num_queries, len(queries)))
+
+        start_memory = memory_mb()
+        sample, extraction = measure_extraction(corpus_path, embed_sample)
+        embedding = measure_embedding(sample)
+        del sample
+        retriever, index = measure_index(corpus_path)
+        started = time.perf_counter()
+        database = DatabaseSchema.load(db_path)
+        schema_seconds = time.perf_counter() - started
+        return {
+            "version": REPORT_VERSION,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "scale": scale_name,
+            "config": {**scale, "queries": len(queries), "k": k, "seed": seed},
+            "environment": {
+                "python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count(),
+                "embedding_model": ragnar_core.EMBEDDING_MODEL_NAME, "embedding_backend": ragnar_core.EMBEDDING_BACKEND,
+                "index_type": ragnar_core.INDEX_TYPE, "retrieval_mode": ragnar_core.RETRIEVAL_MODE, "rerank": ragnar_core.RERANK_ENABLED,
+            },
+            "results": {
+                "generate_seconds": generate_seconds,
+                "start_memory_mb": start_memory,
+                "extraction": extraction,
+                "embedding": embedding,
+                "index": index,
+                "schema": {"tables": len(database), "load_seconds": schema_seconds},
+                "retrieval": measure_retrieval(retriever, queries, k),
+                "engine": measure_engine(retriever, database, [query["question"] for query in queries], sql_questions * 10),
+                "peak_rss_mb": peak_rss_mb(),
+            },
+        }
+    finally:
+        if workdir is None:
+            shutil.rmtree(folder_path, ignore_errors=True)
+
+# Reporting
+def flatten(data, prefix=""):
+    items = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            items.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            items[f"{prefix}{key}"] = value
+    return items
+
+def compare_reports(baseline, report):
+    # One line per metric present in both reports, with the relative change
+    old, new = flatten(baseline["results"]), flatten(report["results"])
+    lines = [f"{'metric':<45}{'baseline':>14}{'current':>14}  change"]
+    for key in sorted(old.keys() & new.keys()):
+        change = f"{(new[key] - old[key]) / old[key] * 100:+.1f}%" if old[key] else "n/a"
+        lines.append(f"{key:<45}{old[key]:>14.3f}{new[key]:>14.3f}  {change}")
+    return "\n".join(lines)
+
+def format_report(report):
+    return "\n".join(f"{key:<45}{value:>14.3f}" for key, value in flatten(report["results"]).items())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark RAGnar on a generated knowledge base and database.")
+    parser.add_argument("--scale", choices=list(SCALES), default="small")
+    parser.add_argument("--queries", type=int, default=200, help="Retrieval and semantic queries to time")
+    parser.add_argument("-k", type=int, default=5, help="Passages retrieved per query for recall@k")
+    parser.add_argument("--embed-sample", type=int, default=2000, help="Passages encoded to measure embedding throughput")
+    parser.add_argument("--workdir", help="Keep the generated corpus, database and cache here instead of a temporary folder")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    parser.add_argument("--compare", help="Print the change against an earlier JSON report")
+    parser.add_argument("--build-index", help=argparse.SUPPRESS)  # Used by measure_index()
+    args = parser.parse_args(argv)
+    if args.build_index:
+        print(json.dumps(build_index(args.build_index)))
+        return
+
+    report = run_benchmark(args.scale, args.queries, args.k, args.embed_sample, args.workdir, args.seed)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            print(compare_reports(json.load(f), report))
+    else:
+        print(format_report(report))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2267 @@
+# RAGnar core: knowledge base ingestion, retrieval, prompts and caches, with no GUI dependencies.
+# The PyQt5 application (RAGnar.py) and the HTTP service (ragnar_server.py) are both built on this module.
+
+import os
+import glob
+import json
+import pathlib
+import hashlib
+import time
+import uuid
+import threading
+import tempfile
+import contextlib
+import contextvars
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import multiprocessing
+import openai
+import sqlite3
+import numpy as np
+import re  # For regex operations
+# faiss, pandas, PyPDF2, docx and sentence_transformers take seconds to import, so they are imported where they
+# are first used; a Text-to-SQL session never loads them and the window appears without waiting on them.
+
+# Load OpenAI API key
+openai.api_key = "YOUR_OPENAI_API_KEY"  # Replace with your actual API key
+
+# Model to use
+MODEL = "gpt-4"  # You can use a different model if available
+
+# Sentence transformer model for semantic search, loaded on first use by get_embedding_backend()
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+
+# Embedding backend used to encode passages and queries:
+#   "torch"       the model in fp32 through PyTorch (the reference)
+#   "torch_int8"  the same model with its linear layers dynamically quantized to int8, typically about twice as fast on CPU
+#   "onnx"        ONNX Runtime through sentence-transformers (needs sentence-transformers >= 3.2 and optimum[onnxruntime])
+# Run `python ragnar_embedding_bench.py <folder>` to compare docs/sec and recall against "torch" on your own documents.
+EMBEDDING_BACKEND = "torch"
+EMBEDDING_ONNX_FILE = None  # ONNX file inside the model repository for "onnx", e.g. a quantized "onnx/model_qint8_avx512.onnx"
+EMBEDDING_WORKERS = 1  # Processes that encode passages while indexing, each with its own copy of the model
+MULTIPROCESS_MIN_BATCH = 64  # Smaller encode calls, such as queries, always run in-process
+
+def warm_up(semantic=True):
+    # Import the heavy libraries and load the embedding model ahead of the first query, e.g. from a background
+    # thread once the window is showing. Failures are left for the first real use to report.
+    try:
+        import faiss, pandas, PyPDF2, docx  # noqa: F401
+        if semantic:
+            get_embedding_backend()
+            if RERANK_ENABLED:
+                get_reranker().load()
+    except Exception:
+        pass
+
+def warm_up_in_background(semantic=True):
+    thread = threading.Thread(target=warm_up, args=(semantic,), name="ragnar-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+# Knowledge base cache settings
+CACHE_DIR_NAME = ".ragnar_cache"  # Created inside the knowledge base folder when it is writable
+USER_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".ragnar", "cache")  # Fallback for read-only folders
+SUPPORTED_EXTENSIONS = ('.pdf', '.docx', '.csv')
+
+# Chunking settings, in words (estimated word pieces for CSV rows). all-MiniLM-L6-v2 truncates inputs at 256
+# word pieces, so passages are kept comfortably below that.
+CHUNK_SIZE = 180
+CHUNK_OVERLAP = 30
+CSV_BATCH_ROWS = 10000  # CSV files are read this many rows at a time, so a large file is never loaded whole
+
+# CSV files can also be imported into SQLite tables and queried in Text-to-SQL mode; imports go here by default
+CSV_DATABASE_PATH = os.path.join(os.path.expanduser("~"), ".ragnar", "csv_tables.sqlite")
+# Semantic prompts get the best-ranked passages that fit in CONTEXT_TOKEN_BUDGET tokens (estimated at
+# CHARS_PER_TOKEN characters each) rather than a fixed number of them
+CONTEXT_TOKEN_BUDGET = 1500
+CONTEXT_CANDIDATES = 20  # Passages retrieved to fill the budget when re-ranking is off
+CHARS_PER_TOKEN = 4
+
+# Optional second retrieval stage: RERANK_CANDIDATES first-stage passages are re-scored by a small local cross-encoder
+# in batches of RERANK_BATCH_SIZE, within RERANK_BUDGET_MS per query. Candidates not scored in time keep their
+# first-stage order, so a slow or busy CPU degrades to plain retrieval rather than a slow answer.
+RERANK_ENABLED = False
+RERANK_MODEL_NAME = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+RERANK_CANDIDATES = 50
+RERANK_BATCH_SIZE = 16
+RERANK_BUDGET_MS = 150
+
+# Indexing pipeline settings. Peak memory while indexing is bounded by these rather than by corpus size:
+# at most EXTRACTION_WORKERS * EXTRACTION_QUEUE_FACTOR files are in flight and passages are embedded
+# EMBED_BATCH_SIZE at a time.
+EXTRACTION_WORKERS = os.cpu_count() or 1
+EXTRACTION_QUEUE_FACTOR = 2
+EMBED_BATCH_SIZE = 256
+
+# Vector index settings. "flat" is exact brute-force search; "ivf_flat", "ivf_pq" and "hnsw" are approximate and
+# trade a little recall for much faster search on large knowledge bases (ivf_pq also stores compressed vectors).
+# Run `python RAGnar.py --index-report <folder>` to measure recall and latency against flat on your own data.
+INDEX_TYPE = "flat"
+INDEX_PARAMS = {
+    "nlist": None,  # IVF cells, None picks about 4 * sqrt(training sample size)
+    "pq_m": 16,  # PQ sub-quantizers, must divide the embedding dimension
+    "pq_bits": 8,  # Bits per PQ sub-quantizer code
+    "hnsw_m": 32,  # HNSW neighbours per node
+    "nprobe": 16,  # IVF cells visited per query
+    "ef_search": 64,  # HNSW candidate list size per query
+    "storage": "float32",  # Stored vector precision for flat, ivf_flat and hnsw: "float32", "float16" (half the memory) or "int8" (a quarter)
+}
+INDEX_BUILD_PARAMS = ("nlist", "pq_m", "pq_bits", "hnsw_m", "storage")  # Changing these requires a rebuild, the others are applied at load
+TRAIN_SAMPLE_SIZE = 50000  # Vectors sampled uniformly from a whole first build to train IVF and int8 indexes
+MIN_TRAIN_SIZE = 1000  # Below this many vectors, trained index types fall back to exact flat search
+
+# Retrieval mode: "dense" (vectors only), "lexical" (BM25 only) or "hybrid" (both, merged with reciprocal rank fusion).
+# Hybrid catches exact identifiers such as part numbers and table names that embeddings tend to miss.
+RETRIEVAL_MODE = "hybrid"
+HYBRID_CANDIDATES = 50  # Candidates taken from each retriever before fusion
+RRF_K = 60  # Reciprocal rank fusion damping constant
+
+# Query caches. Embeddings are cached per normalised query text; top-k results are cached until the index changes.
+QUERY_EMBEDDING_CACHE_SIZE = 4096
+QUERY_RESULT_CACHE_SIZE = 1024
+# Micro-batching: concurrent retrieve() calls through a QueryBatcher wait up to this long to share one encode/search
+QUERY_BATCH_SIZE = 32
+QUERY_BATCH_WAIT_MS = 5
+
+# LLM response cache. Answers are reused for the same model, prompt and context; with a similarity threshold set,
+# a differently worded semantic question against the same context can also be served from the cache.
+RESPONSE_CACHE_ENABLED = True
+RESPONSE_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".ragnar", "responses.sqlite")
+RESPONSE_CACHE_TTL = 7 * 24 * 3600  # Seconds
+RESPONSE_CACHE_MAX_ENTRIES = 10000
+RESPONSE_CACHE_SIMILARITY = None  # Cosine similarity (e.g. 0.95) to also match near-duplicate questions, None for exact matches only
+
+# Text-to-SQL schema settings. A database is introspected once per change to the file and cached on disk; each
+# question is then sent only the tables most relevant to it rather than the whole schema.
+SCHEMA_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".ragnar", "schemas")
+SCHEMA_CACHE_VERSION = 1
+SCHEMA_TOP_TABLES = 8  # Tables per prompt; databases with no more tables than this are always sent whole
+SCHEMA_MAX_TABLES = 16  # Cap after adding the tables that the chosen ones reference through foreign keys
+SCHEMA_SAMPLE_ROWS = 20  # Rows read from each table to pick sample values
+SCHEMA_SAMPLE_VALUES = 3  # Distinct sample values shown per text column
+SCHEMA_SAMPLE_LENGTH = 40  # Sample values are cut to this many characters
+
+# Execution of generated SQL. Queries run on one reused read-only connection per database, are interrupted after
+# SQL_TIMEOUT seconds and are read SQL_PAGE_SIZE rows at a time, never more than SQL_MAX_ROWS in total.
+SQL_TIMEOUT = 10.0  # Seconds, applied to the query itself and to every page fetched afterwards
+SQL_PAGE_SIZE = 100
+SQL_MAX_ROWS = 10000
+SQL_PROGRESS_STEPS = 10000  # SQLite virtual machine steps between timeout checks
+
+# Tracing. Each query (and each indexing run) records how long every stage took - encoding, index search, re-ranking,
+# the LLM call, SQL execution, rendering - along with its token counts. Finished traces are appended to TRACE_LOG_PATH
+# as JSON lines, and the time per stage is summed into counters that can be exported in the Prometheus text format.
+TRACE_ENABLED = True
+TRACE_LOG_PATH = os.path.join(os.path.expanduser("~"), ".ragnar", "traces.jsonl")  # None keeps traces in memory only
+TRACE_LOG_MAX_BYTES = 20 * 1024 * 1024  # Past this size the log is moved to traces.jsonl.1 and started again
+TRACE_HISTORY = 100  # Finished traces kept in memory
+TRACE_MAX_SPANS = 500  # Spans listed per trace; later ones still count towards the per-stage totals
+
+class LRUCache:
+    # Thread-safe least-recently-used cache that counts hits and misses
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self.data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+# Tracing
+_current_trace = contextvars.ContextVar("ragnar_trace", default=None)
+
+class Trace:
+    # The timed spans of one query or indexing run. Spans may come from any thread and may nest (sql.fetch runs
+    # inside sql.execute); each is kept as (name, perf_counter start, duration ms, attributes).
+    def __init__(self, kind, **attributes):
+        self.id = uuid.uuid4().hex[:16]
+        self.kind = kind
+        self.attributes = attributes
+        self.started = time.time()
+        self.origin = time.perf_counter()
+        self.duration_ms = None
+        self.error = None
+        self.spans = []
+        self.stages = {}  # Stage name -> [calls, total ms], including spans past TRACE_MAX_SPANS
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def add_span(self, name, start, duration_ms, attributes):
+        with self.lock:
+            stage = self.stages.setdefault(name, [0, 0.0])
+            stage[0] += 1
+            stage[1] += duration_ms
+            if len(self.spans) < TRACE_MAX_SPANS:
+                self.spans.append((name, start, duration_ms, attributes))
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "id": self.id,
+                "kind": self.kind,
+                "started": self.started,
+                "duration_ms": self.duration_ms,
+                "error": self.error,
+                "attributes": dict(self.attributes),
+                "counts": dict(self.counts),
+                "stages": {name: {"calls": calls, "total_ms": round(total_ms, 3)} for name, (calls, total_ms) in self.stages.items()},
+                "spans": [{"name": name, "start_ms": round((start - self.origin) * 1000, 3), "duration_ms": round(duration_ms, 3), **attributes}
+                          for name, start, duration_ms, attributes in self.spans],
+            }
+
+@contextlib.contextmanager
+def trace_context(trace):
+    # Make trace the current trace for the block; the current trace follows asyncio tasks and asyncio.to_thread()
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+def current_trace():
+    return _current_trace.get()
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    # Time a stage, adding it to the current trace (if any) and to the tracer's per-stage counters. The yielded dict
+    # holds the span's attributes, so the block can add what it learns, such as how many rows it read.
+    started = time.perf_counter()
+    failed = False
+    try:
+        yield attributes
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        record_span(name, started, (time.perf_counter() - started) * 1000, failed, **attributes)
+
+def record_span(name, start, duration_ms, failed=False, **attributes):
+    # Record a stage that was timed by hand, for work that cannot be wrapped in span()
+    if failed:
+        attributes["error"] = True
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_span(name, start, duration_ms, attributes)
+    tracer = get_tracer()
+    if tracer is not None:
+        tracer.observe(name, duration_ms, failed)
+
+def add_counts(**amounts):
+    # Add to the current trace's counts (such as prompt_tokens) and to the tracer's running totals
+    trace = _current_trace.get()
+    if trace is not None:
+        with trace.lock:
+            trace.counts.update(amounts)
+    tracer = get_tracer()
+    if tracer is not None:
+        tracer.add_counts(amounts)
+
+@contextlib.contextmanager
+def traced(kind, **attributes):
+    # Run the block under a new current trace, finished (logged and counted) when the block exits
+    tracer = get_tracer()
+    if tracer is None:
+        with trace_context(None):
+            yield None
+        return
+    trace = tracer.start(kind, **attributes)
+    error = None
+    try:
+        with trace_context(trace):
+            yield trace
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        tracer.finish(trace, error)
+
+class Tracer:
+    # Finished traces and running counters. The latest traces are kept in memory (the app's timings panel and the
+    # server's /traces endpoint), every trace is appended to the JSON lines log, and stage times and token counts
+    # are summed for prometheus().
+    def __init__(self, log_path=TRACE_LOG_PATH, history=TRACE_HISTORY, max_log_bytes=TRACE_LOG_MAX_BYTES):
+        self.log_path = log_path
+        self.max_log_bytes = max_log_bytes
+        self.recent = deque(maxlen=history)
+        self.lock = threading.Lock()
+        self.log_lock = threading.Lock()
+        self.stage_calls = Counter()
+        self.stage_ms = Counter()
+        self.stage_errors = Counter()
+        self.trace_calls = Counter()  # (kind, mode) -> finished traces
+        self.trace_ms = Counter()
+        self.trace_errors = Counter()
+        self.counts = Counter()
+
+    def start(self, kind, **attributes):
+        return Trace(kind, **attributes)
+
+    def finish(self, trace, error=None):
+        # Close the trace and return it as a dict, as logged
+        trace.duration_ms = round((time.perf_counter() - trace.origin) * 1000, 3)
+        trace.error = error
+        record = trace.to_dict()
+        key = (trace.kind, trace.attributes.get("mode", ""))
+        with self.lock:
+            self.recent.append(record)
+            self.trace_calls[key] += 1
+            self.trace_ms[key] += trace.duration_ms
+            self.trace_errors[key] += error is not None
+        if self.log_path:
+            self.write(record)
+        return record
+
+    def write(self, record):
+        with self.log_lock:
+            try:
+                os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+                if os.path.exists(self.log_path) and os.path.getsize(self.log_path) > self.max_log_bytes:
+                    os.replace(self.log_path, self.log_path + ".1")
+                with open(self.log_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record) + "\n")
+            except OSError:
+                pass  # Tracing must never break a query
+
+    def observe(self, name, duration_ms, failed=False):
+        with self.lock:
+            self.stage_calls[name] += 1
+            self.stage_ms[name] += duration_ms
+            self.stage_errors[name] += failed
+
+    def add_counts(self, amounts):
+        with self.lock:
+            self.counts.update(amounts)
+
+    def recent_traces(self, limit=None):
+        with self.lock:
+            records = list(self.recent)
+        return records[-limit:] if limit else records
+
+    def prometheus(self):
+        # Counters in the Prometheus text exposition format
+        def label(value):
+            return json.dumps(str(value))
+        with self.lock:
+            metrics = [
+                ("ragnar_stage_seconds_total", "Seconds spent in each traced stage.",
+                 [(f"stage={label(name)}", ms / 1000) for name, ms in sorted(self.stage_ms.items())]),
+                ("ragnar_stage_calls_total", "Times each traced stage ran.",
+                 [(f"stage={label(name)}", calls) for name, calls in sorted(self.stage_calls.items())]),
+                ("ragnar_stage_errors_total", "Times each traced stage raised an error.",
+                 [(f"stage={label(name)}", errors) for name, errors in sorted(self.stage_errors.items())]),
+                ("ragnar_traces_total", "Finished queries and indexing runs.",
+                 [(f"kind={label(kind)},mode={label(mode)}", calls) for (kind, mode), calls in sorted(self.trace_calls.items())]),
+                ("ragnar_trace_seconds_total", "Seconds spent in finished queries and indexing runs.",
+                 [(f"kind={label(kind)},mode={label(mode)}", ms / 1000) for (kind, mode), ms in sorted(self.trace_ms.items())]),
+                ("ragnar_trace_errors_total", "Queries and indexing runs that failed.",
+                 [(f"kind={label(kind)},mode={label(mode)}", errors) for (kind, mode), errors in sorted(self.trace_errors.items())]),
+                ("ragnar_counts_total", "Token and other counts recorded by traced stages.",
+                 [(f"name={label(name)}", value) for name, value in sorted(self.counts.items())]),
+            ]
+        lines = []
+        for name, help_text, samples in metrics:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            # repr() keeps every digit; large counters printed with :g would lose all but six
+            lines += [f"{name}{{{labels}}} {float(value)!r}" for labels, value in samples]
+        return "\n".join(lines) + "\n"
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+def get_tracer():
+    # The shared tracer, or None when tracing is disabled
+    global _tracer
+    if not TRACE_ENABLED:
+        return None
+    if _tracer is None:
+        with _tracer_lock:
+            if _tracer is None:
+                _tracer = Tracer()
+    return _tracer
+
+def format_trace(record):
+    # A finished trace as text: a summary line, then time per stage, slowest first
+    attributes = record["attributes"]
+    title = " ".join([record["kind"]] + [str(attributes[key]) for key in ("mode",) if key in attributes])
+    summary = f"{title}: {record['duration_ms'] or 0:,.1f} ms"
+    counts = record["counts"]
+    if "prompt_tokens" in counts or "completion_tokens" in counts:
+        summary += f", {counts.get('prompt_tokens', 0):,} prompt + {counts.get('completion_tokens', 0):,} completion tokens"
+    if record["error"]:
+        summary += f", failed: {record['error']}"
+    lines = [summary, f"{'stage':<18}{'calls':>6}{'ms':>10}{'share':>8}"]
+    total_ms = record["duration_ms"] or 1
+    for name, stage in sorted(record["stages"].items(), key=lambda item: -item[1]["total_ms"]):
+        share = stage["total_ms"] / total_ms
+        lines.append(f"{name:<18}{stage['calls']:>6}{stage['total_ms']:>10.1f}{share:>8.0%}  {'#' * round(min(share, 1) * 20)}")
+    return "\n".join(lines)
+
+# Embedding backends. Each exposes dim and encode(texts, normalize=False) -> float32 array of shape (len(texts), dim).
+class SentenceTransformerBackend:
+    def __init__(self, model_name=EMBEDDING_MODEL_NAME):
+        self.model_name = model_name
+        self.model = self.load_model()
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def load_model(self):
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(self.model_name)
+
+    def encode(self, texts, normalize=False):
+        embeddings = np.asarray(self.model.encode(list(texts), normalize_embeddings=normalize), dtype='float32')
+        return embeddings.reshape(len(texts), self.dim)
+
+class QuantizedTorchBackend(SentenceTransformerBackend):
+    # Weights of the linear layers stored as int8 and activations quantized on the fly; CPU only
+    def load_model(self):
+        import torch
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(self.model_name, device="cpu")
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+class OnnxBackend(SentenceTransformerBackend):
+    def load_model(self):
+        from sentence_transformers import SentenceTransformer
+        model_kwargs = {"file_name": EMBEDDING_ONNX_FILE} if EMBEDDING_ONNX_FILE else None
+        return SentenceTransformer(self.model_name, backend="onnx", model_kwargs=model_kwargs)
+
+EMBEDDING_BACKENDS = {
+    "torch": SentenceTransformerBackend,
+    "torch_int8": QuantizedTorchBackend,
+    "onnx": OnnxBackend,
+}
+
+_embedding_backends = {}
+_embedding_backends_lock = threading.Lock()
+
+def get_embedding_backend(name=None):
+    # Load a backend the first time it is needed and share it afterwards; concurrent callers wait for the same load
+    name = name or EMBEDDING_BACKEND
+    backend = _embedding_backends.get(name)
+    if backend is None:
+        with _embedding_backends_lock:
+            backend = _embedding_backends.get(name)
+            if backend is None:
+                if name not in EMBEDDING_BACKENDS:
+                    raise ValueError(f"Unknown embedding backend: {name}")
+                backend = _embedding_backends[name] = EMBEDDING_BACKENDS[name]()
+    return backend
+
+def init_encoder_worker(name, threads):
+    try:
+        import torch
+        torch.set_num_threads(threads)  # Share the cores between workers instead of every worker using all of them
+    except ImportError:
+        pass
+    get_embedding_backend(name)
+
+def encode_in_worker(name, texts, normalize):
+    return get_embedding_backend(name).encode(texts, normalize)
+
+class MultiProcessEncoder:
+    # Spreads large encode calls over worker processes, each holding its own copy of the backend. Calls smaller than
+    # min_batch, such as queries, are encoded in-process where there is no hand-off cost.
+    def __init__(self, name=None, workers=EMBEDDING_WORKERS, min_batch=MULTIPROCESS_MIN_BATCH):
+        self.name = name or EMBEDDING_BACKEND
+        self.workers = workers
+        self.min_batch = min_batch
+        self.pool = None
+        self.lock = threading.Lock()
+
+    @property
+    def dim(self):
+        return get_embedding_backend(self.name).dim
+
+    def encode(self, texts, normalize=False):
+        if len(texts) < self.min_batch:
+            return get_embedding_backend(self.name).encode(texts, normalize)
+        with self.lock:
+            if self.pool is None:
+                # Spawned rather than forked: forking a process that has already started PyTorch's threads can hang
+                threads = max(1, (os.cpu_count() or 1) // self.workers)
+                self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=init_encoder_worker, initargs=(self.name, threads))
+        size = -(-len(texts) // self.workers)
+        parts = [self.pool.submit(encode_in_worker, self.name, list(texts[start:start + size]), normalize)
+                 for start in range(0, len(texts), size)]
+        return np.vstack([part.result() for part in parts])
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+_encoder = None
+
+def get_encoder():
+    # The encoder used for passages: the configured backend, spread over EMBEDDING_WORKERS processes if more than one
+    global _encoder
+    if EMBEDDING_WORKERS <= 1:
+        return get_embedding_backend()
+    with _embedding_backends_lock:
+        if _encoder is None:
+            _encoder = MultiProcessEncoder()
+    return _encoder
+
+# Document Retriever Class
+class PassageStore:
+    # Passage texts and metadata live in SQLite rather than in memory, so only retrieved passages are loaded.
+    # Writes are committed by commit(), which lets a sync that is interrupted half way roll back cleanly.
+    # On-disk stores use write-ahead logging, so a retriever still serving queries from the cache keeps reading
+    # its snapshot while a resync holds a long write transaction on the same file.
+    SIDECAR_SUFFIXES = ("-wal", "-shm")
+
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        if path != ":memory:":
+            try:
+                self.conn.execute("PRAGMA journal_mode=WAL")
+            except sqlite3.OperationalError:
+                pass  # Read-only cache folder, the store can still be read in the default journal mode
+        self.conn.execute("CREATE TABLE IF NOT EXISTS passages (id INTEGER PRIMARY KEY, passage TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM passages").fetchone()[0]
+
+    def __getitem__(self, doc_id):
+        passages = self.get_many([doc_id])
+        if doc_id not in passages:
+            raise KeyError(doc_id)
+        return passages[doc_id]
+
+    def get_many(self, ids):
+        ids = [int(doc_id) for doc_id in ids]
+        with self.lock:
+            rows = self.conn.execute(f"SELECT id, passage FROM passages WHERE id IN ({','.join('?' * len(ids))})", ids).fetchall()
+        return {doc_id: json.loads(passage) for doc_id, passage in rows}
+
+    def existing_ids(self, ids):
+        ids = [int(doc_id) for doc_id in ids]
+        with self.lock:
+            rows = self.conn.execute(f"SELECT id FROM passages WHERE id IN ({','.join('?' * len(ids))})", ids).fetchall()
+        return {doc_id for doc_id, in rows}
+
+    def next_id(self):
+        # Passage IDs are never reused, so vectors and postings left behind by removed passages can never be
+        # mistaken for new ones. The high-water mark is stored rather than derived from the highest live ID.
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM metadata WHERE key = 'next_id'").fetchone()
+            max_id = self.conn.execute("SELECT MAX(id) FROM passages").fetchone()[0]
+        return max(row[0] if row else 0, -1 if max_id is None else max_id + 1)
+
+    def set_next_id(self, next_id):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('next_id', ?)", (int(next_id),))
+
+    def add(self, ids, passages):
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO passages (id, passage) VALUES (?, ?)",
+                                  [(int(doc_id), json.dumps(passage)) for doc_id, passage in zip(ids, passages)])
+
+    def remove(self, ids):
+        with self.lock:
+            self.conn.executemany("DELETE FROM passages WHERE id = ?", [(int(doc_id),) for doc_id in ids])
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def sample(self, count):
+        with self.lock:
+            rows = self.conn.execute("SELECT passage FROM passages ORDER BY RANDOM() LIMIT ?", (count,)).fetchall()
+        return [json.loads(passage) for passage, in rows]
+
+    def save(self, path):
+        # Commit in place, or copy an in-memory store to path
+        if os.path.abspath(path) == os.path.abspath(self.path):
+            self.commit()
+            return
+        with self.lock:
+            self.conn.commit()
+            target = sqlite3.connect(path)
+            self.conn.backup(target)
+            target.close()
+
+class LexicalIndex:
+    # BM25 keyword index over passage text, stored in the passage store's SQLite database so it is saved and
+    # committed together with the passages. Postings are kept compact: each flush writes one row per term
+    # holding that segment's delta-encoded passage IDs and term frequencies, zlib-compressed.
+    # Document lengths are held in memory as a dense array; a length of 0 marks a removed passage. The postings
+    # of removed passages are skipped at query time until compact() rewrites the terms they contained.
+    K1 = 1.2
+    B = 0.75
+    FLUSH_SIZE = 50000  # Passages buffered in memory before their postings are written out
+
+    def __init__(self, store):
+        self.store = store
+        self.lock = threading.Lock()
+        with store.lock:
+            store.conn.execute("CREATE TABLE IF NOT EXISTS postings (term TEXT NOT NULL, segment INTEGER NOT NULL, "
+                               "doc_ids BLOB NOT NULL, tfs BLOB NOT NULL, PRIMARY KEY (term, segment))")
+            store.conn.execute("CREATE TABLE IF NOT EXISTS lexical_docs (id INTEGER PRIMARY KEY, length INTEGER NOT NULL)")
+            rows = store.conn.execute("SELECT id, length FROM lexical_docs").fetchall()
+            max_segment = store.conn.execute("SELECT MAX(segment) FROM postings").fetchone()[0]
+        ids = np.fromiter((doc_id for doc_id, _ in rows), dtype='int64', count=len(rows))
+        self.doc_lengths = np.zeros(int(ids.max()) + 1 if len(ids) else 0, dtype='int32')
+        self.doc_lengths[ids] = np.fromiter((length for _, length in rows), dtype='int32', count=len(rows))
+        self.num_docs = int(np.count_nonzero(self.doc_lengths))
+        self.total_length = int(self.doc_lengths.sum())
+        self.next_segment = 0 if max_segment is None else max_segment + 1
+        self.pending = {}  # term -> ([passage IDs], [term frequencies]) not yet written
+        self.pending_docs = 0
+        self.stale_terms = set()  # Terms of removed passages whose postings have not been compacted yet
+
+    def add(self, ids, texts):
+        rows = []
+        with self.lock:
+            for doc_id, text in zip(ids, texts):
+                counts = Counter(tokenize(text))
+                length = max(1, sum(counts.values()))  # Keep empty passages distinguishable from removed ones
+                for term, tf in counts.items():
+                    postings = self.pending.setdefault(term, ([], []))
+                    postings[0].append(doc_id)
+                    postings[1].append(min(tf, 255))
+                if doc_id >= len(self.doc_lengths):
+                    self.doc_lengths = np.concatenate([self.doc_lengths, np.zeros(max(doc_id + 1 - len(self.doc_lengths), len(self.doc_lengths)), dtype='int32')])
+                self.doc_lengths[doc_id] = length
+                self.num_docs += 1
+                self.total_length += length
+                rows.append((int(doc_id), length))
+            self.pending_docs += len(rows)
+            flush = self.pending_docs >= self.FLUSH_SIZE
+        with self.store.lock:
+            self.store.conn.executemany("INSERT OR REPLACE INTO lexical_docs (id, length) VALUES (?, ?)", rows)
+        if flush:
+            self.flush()
+
+    def remove(self, ids):
+        # Removed passages are masked out through their length. Must be called while the store still holds them,
+        # so the terms whose postings need compacting can be read from their text.
+        terms = set()
+        for batch in iter_batches(ids, 500):
+            for passage in self.store.get_many(batch).values():
+                terms.update(tokenize(passage["text"]))
+        with self.lock:
+            self.stale_terms |= terms
+            for doc_id in ids:
+                if doc_id < len(self.doc_lengths) and self.doc_lengths[doc_id]:
+                    self.num_docs -= 1
+                    self.total_length -= int(self.doc_lengths[doc_id])
+                    self.doc_lengths[doc_id] = 0
+        with self.store.lock:
+            self.store.conn.executemany("DELETE FROM lexical_docs WHERE id = ?", [(int(doc_id),) for doc_id in ids])
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            segment = self.next_segment
+            rows = [(term, segment, encode_postings(doc_ids), zlib.compress(bytes(tfs)))
+                    for term, (doc_ids, tfs) in self.pending.items()]
+            self.pending = {}
+            self.pending_docs = 0
+            self.next_segment += 1
+        with self.store.lock:
+            self.store.conn.executemany("INSERT INTO postings (term, segment, doc_ids, tfs) VALUES (?, ?, ?, ?)", rows)
+
+    def compact(self):
+        # Write pending postings, then drop removed passages from the posting rows of the terms they contained
+        self.flush()
+        with self.lock:
+            terms, self.stale_terms = self.stale_terms, set()
+            doc_lengths = self.doc_lengths
+        updates, deletes = [], []
+        for term in terms:
+            with self.store.lock:
+                rows = self.store.conn.execute("SELECT segment, doc_ids, tfs FROM postings WHERE term = ?", (term,)).fetchall()
+            for segment, doc_ids, tfs in rows:
+                ids = decode_postings(doc_ids)
+                in_range = ids < len(doc_lengths)
+                live = np.zeros(len(ids), dtype=bool)
+                live[in_range] = doc_lengths[ids[in_range]] > 0
+                if live.all():
+                    continue
+                if live.any():
+                    tfs = np.frombuffer(zlib.decompress(tfs), dtype='uint8')
+                    updates.append((encode_postings(ids[live]), zlib.compress(tfs[live].tobytes()), term, segment))
+                else:
+                    deletes.append((term, segment))
+        with self.store.lock:
+            self.store.conn.executemany("UPDATE postings SET doc_ids = ?, tfs = ? WHERE term = ? AND segment = ?", updates)
+            self.store.conn.executemany("DELETE FROM postings WHERE term = ? AND segment = ?", deletes)
+
+    def postings(self, term):
+        with self.store.lock:
+            rows = self.store.conn.execute("SELECT doc_ids, tfs FROM postings WHERE term = ? ORDER BY segment", (term,)).fetchall()
+        if not rows:
+            return np.zeros(0, dtype='int64'), np.zeros(0, dtype='uint8')
+        ids = np.concatenate([decode_postings(doc_ids) for doc_ids, _ in rows])
+        tfs = np.concatenate([np.frombuffer(zlib.decompress(tfs), dtype='uint8') for _, tfs in rows])
+        return ids, tfs
+
+    def search(self, query, k):
+        # Return up to k (passage ID, BM25 score) pairs, best first
+        self.flush()
+        if not self.num_docs:
+            return []
+        average_length = self.total_length / self.num_docs
+        matched_ids, matched_scores = [], []
+        for term in set(tokenize(query)):
+            ids, tfs = self.postings(term)
+            in_range = ids < len(self.doc_lengths)  # Stale postings may outlive the highest live ID
+            ids, tfs = ids[in_range], tfs[in_range]
+            lengths = self.doc_lengths[ids]
+            live = lengths > 0
+            if not live.any():
+                continue
+            ids, tfs, lengths = ids[live], tfs[live].astype('float32'), lengths[live]
+            idf = np.log(1 + (self.num_docs - len(ids) + 0.5) / (len(ids) + 0.5))
+            matched_ids.append(ids)
+            matched_scores.append(idf * tfs * (self.K1 + 1) / (tfs + self.K1 * (1 - self.B + self.B * lengths / average_length)))
+        if not matched_ids:
+            return []
+        unique_ids, inverse = np.unique(np.concatenate(matched_ids), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(matched_scores))
+        top = np.argsort(-scores)[:k] if len(scores) <= k else np.argpartition(-scores, k)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(unique_ids[i]), float(scores[i])) for i in top]
+
+# Tokens keep identifiers such as part numbers, versions and dotted table names whole, and also index their parts
+TOKEN_PATTERN = re.compile(r"\w+(?:[-./:]\w+)*")
+
+def tokenize(text):
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        tokens.append(token)
+        parts = re.split(r"[-./:]", token)
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return tokens
+
+def encode_postings(doc_ids):
+    # IDs within a segment are ascending, so the gaps are small and compress well
+    return zlib.compress(np.diff(np.asarray(doc_ids, dtype='int64'), prepend=0).astype('<u4').tobytes())
+
+def decode_postings(blob):
+    return np.cumsum(np.frombuffer(zlib.decompress(blob), dtype='<u4').astype('int64'))
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    # Merge ranked ID lists by summing 1 / (k + rank) across them
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+class TrainingBuffer:
+    # Holds vectors back until a trained index type can be built. Every vector is spilled to a temporary file in
+    # ingestion order, while a uniform reservoir sample of up to sample_size of them is kept in memory to train
+    # on, so the sample is not dominated by the files that happened to be embedded first.
+    def __init__(self, dim, sample_size=TRAIN_SAMPLE_SIZE, seed=0):
+        self.dim = dim
+        self.sample_size = sample_size
+        self.sample = np.zeros((0, dim), dtype='float32')
+        self.count = 0
+        self.rng = np.random.default_rng(seed)
+        self.vectors = tempfile.TemporaryFile()
+        self.ids = tempfile.TemporaryFile()
+
+    def __len__(self):
+        return self.count
+
+    def add(self, embeddings, ids):
+        embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+        self.vectors.write(embeddings.tobytes())
+        self.ids.write(np.asarray(ids, dtype='int64').tobytes())
+        # Algorithm R: fill the sample, then the n-th vector replaces a random slot with probability sample_size / n
+        free = min(self.sample_size - len(self.sample), len(embeddings))
+        if free:
+            self.sample = np.vstack([self.sample, embeddings[:free]])
+        slots = self.rng.integers(0, self.count + np.arange(free, len(embeddings)) + 1)
+        kept = slots < self.sample_size
+        self.sample[slots[kept]] = embeddings[free:][kept]
+        self.count += len(embeddings)
+
+    def chunks(self, rows):
+        # Yield the buffered (embeddings, ids) in ingestion order, up to rows at a time
+        self.vectors.seek(0)
+        self.ids.seek(0)
+        while True:
+            ids = np.frombuffer(self.ids.read(rows * 8), dtype='int64')
+            if not len(ids):
+                return
+            yield np.frombuffer(self.vectors.read(len(ids) * self.dim * 4), dtype='float32').reshape(len(ids), self.dim), ids
+
+    def close(self):
+        self.vectors.close()
+        self.ids.close()
+
+class DocumentRetriever:
+    INDEX_FILE = "index.faiss"
+    PASSAGES_FILE = "passages.sqlite"
+
+    def __init__(self, documents=(), index=None, store=None, batch_size=EMBED_BATCH_SIZE, index_type=INDEX_TYPE, index_params=None, encoder=None):
+        # Documents are passages, dicts holding "text" plus source metadata (plain strings are accepted too).
+        # They are addressed by stable integer IDs so they can be added and removed individually.
+        # encoder is an embedding backend; by default the configured one is loaded on first use.
+        self._encoder = encoder
+        self.batch_size = batch_size
+        self.index_type = index_type
+        self.index_params = {**INDEX_PARAMS, **(index_params or {})}
+        self.store = store if store is not None else PassageStore()
+        self.lexical = LexicalIndex(self.store)
+        self.embedding_cache = LRUCache(QUERY_EMBEDDING_CACHE_SIZE)
+        self.result_cache = LRUCache(QUERY_RESULT_CACHE_SIZE)  # Cleared whenever the indexed passages change
+        self.training_buffer = None  # TrainingBuffer holding vectors back until a trained index type is built
+        self.index = index if index is not None else self.create_index()
+        if index is not None:
+            set_search_params(self.index, self.index_params)
+        self.next_id = self.store.next_id()
+        if documents:
+            self.add_documents(documents)
+
+    def __len__(self):
+        return len(self.store)
+
+    @property
+    def encoder(self):
+        if self._encoder is None:
+            self._encoder = get_encoder()
+        return self._encoder
+
+    def encode(self, texts):
+        return self.encoder.encode(texts)
+
+    def create_index(self, train_vectors=None):
+        # Create an empty FAISS index for fast document retrieval. Index types that need training return None
+        # until enough vectors have been buffered to train on.
+        if index_needs_training(self.index_type, self.index_params["storage"]) and train_vectors is None:
+            return None
+        return build_faiss_index(self.index_type, self.encoder.dim, train_vectors, self.index_params)
+
+    def train_index(self):
+        # Train on the buffer's sample, then stream every buffered vector into the new index
+        buffer = self.training_buffer
+        if buffer is None:
+            self.index = self.create_index(train_vectors=np.zeros((0, self.encoder.dim), dtype='float32'))
+            return
+        with span("index.train", vectors=len(buffer.sample)):
+            self.index = self.create_index(train_vectors=buffer.sample)
+        with span("index.add", passages=len(buffer)):
+            for embeddings, ids in buffer.chunks(TRAIN_SAMPLE_SIZE):
+                self.index.add_with_ids(embeddings, ids)
+        buffer.close()
+        self.training_buffer = None
+        self.result_cache.clear()
+
+    def add_documents(self, documents, on_batch=None):
+        # Embed and index passages batch by batch, returning the IDs assigned to them in order.
+        # documents may be any iterable, including a generator, and is never materialised as a whole.
+        # on_batch, if given, is called with the running number of embedded passages after every batch.
+        new_ids = []
+        for batch in iter_batches((as_passage(doc) for doc in documents), self.batch_size):
+            batch_ids = np.arange(self.next_id, self.next_id + len(batch), dtype='int64')
+            with span("encode", passages=len(batch)):
+                embeddings = self.encode([doc["text"] for doc in batch])
+            with span("index.add", passages=len(batch)):
+                if self.index is None:
+                    if self.training_buffer is None:
+                        self.training_buffer = TrainingBuffer(self.encoder.dim)
+                    self.training_buffer.add(embeddings, batch_ids)
+                else:
+                    self.index.add_with_ids(embeddings, batch_ids)
+                self.store.add(batch_ids.tolist(), batch)
+                self.lexical.add(batch_ids.tolist(), [doc["text"] for doc in batch])
+            self.result_cache.clear()
+            self.next_id += len(batch)
+            self.store.set_next_id(self.next_id)
+            new_ids.extend(batch_ids.tolist())
+            if on_batch:
+                on_batch(len(new_ids))
+        if self.index is None:
+            self.train_index()  # Trained index types are built once every vector has had a chance to be sampled
+        return new_ids
+
+    def remove_documents(self, ids):
+        if not len(ids):
+            return
+        try:
+            self.index.remove_ids(np.asarray(ids, dtype='int64'))
+        except RuntimeError:
+            pass  # HNSW cannot delete vectors; removed IDs are skipped at search time because the store drops them
+        self.lexical.remove(ids)  # Before the store, which still holds the text of the removed passages
+        self.store.remove(ids)
+        self.result_cache.clear()
+
+    def save(self, cache_dir):
+        # Persist the index and passages so an unchanged folder can be reopened without re-encoding
+        import faiss
+        os.makedirs(cache_dir, exist_ok=True)
+        write_atomic(os.path.join(cache_dir, self.INDEX_FILE), lambda path: faiss.write_index(self.index, path))
+        self.lexical.compact()
+        self.store.save(os.path.join(cache_dir, self.PASSAGES_FILE))
+
+    @classmethod
+    def load(cls, cache_dir, mmap=True):
+        # Load a retriever saved with save(); the index is memory-mapped where possible.
+        # Pass mmap=False when the retriever is going to be modified.
+        import faiss
+        index_path = os.path.join(cache_dir, cls.INDEX_FILE)
+        passages_path = os.path.join(cache_dir, cls.PASSAGES_FILE)
+        if not os.path.exists(passages_path):
+            raise FileNotFoundError(passages_path)
+        index = None
+        if mmap:
+            try:
+                index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            except RuntimeError:
+                index = None  # This index type or FAISS build does not support mmap
+        if index is None:
+            index = faiss.read_index(index_path)
+        return cls(index=index, store=PassageStore(passages_path))
+
+    def embed_queries(self, queries):
+        # Encode normalised queries, serving repeats from the cache and encoding all misses in one call
+        embeddings = [self.embedding_cache.get(query) for query in queries]
+        missing = list(dict.fromkeys(query for query, embedding in zip(queries, embeddings) if embedding is None))
+        if missing:
+            with span("encode", queries=len(missing)):
+                encoded = dict(zip(missing, self.encode(missing)))
+            for query, embedding in encoded.items():
+                self.embedding_cache.put(query, embedding)
+            embeddings = [encoded[query] if embedding is None else embedding for query, embedding in zip(queries, embeddings)]
+        return np.stack(embeddings)
+
+    def dense_search(self, query_embeddings, k):
+        # Return, for each query embedding, up to k live passage IDs ordered by vector distance.
+        # All queries share a single index.search() call.
+        with span("search", queries=len(query_embeddings), k=k):
+            distances, indices = self.index.search(query_embeddings, k)
+        rows = [[i for i in row if i != -1] for row in indices.tolist()]
+        live = self.store.existing_ids({i for ids in rows for i in ids})
+        results = []
+        for query_embedding, ids in zip(query_embeddings, rows):
+            ranked = [i for i in ids if i in live]
+            if len(ranked) < k and len(ids) == k and k < self.index.ntotal:
+                # Removed-but-not-deleted vectors (HNSW) pushed live passages out of the top-k, search deeper
+                ranked = self.dense_search_deeper(query_embedding[None, :], k)
+            results.append(ranked)
+        return results
+
+    def dense_search_deeper(self, query_embedding, k):
+        fetch = 2 * k
+        while True:
+            distances, indices = self.index.search(query_embedding, fetch)
+            ids = [i for i in indices[0].tolist() if i != -1]
+            live = self.store.existing_ids(ids)
+            ranked = [i for i in ids if i in live]
+            if len(ranked) >= k or len(ids) < fetch or fetch >= self.index.ntotal:
+                return ranked[:k]
+            fetch *= 2
+
+    def lexical_search(self, query, k):
+        with span("lexical", k=k):
+            return [doc_id for doc_id, _ in self.lexical.search(query, k)]
+
+    def retrieve(self, query, k=3, mode=RETRIEVAL_MODE):
+        # Retrieve the top-k passages most relevant to the query
+        return self.retrieve_batch([query], k, mode)[0]
+
+    def retrieve_batch(self, queries, k=3, mode=RETRIEVAL_MODE):
+        # Retrieve the top-k passages for several queries at once. Cached results are reused; the remaining
+        # queries are embedded together and searched with one FAISS call.
+        keys = [normalize_query(query) for query in queries]
+        results = [self.result_cache.get((key, k, mode)) for key in keys]
+        todo = [position for position, ids in enumerate(results) if ids is None]
+        if todo:
+            candidates = k if mode == "dense" else max(k, HYBRID_CANDIDATES)
+            dense = None if mode == "lexical" else self.dense_search(self.embed_queries([keys[i] for i in todo]), candidates)
+            for row, position in enumerate(todo):
+                if mode == "dense":
+                    ids = dense[row]
+                elif mode == "lexical":
+                    ids = self.lexical_search(keys[position], k)
+                else:
+                    ids = reciprocal_rank_fusion([dense[row], self.lexical_search(keys[position], candidates)])
+                results[position] = ids[:k]
+                self.result_cache.put((keys[position], k, mode), results[position])
+        with span("passages"):
+            passages = self.store.get_many({i for ids in results for i in ids})
+        return [[passages[i] for i in ids if i in passages] for ids in results]
+
+    def cache_stats(self):
+        return {"query_embeddings": self.embedding_cache.stats(), "query_results": self.result_cache.stats()}
+
+def normalize_query(query):
+    # Queries differing only in case or whitespace share cache entries (the embedding model is uncased)
+    return " ".join(query.lower().split())
+
+class QueryBatcher:
+    # Micro-batches concurrent retrieve() calls from many threads so they share one encode() and one
+    # index.search(). The first caller to arrive leads: it waits up to max_wait_ms for others to join,
+    # runs the batch for everyone and keeps going while requests are still queued.
+    def __init__(self, retriever, max_batch=QUERY_BATCH_SIZE, max_wait_ms=QUERY_BATCH_WAIT_MS):
+        self.retriever = retriever
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.condition = threading.Condition()
+        self.pending = []
+        self.leader_active = False
+        self.batches = 0
+        self.queries = 0
+
+    def retrieve(self, query, k=3, mode=RETRIEVAL_MODE):
+        with span("retrieve", k=k):
+            return self.wait_for_batch(query, k, mode)
+
+    def wait_for_batch(self, query, k, mode):
+        request = {"query": query, "k": k, "mode": mode, "done": threading.Event(), "result": None, "error": None, "trace": current_trace()}
+        with self.condition:
+            self.pending.append(request)
+            if len(self.pending) >= self.max_batch:
+                self.condition.notify_all()
+            lead = not self.leader_active
+            self.leader_active = True
+        if lead:
+            self.run_batches()
+        request["done"].wait()
+        if request["error"] is not None:
+            raise request["error"]
+        return request["result"]
+
+    def run_batches(self):
+        while True:
+            deadline = time.monotonic() + self.max_wait
+            with self.condition:
+                while len(self.pending) < self.max_batch and time.monotonic() < deadline:
+                    self.condition.wait(deadline - time.monotonic())
+                batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+            self.run_batch(batch)
+            with self.condition:
+                if not self.pending:
+                    self.leader_active = False
+                    return
+
+    def run_batch(self, batch):
+        # The batch's encode and search spans are shared work, so they are copied into the trace of every query in it
+        groups = {}
+        for request in batch:
+            groups.setdefault(request["mode"], []).append(request)
+        for mode, requests in groups.items():
+            k = max(request["k"] for request in requests)
+            batch_trace = Trace("batch")
+            try:
+                with trace_context(batch_trace):
+                    results = self.retriever.retrieve_batch([request["query"] for request in requests], k, mode)
+                for request, passages in zip(requests, results):
+                    request["result"] = passages[:request["k"]]
+            except Exception as e:
+                for request in requests:
+                    request["error"] = e
+            for request in requests:
+                if request["trace"] is not None:
+                    for name, start, duration_ms, attributes in batch_trace.spans:
+                        request["trace"].add_span(name, start, duration_ms, {**attributes, "batch_size": len(requests)})
+        with self.condition:
+            self.batches += 1
+            self.queries += len(batch)
+        for request in batch:
+            request["done"].set()
+
+    def stats(self):
+        with self.condition:
+            return {"batches": self.batches, "queries": self.queries,
+                    "average_batch_size": self.queries / self.batches if self.batches else 0.0,
+                    **self.retriever.cache_stats()}
+
+class CrossEncoderReranker:
+    # Re-scores (query, passage) pairs with a cross-encoder under a per-query time budget. The cost of a pair is
+    # tracked as it runs, so a batch that would overrun the budget is cut short instead of started.
+    def __init__(self, model_name=RERANK_MODEL_NAME, batch_size=RERANK_BATCH_SIZE, budget_ms=RERANK_BUDGET_MS):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.budget_ms = budget_ms
+        self.model = None
+        self.lock = threading.Lock()  # Held while loading the model or scoring with it
+        self.stats_lock = threading.Lock()
+        self.pair_ms = None  # Moving average of the time to score one pair
+        self.queries = 0
+        self.partial = 0  # Queries where the budget ran out before every candidate was scored
+        self.total_ms = 0.0
+
+    def load(self):
+        if self.model is not None:
+            return self.model  # Without taking the lock, which a query being scored holds
+        with self.lock:
+            if self.model is None:
+                from sentence_transformers import CrossEncoder
+                self.model = CrossEncoder(self.model_name, device="cpu")
+        return self.model
+
+    def rerank(self, query, passages, budget_ms=None):
+        # Return passages with the scored ones first, best first, followed by the rest in their original order.
+        # The budget covers waiting for the model as well, since concurrent queries share it.
+        model = self.load()  # Loading the model once is not charged to any query
+        started = time.perf_counter()
+        deadline = started + (self.budget_ms if budget_ms is None else budget_ms) / 1000
+        scores = []
+        # A query that cannot get the model within its budget keeps the first-stage order
+        if self.lock.acquire(timeout=max(deadline - time.perf_counter(), 0)):
+            try:
+                while len(scores) < len(passages):
+                    remaining_ms = (deadline - time.perf_counter()) * 1000
+                    size = min(self.batch_size, len(passages) - len(scores))
+                    if self.pair_ms:
+                        size = min(size, int(remaining_ms / self.pair_ms))
+                    if size <= 0 or remaining_ms <= 0:
+                        break
+                    batch = passages[len(scores):len(scores) + size]
+                    batch_started = time.perf_counter()
+                    scores.extend(float(score) for score in model.predict([(query, passage["text"]) for passage in batch], batch_size=size))
+                    pair_ms = (time.perf_counter() - batch_started) * 1000 / size
+                    self.pair_ms = pair_ms if self.pair_ms is None else 0.8 * self.pair_ms + 0.2 * pair_ms
+            finally:
+                self.lock.release()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self.stats_lock:
+            self.queries += 1
+            self.partial += len(scores) < len(passages)
+            self.total_ms += elapsed_ms
+        record_span("rerank", started, elapsed_ms, candidates=len(passages), scored=len(scores))
+        ranked = sorted(range(len(scores)), key=lambda position: -scores[position])
+        return [passages[position] for position in ranked] + passages[len(scores):]
+
+    def stats(self):
+        with self.stats_lock:
+            return {"queries": self.queries, "partial": self.partial, "pair_ms": self.pair_ms,
+                    "average_ms": self.total_ms / self.queries if self.queries else 0.0}
+
+_reranker = None
+
+def get_reranker():
+    # The shared reranker when re-ranking is enabled, else None; its model loads on first use
+    global _reranker
+    if not RERANK_ENABLED:
+        return None
+    with _embedding_backends_lock:
+        if _reranker is None:
+            _reranker = CrossEncoderReranker()
+    return _reranker
+
+def estimate_tokens(text):
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+def pack_passages(passages, token_budget=CONTEXT_TOKEN_BUDGET):
+    # Take passages in ranked order while they fit in the budget, skipping any that do not so a shorter one further
+    # down can still be used. The best passage is always included.
+    packed, used = [], 0
+    for passage in passages:
+        cost = estimate_tokens(format_passage(passage)) + 1
+        if packed and used + cost > token_budget:
+            continue
+        packed.append(passage)
+        used += cost
+    return packed
+
+def retrieve_context(retriever, query, reranker=None, token_budget=CONTEXT_TOKEN_BUDGET):
+    # Passages for a semantic prompt: first-stage candidates from retriever (a DocumentRetriever or QueryBatcher),
+    # re-ranked if a reranker is given, then packed into the token budget
+    candidates = retriever.retrieve(query, RERANK_CANDIDATES if reranker is not None else CONTEXT_CANDIDATES)
+    if reranker is not None and candidates:
+        candidates = reranker.rerank(query, candidates)
+    return pack_passages(candidates, token_budget)
+
+# FAISS index construction for the supported index types
+# FAISS codes for each stored vector precision; int8 is a scalar quantizer trained on the per-dimension value ranges
+VECTOR_CODECS = {"float32": "Flat", "float16": "SQfp16", "int8": "SQ8"}
+
+def index_needs_training(index_type, storage="float32"):
+    return index_type in ("ivf_flat", "ivf_pq") or (storage == "int8" and index_type != "ivf_pq")
+
+def resolve_index_type(index_type, num_train):
+    # Trained index types need a reasonable sample; tiny knowledge bases are searched exactly instead
+    if index_type in ("ivf_flat", "ivf_pq") and num_train < MIN_TRAIN_SIZE:
+        return "flat"
+    return index_type
+
+def resolve_storage(storage, num_train):
+    # Value ranges learned from a handful of vectors clip everything added later, so small samples use float16
+    if storage not in VECTOR_CODECS:
+        raise ValueError(f"Unknown vector storage: {storage}")
+    if storage == "int8" and num_train < MIN_TRAIN_SIZE:
+        return "float16"
+    return storage
+
+def index_factory_string(index_type, dim, num_train, params):
+    codec = VECTOR_CODECS[resolve_storage(params["storage"], num_train)]
+    if index_type == "flat":
+        return f"IDMap,{codec}"
+    if index_type == "hnsw":
+        return f"IDMap,HNSW{params['hnsw_m']},{codec}"
+    nlist = params["nlist"] or int(4 * num_train ** 0.5)
+    nlist = max(1, min(nlist, num_train // 39))  # FAISS wants at least 39 training points per cell
+    if index_type == "ivf_flat":
+        return f"IVF{nlist},{codec}"
+    if index_type == "ivf_pq":
+        pq_m = max(m for m in range(1, params["pq_m"] + 1) if dim % m == 0)
+        return f"IVF{nlist},PQ{pq_m}x{params['pq_bits']}"
+    raise ValueError(f"Unknown index type: {index_type}")
+
+def build_faiss_index(index_type, dim, train_vectors=None, params=None):
+    import faiss
+    params = {**INDEX_PARAMS, **(params or {})}
+    num_train = 0 if train_vectors is None else len(train_vectors)
+    index = faiss.index_factory(dim, index_factory_string(resolve_index_type(index_type, num_train), dim, num_train, params), faiss.METRIC_L2)
+    if not index.is_trained:
+        index.train(np.ascontiguousarray(train_vectors, dtype='float32'))
+    set_search_params(index, params)
+    return index
+
+def set_search_params(index, params=None):
+    # Apply the query-time knobs; each one only applies to some index types
+    import faiss
+    params = {**INDEX_PARAMS, **(params or {})}
+    space = faiss.ParameterSpace()
+    for name, value in (("nprobe", params["nprobe"]), ("efSearch", params["ef_search"])):
+        try:
+            space.set_index_parameter(index, name, value)
+        except RuntimeError:
+            pass
+
+# Recall-vs-latency comparison of index settings against exact search
+INDEX_REPORT_CONFIGS = [
+    ("flat", {}),
+    ("flat", {"storage": "float16"}),
+    ("flat", {"storage": "int8"}),
+    ("ivf_flat", {"nprobe": 8}),
+    ("ivf_flat", {"nprobe": 32}),
+    ("ivf_pq", {"nprobe": 8}),
+    ("ivf_pq", {"nprobe": 32}),
+    ("hnsw", {"ef_search": 32}),
+    ("hnsw", {"ef_search": 128}),
+    ("hnsw", {"ef_search": 128, "storage": "int8"}),
+]
+
+def compare_index_types(vectors, queries, k=10, configs=INDEX_REPORT_CONFIGS):
+    # Build each configuration over vectors and report build time, size, recall@k against flat and query latency
+    import faiss
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    queries = np.ascontiguousarray(queries, dtype='float32')
+    dim = vectors.shape[1]
+    ids = np.arange(len(vectors), dtype='int64')
+    exact = build_faiss_index("flat", dim)
+    exact.add_with_ids(vectors, ids)
+    _, truth = exact.search(queries, k)
+
+    rows = []
+    for index_type, params in configs:
+        started = time.perf_counter()
+        index = build_faiss_index(index_type, dim, vectors[:TRAIN_SAMPLE_SIZE], params)
+        index.add_with_ids(vectors, ids)
+        build_seconds = time.perf_counter() - started
+        latencies, hits = [], 0
+        for query, expected in zip(queries, truth):
+            started = time.perf_counter()
+            _, found = index.search(query[None, :], k)
+            latencies.append((time.perf_counter() - started) * 1000)
+            hits += len(set(found[0].tolist()) & set(expected.tolist()) - {-1})
+        rows.append({
+            "index_type": resolve_index_type(index_type, min(len(vectors), TRAIN_SAMPLE_SIZE)),
+            "params": params,
+            "build_seconds": build_seconds,
+            "index_bytes": int(faiss.serialize_index(index).size),
+            f"recall@{k}": hits / (k * len(queries)),
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p99_ms": float(np.percentile(latencies, 99)),
+        })
+    return rows
+
+def index_tradeoff_report(folder_path, sample_size=20000, num_queries=200, k=10, configs=INDEX_REPORT_CONFIGS):
+    # Compare index settings on a sample of a knowledge base. Held-out passages are used as queries.
+    retriever, _ = load_knowledge_base(folder_path)
+    if retriever is None:
+        return []
+    texts = [passage["text"] for passage in retriever.store.sample(sample_size + num_queries)]
+    num_queries = min(num_queries, max(1, len(texts) // 10))
+    vectors = np.vstack([retriever.encode(batch) for batch in iter_batches(texts, EMBED_BATCH_SIZE)])
+    return compare_index_types(vectors[num_queries:], vectors[:num_queries], k, configs)
+
+def format_index_report(rows):
+    lines = []
+    for row in rows:
+        recall_key = next(key for key in row if key.startswith("recall@"))
+        params = ", ".join(f"{key}={value}" for key, value in row["params"].items()) or "-"
+        lines.append(f"{row['index_type']:<9} {params:<28} {recall_key}={row[recall_key]:.3f}  "
+                     f"p50={row['p50_ms']:.2f}ms  p99={row['p99_ms']:.2f}ms  "
+                     f"build={row['build_seconds']:.1f}s  size={row['index_bytes'] / 1e6:.1f}MB")
+    return "\n".join(lines)
+
+def as_passage(document):
+    return {"text": document} if isinstance(document, str) else document
+
+def iter_batches(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# Functions to extract text from different file types
+def extract_pages_from_pdf(pdf_path):
+    import PyPDF2
+    with open(pdf_path, 'rb') as pdf_file:
+        reader = PyPDF2.PdfReader(pdf_file)
+        return [page.extract_text() or "" for page in reader.pages]
+
+def extract_text_from_pdf(pdf_path):
+    return "".join(extract_pages_from_pdf(pdf_path))
+
+def extract_text_from_docx_file(docx_path):
+    import docx
+    doc = docx.Document(docx_path)
+    return "\n".join([para.text for para in doc.paragraphs])
+
+def iter_csv_batches(csv_path, batch_rows=CSV_BATCH_ROWS):
+    # Yield (columns, rows) batch_rows rows at a time, every value as the text in the file; empty cells stay empty
+    import pandas as pd
+    with pd.read_csv(csv_path, chunksize=batch_rows, dtype=str, keep_default_na=False) as reader:
+        for chunk in reader:
+            yield [str(column) for column in chunk.columns], chunk.values.tolist()
+
+def extract_text_from_csv_file(csv_path):
+    header, lines = None, []
+    for columns, rows in iter_csv_batches(csv_path):
+        header = ",".join(columns)
+        lines.extend(",".join(values) for values in rows)
+    return "\n".join(([header] if header is not None else []) + lines)
+
+FILE_EXTRACTORS = {
+    '.pdf': extract_text_from_pdf,
+    '.docx': extract_text_from_docx_file,
+    '.csv': extract_text_from_csv_file,
+}
+
+def extract_text_from_file(file_path):
+    return FILE_EXTRACTORS[os.path.splitext(file_path)[1].lower()](file_path)
+
+# Chunking: split extracted text into overlapping passages that keep their source and offset
+def chunk_text(text, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    # Return (chunk, character offset) pairs covering text in windows of chunk_size words
+    words = [match.span() for match in re.finditer(r'\S+', text)]
+    step = max(1, chunk_size - chunk_overlap)
+    chunks = []
+    for start in range(0, len(words), step):
+        window = words[start:start + chunk_size]
+        chunks.append((text[window[0][0]:window[-1][1]], window[0][0]))
+        if start + chunk_size >= len(words):
+            break
+    return chunks
+
+def count_word_pieces(text):
+    # Rough count of the embedding model's word pieces. Every word and punctuation mark is at least one, and long
+    # words such as numbers, dates and codes are split further, at about CHARS_PER_TOKEN characters a piece.
+    # Counting whitespace-separated words instead would treat a whole comma-separated row as one word.
+    return sum(-(-len(piece) // CHARS_PER_TOKEN) for piece in re.findall(r'\w+|[^\w\s]', text))
+
+def chunk_csv(csv_path, source, chunk_size=CHUNK_SIZE):
+    # Yield passages of whole rows, roughly chunk_size word pieces each, repeating the header in each one. The file
+    # is read in batches of CSV_BATCH_ROWS rows and a passage may span two batches.
+    header, lines, start, words = None, [], 0, 0
+    row = 0
+    for columns, rows in iter_csv_batches(csv_path):
+        if header is None:
+            header = ",".join(columns)
+            header_words = words = count_word_pieces(header)
+        for values in rows:
+            line = ",".join(values)
+            line_words = count_word_pieces(line)
+            if lines and words + line_words > chunk_size:
+                yield {"text": "\n".join([header] + lines), "source": source, "rows": [start, row]}
+                lines, start, words = [], row, header_words
+            lines.append(line)
+            words += line_words
+            row += 1
+    if lines:
+        yield {"text": "\n".join([header] + lines), "source": source, "rows": [start, row]}
+
+def csv_table_name(csv_path, taken=()):
+    # A table name for a CSV file: its file name in lower case with other characters turned into underscores
+    base = re.sub(r'\W+', '_', os.path.splitext(os.path.basename(csv_path))[0]).strip('_').lower() or "csv"
+    if base[0].isdigit():
+        base = f"t_{base}"
+    name, number = base, 2
+    while name in taken:
+        name, number = f"{base}_{number}", number + 1
+    return name
+
+def import_csv_files(csv_paths, db_path=CSV_DATABASE_PATH, batch_rows=CSV_BATCH_ROWS, progress=None):
+    # Import CSV files into tables of a SQLite database for Text-to-SQL mode, reading batch_rows rows at a time.
+    # Each file becomes the table csv_table_name() gives it, replacing a table of that name; a failed import leaves
+    # the previous table in place. Column types are inferred by pandas batch by batch.
+    # Returns {csv path: table name}. progress, if given, is called as progress(file_path, rows_imported).
+    import pandas as pd
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    tables = {}
+    try:
+        conn.execute("PRAGMA synchronous = OFF")  # A derived copy of the CSV files; an interrupted import is just redone
+        # In WAL mode an open query result (ReadOnlyDatabase) does not lock the import out, as it would with a
+        # rollback journal
+        conn.execute("PRAGMA journal_mode = WAL")
+        for csv_path in dict.fromkeys(csv_paths):
+            table = csv_table_name(csv_path, set(tables.values()))
+            staging = f"{table}__importing"
+            rows = 0
+            try:
+                with span("csv.import", file=os.path.basename(csv_path)) as import_span:
+                    with pd.read_csv(csv_path, chunksize=batch_rows) as reader:
+                        for chunk in reader:
+                            chunk.to_sql(staging, conn, if_exists="replace" if rows == 0 else "append", index=False)
+                            rows += len(chunk)
+                            if progress:
+                                progress(csv_path, rows)
+                    if rows == 0:
+                        raise ValueError(f"{os.path.basename(csv_path)} has no rows to import.")
+                    with conn:
+                        conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(table)}")
+                        conn.execute(f"ALTER TABLE {quote_identifier(staging)} RENAME TO {quote_identifier(table)}")
+                    import_span["rows"] = rows
+            except Exception:
+                conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(staging)}")
+                conn.commit()
+                raise
+            tables[csv_path] = table
+    finally:
+        conn.close()
+    return tables
+
+def chunk_file(folder_path, file_name, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    # Extract and chunk one knowledge base file. PDF chunks never span pages and CSV chunks never split rows.
+    file_path = os.path.join(folder_path, file_name)
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == '.csv':
+        return list(chunk_csv(file_path, file_name, chunk_size))
+    if extension == '.pdf':
+        sections = [(text, {"page": number}) for number, text in enumerate(extract_pages_from_pdf(file_path), start=1)]
+    else:
+        sections = [(extract_text_from_file(file_path), {})]
+    passages = []
+    for text, metadata in sections:
+        for chunk, offset in chunk_text(text, chunk_size, chunk_overlap):
+            passages.append({"text": chunk, "source": file_name, "offset": offset, **metadata})
+    return passages
+
+def format_passage(passage):
+    # Label a retrieved passage with where it came from, for the prompt and for display
+    location = [passage.get("source", "unknown")]
+    if "page" in passage:
+        location.append(f"page {passage['page']}")
+    if "rows" in passage:
+        location.append(f"rows {passage['rows'][0] + 1}-{passage['rows'][1]}")
+    return f"[{', '.join(location)}]\n{passage['text']}"
+
+# Knowledge base traversal and parallel extraction
+def iter_knowledge_base_files(folder_path):
+    # Walk the folder tree once, yielding supported files as '/'-separated paths relative to folder_path.
+    # Hidden directories, including the cache directory, are skipped.
+    for root, dirs, files in os.walk(folder_path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for file_name in sorted(files):
+            if file_name.lower().endswith(SUPPORTED_EXTENSIONS):
+                yield os.path.relpath(os.path.join(root, file_name), folder_path).replace(os.sep, '/')
+
+def chunk_file_safely(folder_path, file_name):
+    # Worker entry point: errors are returned rather than raised so one corrupt file does not abort the load
+    try:
+        return file_name, chunk_file(folder_path, file_name), None
+    except Exception as e:
+        return file_name, [], f"{type(e).__name__}: {e}"
+
+def iter_chunked_files(folder_path, file_names, max_workers=EXTRACTION_WORKERS, queue_factor=EXTRACTION_QUEUE_FACTOR):
+    # Extract and chunk files in a process pool, yielding (file_name, passages, error) as each one finishes.
+    # Only max_workers * queue_factor files are submitted at a time, so a slow consumer applies back-pressure
+    # instead of finished results piling up in memory. Pass the file names largest first so slow files do not
+    # end up at the tail of the run.
+    if max_workers <= 1 or len(file_names) <= 1:
+        for file_name in file_names:
+            yield chunk_file_safely(folder_path, file_name)
+        return
+    max_workers = min(max_workers, len(file_names))
+    remaining = iter(file_names)
+    pending = {}
+    # Spawned rather than forked: the GUI forks from a process whose other threads (Qt, the engine loop, the warm-up
+    # import of the same parsers) may hold locks the child would inherit and wait on forever
+    pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        while True:
+            for file_name in remaining:
+                pending[pool.submit(chunk_file_safely, folder_path, file_name)] = file_name
+                if len(pending) >= max_workers * queue_factor:
+                    break
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                file_name = pending.pop(future)
+                try:
+                    yield future.result()
+                except Exception as e:  # The worker process itself died, e.g. a parser crashed
+                    yield file_name, [], f"{type(e).__name__}: {e}"
+    finally:
+        # Closed early, on a cancel: drop the files still in flight instead of waiting for them, which as the
+        # largest of the run can take far longer than the file being embedded. Queued ones are cancelled and the
+        # workers still extracting are stopped.
+        workers = list((pool._processes or {}).values()) if pending else []
+        pool.shutdown(wait=False, cancel_futures=True)
+        for worker in workers:
+            worker.terminate()
+
+# Helpers for the on-disk knowledge base cache
+def write_json(path, data):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+
+def read_json(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_atomic(path, writer, suffix=""):
+    # Write to a temporary file first so an interrupted save never leaves a half-written cache behind
+    tmp_path = f"{path}.tmp{suffix}"
+    writer(tmp_path)
+    os.replace(tmp_path, path)
+
+def compute_file_hash(path, block_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def get_cache_dir(folder_path, model_name=EMBEDDING_MODEL_NAME):
+    # Cache lives next to the documents, or under the user's home directory if the folder is read-only
+    model_dir = re.sub(r'[^A-Za-z0-9_.-]', '_', model_name)
+    if os.access(folder_path, os.W_OK):
+        return os.path.join(folder_path, CACHE_DIR_NAME, model_dir)
+    folder_key = hashlib.sha256(os.path.abspath(folder_path).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(USER_CACHE_DIR, folder_key, model_dir)
+
+def build_manifest(folder_path, previous=None, model_name=EMBEDDING_MODEL_NAME):
+    # Fingerprint every supported file by path, mtime, size and content hash.
+    # Hashes from a previous manifest are reused when mtime and size are unchanged, so reopening an
+    # unchanged folder only costs a stat() per file.
+    previous_files = previous.get("files", {}) if previous and previous.get("model") == model_name else {}
+    files = {}
+    for file_name in iter_knowledge_base_files(folder_path):
+        file_path = os.path.join(folder_path, file_name)
+        stat = os.stat(file_path)
+        entry = {"mtime": stat.st_mtime_ns, "size": stat.st_size}
+        old_entry = previous_files.get(file_name)
+        if old_entry and old_entry.get("mtime") == entry["mtime"] and old_entry.get("size") == entry["size"]:
+            entry["sha256"] = old_entry["sha256"]
+        else:
+            entry["sha256"] = compute_file_hash(file_path)
+        files[file_name] = entry
+    return {
+        "model": model_name,
+        "embedding": {"backend": EMBEDDING_BACKEND, "onnx_file": EMBEDDING_ONNX_FILE if EMBEDDING_BACKEND == "onnx" else None},
+        "chunking": {"size": CHUNK_SIZE, "overlap": CHUNK_OVERLAP, "csv": "word_pieces"},
+        "index": {"type": INDEX_TYPE, **{key: INDEX_PARAMS[key] for key in INDEX_BUILD_PARAMS}},
+        "lexical": {"scheme": "bm25", "version": 2},  # 2: passage IDs are never reused and stale postings are compacted
+        "files": files,
+    }
+
+def diff_manifests(old_manifest, new_manifest):
+    # Compare two manifests and return the added, modified and deleted file names.
+    # A file whose mtime changed but whose content hash did not is not treated as modified.
+    old_files = old_manifest.get("files", {}) if old_manifest else {}
+    new_files = new_manifest["files"]
+    added = [name for name in new_files if name not in old_files]
+    deleted = [name for name in old_files if name not in new_files]
+    modified = [name for name in new_files if name in old_files and new_files[name]["sha256"] != old_files[name]["sha256"]]
+    return added, modified, deleted
+
+def read_manifest(cache_dir):
+    return read_json(os.path.join(cache_dir, "manifest.json"))
+
+def save_knowledge_base(retriever, cache_dir, manifest):
+    try:
+        retriever.save(cache_dir)
+        # The manifest is written last and marks the cache as complete
+        write_atomic(os.path.join(cache_dir, "manifest.json"), lambda path: write_json(path, manifest))
+    except (OSError, sqlite3.Error):
+        pass  # Caching is best effort, the retriever is still usable
+
+def create_passage_store(cache_dir):
+    # Start a fresh on-disk passage store for a full rebuild, or an in-memory one if the cache is not writable.
+    # The old manifest is removed first so a rebuild that is interrupted never looks like a valid cache.
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # A leftover write-ahead log would otherwise be replayed into the new store
+        passages = DocumentRetriever.PASSAGES_FILE
+        for file_name in ("manifest.json", passages) + tuple(passages + suffix for suffix in PassageStore.SIDECAR_SUFFIXES):
+            if os.path.exists(os.path.join(cache_dir, file_name)):
+                os.remove(os.path.join(cache_dir, file_name))
+        return PassageStore(os.path.join(cache_dir, DocumentRetriever.PASSAGES_FILE))
+    except (OSError, sqlite3.Error):
+        return PassageStore()
+
+def load_knowledge_base(folder_path, rebuild=False, progress=None, cancel_event=None):
+    # Return (retriever, changes) for the folder, where changes holds the added, modified, deleted, failed and
+    # pending file names. Unchanged folders are loaded straight from the on-disk cache; otherwise only the changed
+    # files are extracted and embedded and applied to the cached index. Pass rebuild=True to ignore the cache.
+    # Files that fail to extract are recorded in the manifest with their error and are only retried once they
+    # change (or with rebuild=True); they are listed under "failed" on every load.
+    #
+    # progress, if given, is called as progress(files_done, files_total, passages_embedded, eta_seconds).
+    # Setting cancel_event stops after the file currently being embedded, or part way through a CSV file; the work
+    # done so far is saved and the remaining files are reported as pending, so loading the folder again resumes
+    # where it stopped.
+    with traced("index", rebuild=rebuild) as trace:
+        retriever, changes = update_knowledge_base(folder_path, rebuild, progress, cancel_event)
+        if trace is not None:
+            trace.attributes.update({change: len(files) for change, files in changes.items()})
+            trace.attributes["passages"] = len(retriever) if retriever is not None else 0
+    return retriever, changes
+
+def update_knowledge_base(folder_path, rebuild, progress, cancel_event):
+    # The work of load_knowledge_base(), which runs it under an "index" trace
+    cache_dir = get_cache_dir(folder_path)
+    cached_manifest = None if rebuild else read_manifest(cache_dir)
+    with span("manifest"):
+        manifest = build_manifest(folder_path, cached_manifest)
+    added, modified, deleted = diff_manifests(cached_manifest, manifest)
+    changes = {"added": added, "modified": modified, "deleted": deleted, "failed": [], "pending": []}
+
+    retriever = None
+    settings = ("model", "embedding", "chunking", "index", "lexical")
+    if cached_manifest is not None and all(cached_manifest.get(key) == manifest[key] for key in settings):
+        try:
+            retriever = DocumentRetriever.load(cache_dir, mmap=not (added or modified or deleted))
+        except (OSError, ValueError, RuntimeError, sqlite3.Error):
+            retriever = None  # Corrupt or partial cache, rebuild below
+    if retriever is None:
+        cached_manifest = None
+        added, modified, deleted = list(manifest["files"]), [], []
+        changes = {"added": added, "modified": [], "deleted": [], "failed": [], "pending": []}
+
+    # Carry document IDs, and extraction errors, over for unchanged files
+    old_files = cached_manifest["files"] if cached_manifest else {}
+    to_extract = set(added) | set(modified)
+    for file_name, entry in manifest["files"].items():
+        if file_name not in to_extract:
+            entry["ids"] = old_files[file_name]["ids"]
+            if "error" in old_files[file_name]:
+                entry["error"] = old_files[file_name]["error"]
+                changes["failed"].append(file_name)
+
+    if not (added or modified or deleted):
+        return (retriever if retriever is not None and len(retriever) else None), changes
+
+    if retriever is None:
+        retriever = DocumentRetriever(store=create_passage_store(cache_dir))
+    else:
+        stale_ids = [doc_id for name in modified + deleted for doc_id in old_files[name]["ids"]]
+        retriever.remove_documents(stale_ids)
+
+    # Stream passages from the extraction pool straight into batched embedding, recording how many
+    # passages each file produced so their IDs can be written to the manifest. CSV files are chunked here instead
+    # of in the pool, whose workers return a whole file's passages at once, so they reach embedding batch by batch.
+    to_extract = sorted(to_extract, key=lambda name: manifest["files"][name]["size"], reverse=True)
+    csv_files = [name for name in to_extract if name.lower().endswith('.csv')]
+    file_counts = []  # (file name, passages yielded, whether they are kept)
+    state = {"files_done": 0, "bytes_done": 0, "embedded": 0}
+    bytes_total = sum(manifest["files"][name]["size"] for name in to_extract) or 1
+    started = time.monotonic()
+
+    def report():
+        if progress:
+            elapsed = time.monotonic() - started
+            eta = elapsed * (bytes_total - state["bytes_done"]) / state["bytes_done"] if state["bytes_done"] else None
+            progress(state["files_done"], len(to_extract), state["embedded"], eta)
+
+    def on_batch(embedded):
+        state["embedded"] = embedded
+        report()
+
+    def iter_passages():
+        chunked_files = iter_chunked_files(folder_path, [name for name in to_extract if not name.lower().endswith('.csv')])
+        waited = time.perf_counter()
+        for file_name, chunks, error in chunked_files:
+            # Extraction overlaps with embedding, so this is only the time spent waiting on the extraction workers
+            record_span("extract", waited, (time.perf_counter() - waited) * 1000, bool(error), file=file_name, passages=len(chunks))
+            state["files_done"] += 1
+            state["bytes_done"] += manifest["files"][file_name]["size"]
+            if error:
+                changes["failed"].append(file_name)
+                manifest["files"][file_name].update(ids=[], error=error)
+            else:
+                file_counts.append((file_name, len(chunks), True))
+                yield from chunks
+            report()
+            if cancel_event is not None and cancel_event.is_set():
+                chunked_files.close()
+                return
+            waited = time.perf_counter()
+        for file_name in csv_files:
+            # A file that fails or is cancelled part way has already had passages embedded; they are removed below
+            started_file, extract_ms = time.perf_counter(), 0.0
+            passages = chunk_csv(os.path.join(folder_path, file_name), file_name)
+            count, error, cancelled = 0, None, False
+            while True:
+                waited = time.perf_counter()
+                try:
+                    passage = next(passages, None)
+                except Exception as e:
+                    passage, error = None, f"{type(e).__name__}: {e}"
+                extract_ms += (time.perf_counter() - waited) * 1000
+                if passage is None:
+                    break
+                count += 1
+                yield passage
+                if cancel_event is not None and cancel_event.is_set():
+                    passages.close()
+                    cancelled = True
+                    break
+            record_span("extract", started_file, extract_ms, bool(error), file=file_name, passages=count)
+            file_counts.append((file_name, count, not (error or cancelled)))
+            if cancelled:
+                return
+            state["files_done"] += 1
+            state["bytes_done"] += manifest["files"][file_name]["size"]
+            if error:
+                changes["failed"].append(file_name)
+                manifest["files"][file_name].update(ids=[], error=error)
+            report()
+
+    report()
+    new_ids = retriever.add_documents(iter_passages(), on_batch=on_batch)
+
+    # Files that were never reached after a cancel stay out of the manifest, so the next load picks them up
+    finished = {file_name for file_name, _, kept in file_counts if kept} | set(changes["failed"])
+    for file_name in to_extract:
+        if file_name not in finished:
+            changes["pending"].append(file_name)
+            del manifest["files"][file_name]
+
+    position, discarded = 0, []
+    for file_name, count, kept in file_counts:
+        if kept:
+            manifest["files"][file_name]["ids"] = new_ids[position:position + count]
+        else:
+            discarded.extend(new_ids[position:position + count])
+        position += count
+    retriever.remove_documents(discarded)
+
+    with span("save"):
+        save_knowledge_base(retriever, cache_dir, manifest)
+    return (retriever if len(retriever) else None), changes
+
+# LLM calls and the persistent response cache
+class ResponseCache:
+    # SQLite-backed cache of chat completions. Entries are keyed on a hash of the model, sampling parameters and
+    # full prompt. Questions are also stored with their embedding under a hash of everything except the
+    # question, so near-duplicate questions asked against the same context can be matched by similarity.
+    # Callers pass similar=False to skip that matching, so the question is never embedded, as Text-to-SQL does.
+    # Entries expire after ttl seconds and the least recently used are evicted beyond max_entries.
+    def __init__(self, path=RESPONSE_CACHE_PATH, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_MAX_ENTRIES, similarity=RESPONSE_CACHE_SIMILARITY):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, context_hash TEXT NOT NULL, "
+                          "embedding BLOB, response TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_context ON responses (context_hash)")
+        self.conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+        self.conn.commit()
+
+    @staticmethod
+    def keys(model, messages, params):
+        # (exact key, context hash); the context hash leaves out the final user question
+        def digest(payload):
+            return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+        return digest([model, params, messages]), digest([model, params, messages[:-1]])
+
+    @staticmethod
+    def embed(question):
+        return get_embedding_backend().encode([question], normalize=True)[0]
+
+    def get(self, model, messages, params, similar=True):
+        key, context_hash = self.keys(model, messages, params)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT key, response FROM responses WHERE key = ? AND created >= ?", (key, now - self.ttl)).fetchone()
+        semantic = False
+        if row is None and similar and self.similarity is not None:
+            with self.lock:
+                candidates = self.conn.execute("SELECT key, response, embedding FROM responses WHERE context_hash = ? AND created >= ? AND embedding IS NOT NULL",
+                                               (context_hash, now - self.ttl)).fetchall()
+            if candidates:
+                stored = np.vstack([np.frombuffer(embedding, dtype='float32') for _, _, embedding in candidates])
+                scores = stored @ self.embed(messages[-1]["content"])
+                best = int(np.argmax(scores))
+                if scores[best] >= self.similarity:
+                    row = candidates[best][:2]
+                    semantic = True
+        with self.lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.semantic_hits += semantic
+            self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, row[0]))
+            self.conn.commit()
+        return row[1]
+
+    def put(self, model, messages, params, response, similar=True):
+        key, context_hash = self.keys(model, messages, params)
+        embedding = self.embed(messages[-1]["content"]).tobytes() if similar and self.similarity is not None else None
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO responses (key, context_hash, embedding, response, created, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                              (key, context_hash, embedding, response, now, now))
+            self.conn.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                              (self.max_entries,))
+            self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            size = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {"size": size, "hits": self.hits, "semantic_hits": self.semantic_hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+def get_response_cache():
+    # The shared response cache, opened on first use; None when caching is disabled or the cache cannot be opened
+    global _response_cache
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    with _response_cache_lock:
+        if _response_cache is None:
+            try:
+                _response_cache = ResponseCache()
+            except (OSError, sqlite3.Error):
+                return None
+    return _response_cache
+
+# Prompts
+SEMANTIC_SYSTEM_PROMPT = "You are a helpful assistant that provides answers based on the retrieved context."
+TEXT2SQL_SYSTEM_PROMPT = "You are an assistant that helps convert natural language queries into SQL based on the provided database schema. When appropriate, output the SQL query in a code block labeled as sql. Do not include any explanations in the code block. If the user asks a general question or something not related to SQL, you can answer normally."
+SEMANTIC_MAX_TOKENS = 300
+TEXT2SQL_MAX_TOKENS = 500
+
+def build_semantic_messages(question, passages):
+    context = "\n\n".join(format_passage(passage) for passage in passages)
+    return [
+        {"role": "system", "content": SEMANTIC_SYSTEM_PROMPT},
+        {"role": "system", "content": f"Context: {context}"},
+        {"role": "user", "content": question}
+    ]
+
+def build_text2sql_messages(question, schema_description):
+    return [
+        {"role": "system", "content": TEXT2SQL_SYSTEM_PROMPT},
+        {"role": "system", "content": f"Database Schema:\n{schema_description or ''}"},
+        {"role": "user", "content": question}
+    ]
+
+def extract_sql(assistant_response):
+    # Return the first ```sql code block in a reply, or None
+    code_blocks = re.findall(r'```sql\s*(.*?)```', assistant_response, re.DOTALL | re.IGNORECASE)
+    return code_blocks[0].strip() if code_blocks else None
+
+# Database schema
+def connect_read_only(db_path):
+    # Open an existing SQLite file without any chance of writing to it (or creating it)
+    return sqlite3.connect(f"{pathlib.Path(os.path.abspath(db_path)).as_uri()}?mode=ro", uri=True, check_same_thread=False)
+
+def database_fingerprint(db_path):
+    # mtime and size of the database and of its write-ahead log, which changes while the main file may not
+    fingerprint = []
+    for path in (db_path, db_path + "-wal"):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            fingerprint += [stat.st_mtime_ns, stat.st_size]
+    return fingerprint
+
+def quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def identifier_words(name):
+    # "orderItems" and "order_items" both give ["order", "items"]
+    return re.sub(r'([a-z0-9])([A-Z])', r'\1 \2', name).replace('_', ' ').lower().split()
+
+def schema_keywords(text):
+    # Words used to match questions to table and column names, with a trailing plural "s" dropped
+    return {word[:-1] if len(word) > 3 and word.endswith('s') else word for word in identifier_words(" ".join(re.findall(r'\w+', text)))}
+
+def format_table(table):
+    lines = [f"Table: {table['name']}"]
+    references = {fk["column"]: f"{fk['table']}.{fk['to']}" for fk in table["foreign_keys"]}
+    for column in table["columns"]:
+        line = f" - {column['name']} ({column['type']}{', primary key' if column['pk'] else ''})"
+        if column["name"] in references:
+            line += f" -> {references[column['name']]}"
+        samples = table["samples"].get(column["name"])
+        if samples:
+            line += " e.g. " + ", ".join(repr(value) for value in samples)
+        lines.append(line)
+    return "\n".join(lines) + "\n"
+
+def table_document(table):
+    # Text embedded for a table: its name, column names, referenced tables and sample values in plain words
+    words = " ".join(identifier_words(table["name"]))
+    columns = ", ".join(" ".join(identifier_words(column["name"])) for column in table["columns"])
+    text = f"{words}: {columns}"
+    if table["foreign_keys"]:
+        text += ". Related to " + ", ".join(sorted({" ".join(identifier_words(fk["table"])) for fk in table["foreign_keys"]}))
+    samples = [value for values in table["samples"].values() for value in values]
+    if samples:
+        text += ". Values such as " + ", ".join(samples)
+    return text
+
+_schema_cache = {}
+_schema_cache_lock = threading.Lock()
+
+class DatabaseSchema:
+    # Tables, columns, foreign keys and sample values of a SQLite database. Tables are dicts holding "name",
+    # "columns" ({"name", "type", "pk"}), "foreign_keys" ({"column", "table", "to"}) and "samples" (column -> values).
+    # For databases with more than SCHEMA_TOP_TABLES tables, describe() picks the tables most relevant to a question
+    # by fusing an embedding ranking of the tables with keyword matches on table and column names.
+    def __init__(self, tables, fingerprint=None, cache_path=None):
+        self.tables = tables
+        self.fingerprint = fingerprint
+        self.cache_path = cache_path  # Path prefix for the cached table embeddings, None to keep them in memory only
+        self.positions = {table["name"]: position for position, table in enumerate(tables)}
+        self.keywords = [schema_keywords(" ".join([table["name"]] + [column["name"] for column in table["columns"]])) for table in tables]
+        self.embeddings = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.tables)
+
+    @classmethod
+    def load(cls, db_path):
+        # Return the schema of db_path. It is introspected only when the file has changed since it was last seen,
+        # by this process or, through the cache under SCHEMA_CACHE_DIR, by an earlier one.
+        db_path = os.path.abspath(db_path)
+        fingerprint = database_fingerprint(db_path)
+        if not fingerprint:
+            raise FileNotFoundError(db_path)
+        with _schema_cache_lock:
+            schema = _schema_cache.get(db_path)
+        if schema is not None and schema.fingerprint == fingerprint:
+            return schema
+        cache_path = os.path.join(SCHEMA_CACHE_DIR, hashlib.sha256(db_path.encode('utf-8')).hexdigest()[:16])
+        cached = read_json(cache_path + ".json")
+        if cached and cached.get("version") == SCHEMA_CACHE_VERSION and cached.get("path") == db_path and cached.get("fingerprint") == fingerprint:
+            tables = cached["tables"]
+        else:
+            tables = cls.introspect(db_path)
+            try:
+                os.makedirs(SCHEMA_CACHE_DIR, exist_ok=True)
+                write_atomic(cache_path + ".json", lambda path: write_json(path, {"version": SCHEMA_CACHE_VERSION, "path": db_path, "fingerprint": fingerprint, "tables": tables}))
+            except OSError:
+                cache_path = None  # Caching is best effort
+        schema = cls(tables, fingerprint, cache_path)
+        with _schema_cache_lock:
+            _schema_cache[db_path] = schema
+        return schema
+
+    @staticmethod
+    def introspect(db_path):
+        # Read the whole schema with one query for columns and one for foreign keys, plus a few rows per table
+        conn = connect_read_only(db_path)
+        try:
+            tables = {}
+            for table_name, column, column_type, pk in conn.execute(
+                    "SELECT m.name, p.name, p.type, p.pk FROM sqlite_master m JOIN pragma_table_info(m.name) p "
+                    "WHERE m.type = 'table' AND m.name NOT LIKE 'sqlite_%' ORDER BY m.name, p.cid"):
+                table = tables.setdefault(table_name, {"name": table_name, "columns": [], "foreign_keys": [], "samples": {}})
+                table["columns"].append({"name": column, "type": column_type, "pk": bool(pk)})
+            for table_name, column, target, target_column in conn.execute(
+                    "SELECT m.name, f.\"from\", f.\"table\", f.\"to\" FROM sqlite_master m JOIN pragma_foreign_key_list(m.name) f "
+                    "WHERE m.type = 'table' AND m.name NOT LIKE 'sqlite_%'"):
+                if target_column is None:  # References the target's primary key
+                    target_column = next((c["name"] for c in tables.get(target, {}).get("columns", []) if c["pk"]), "rowid")
+                tables[table_name]["foreign_keys"].append({"column": column, "table": target, "to": target_column})
+            for table in tables.values():
+                try:
+                    cursor = conn.execute(f"SELECT * FROM {quote_identifier(table['name'])} LIMIT ?", (SCHEMA_SAMPLE_ROWS,))
+                    rows = cursor.fetchall()
+                except sqlite3.Error:
+                    continue  # e.g. a virtual table whose module is not available
+                for position, description in enumerate(cursor.description):
+                    values = [row[position] for row in rows if isinstance(row[position], str) and row[position].strip()]
+                    values = list(dict.fromkeys(value[:SCHEMA_SAMPLE_LENGTH] for value in values))[:SCHEMA_SAMPLE_VALUES]
+                    if values:
+                        table["samples"][description[0]] = values
+            return list(tables.values())
+        finally:
+            conn.close()
+
+    def describe(self, question=None, top_n=SCHEMA_TOP_TABLES):
+        # Schema text for the Text-to-SQL prompt: every table, or only those relevant to the question
+        if question is None or len(self.tables) <= top_n:
+            return "".join(format_table(table) for table in self.tables)
+        tables = self.select_tables(question, top_n)
+        return "".join(format_table(table) for table in tables) + f"({len(tables)} of {len(self.tables)} tables shown, chosen for relevance to the question)\n"
+
+    def select_tables(self, question, top_n=SCHEMA_TOP_TABLES):
+        # Rank tables by embedding similarity and by keyword overlap, fuse the rankings, then add the tables the
+        # chosen ones reference so that the joins between them can be written
+        scores = self.table_embeddings() @ get_embedding_backend().encode([question], normalize=True)[0]
+        dense = np.argsort(-scores).tolist()
+        keywords = schema_keywords(question)
+        overlaps = [len(keywords & table_keywords) for table_keywords in self.keywords]
+        lexical = sorted((position for position, overlap in enumerate(overlaps) if overlap), key=lambda position: -overlaps[position])
+        chosen = reciprocal_rank_fusion([dense, lexical])[:top_n]
+        for position in list(chosen):
+            for fk in self.tables[position]["foreign_keys"]:
+                target = self.positions.get(fk["table"])
+                if target is not None and target not in chosen and len(chosen) < SCHEMA_MAX_TABLES:
+                    chosen.append(target)
+        return [self.tables[position] for position in chosen]
+
+    def table_embeddings(self):
+        # One normalised embedding per table, computed on first use and cached next to the schema
+        with self.lock:
+            if self.embeddings is not None:
+                return self.embeddings
+            path = None
+            if self.cache_path and self.fingerprint:
+                key = hashlib.sha256(json.dumps([self.fingerprint, EMBEDDING_MODEL_NAME, EMBEDDING_BACKEND]).encode('utf-8')).hexdigest()[:16]
+                path = f"{self.cache_path}-{key}.npy"
+                try:
+                    embeddings = np.load(path)
+                    if len(embeddings) == len(self.tables):
+                        self.embeddings = embeddings
+                        return embeddings
+                except (OSError, ValueError):
+                    pass
+            backend = get_embedding_backend()
+            documents = [table_document(table) for table in self.tables]
+            self.embeddings = np.vstack([backend.encode(batch, normalize=True) for batch in iter_batches(documents, EMBED_BATCH_SIZE)])
+            if path:
+                try:
+                    def writer(tmp_path):
+                        with open(tmp_path, 'wb') as f:
+                            np.save(f, self.embeddings)
+                    write_atomic(path, writer)
+                    for old_path in glob.glob(glob.escape(self.cache_path) + "-*.npy"):
+                        if old_path != path:
+                            os.remove(old_path)  # Embeddings of an earlier version of the database
+                except OSError:
+                    pass
+            return self.embeddings
+
+# SQL execution
+def limit_query(sql, max_rows):
+    # Add a LIMIT to a single SELECT that has none, so SQLite can stop early (or use a top-N sort) instead of
+    # producing every row. The LIMIT goes on its own line in case the statement ends with a comment.
+    statement = re.sub(r'(\s*--[^\n]*)+\s*$', '', sql.strip()).strip().rstrip(';').strip()
+    if not re.match(r'(SELECT|WITH|VALUES)\b', statement, re.IGNORECASE):
+        return statement
+    # Only a number or a parameter counts, so the LIMIT of a subquery the statement ends with ("... LIMIT 5)") does not
+    value = r'(-?\d+|\?\d*|[:@$]\w+)'
+    if re.search(rf'\bLIMIT\s+{value}(\s*(,|\bOFFSET\b)\s*{value})?$', statement, re.IGNORECASE):
+        return statement
+    return f"{statement}\nLIMIT {max_rows + 1}"
+
+def full_scan_warnings(plan_details):
+    # Warnings for EXPLAIN QUERY PLAN steps that read a whole table without an index
+    warnings = []
+    for detail in plan_details:
+        match = re.match(r'SCAN (?:TABLE )?(\S+)(?: AS \S+)?$', detail)
+        if match and match.group(1) not in ("CONSTANT",) and not match.group(1).startswith("("):
+            warnings.append(f"Full scan of table {match.group(1)}; this can be slow on a large table.")
+    return warnings
+
+class ReadOnlyDatabase:
+    # One read-only connection to a SQLite file, reused for every query against it. Statements are interrupted
+    # through SQLite's progress handler once they run past the timeout or cancel() is called, and only one result
+    # is kept open at a time so an abandoned cursor never holds a read lock for long.
+    def __init__(self, db_path, timeout=SQL_TIMEOUT, page_size=SQL_PAGE_SIZE, max_rows=SQL_MAX_ROWS):
+        self.db_path = db_path
+        self.timeout = timeout
+        self.page_size = page_size
+        self.max_rows = max_rows
+        self.lock = threading.RLock()
+        self.deadline = None
+        self.cancelled = False
+        self.active = None
+        self.conn = connect_read_only(db_path)
+        self.conn.execute("PRAGMA query_only = ON")
+        self.conn.set_progress_handler(self.should_interrupt, SQL_PROGRESS_STEPS)
+
+    def should_interrupt(self):
+        return self.cancelled or (self.deadline is not None and time.monotonic() > self.deadline)
+
+    def cancel(self):
+        # Interrupt whatever statement is running, and the rest of the execute() or page() call it belongs to; may be
+        # called from any thread
+        self.cancelled = True
+
+    def begin(self):
+        # Called under the lock at the start of execute() and page(), not in run(), so a cancel() that lands between
+        # two statements of the same call still stops the second
+        self.cancelled = False
+
+    def run(self, operation):
+        # Run operation() on the connection under the timeout
+        with self.lock:
+            self.deadline = time.monotonic() + self.timeout
+            try:
+                return operation()
+            except sqlite3.OperationalError as e:
+                if "interrupt" not in str(e):
+                    raise
+                if self.cancelled:
+                    raise InterruptedError("Query cancelled.") from e
+                raise TimeoutError(f"Query stopped after {self.timeout:g} seconds.") from e
+            finally:
+                self.deadline = None
+
+    def explain(self, sql):
+        # Warnings from the query plan, without running the query; an unplannable query is left to fail on execute
+        try:
+            with span("sql.explain"):
+                plan = self.run(lambda: self.conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall())
+        except (sqlite3.Error, TimeoutError, InterruptedError):
+            return []
+        return full_scan_warnings([row[-1] for row in plan])
+
+    def execute(self, sql):
+        # Start a query and fetch its first page; the result replaces (and closes) the previous one
+        sql = limit_query(sql, self.max_rows)
+        with self.lock, span("sql.execute") as sql_span:
+            self.begin()
+            if self.active is not None:
+                self.active.close()
+            warnings = self.explain(sql)
+            cursor = self.run(lambda: self.conn.execute(sql))
+            self.active = QueryResult(self, cursor, sql, warnings)
+            sql_span["rows"] = len(self.active.read(0))
+            return self.active
+
+    def close(self):
+        with self.lock:
+            if self.active is not None:
+                self.active.close()
+            self.conn.close()
+
+class QueryResult:
+    # Rows of a query, read from the open cursor one page at a time as pages are asked for. Pages already read are
+    # kept so they can be shown again; reading stops at the database's max_rows.
+    def __init__(self, database, cursor, sql, warnings=()):
+        self.database = database
+        self.cursor = cursor
+        self.sql = sql
+        self.warnings = list(warnings)
+        self.columns = [description[0] for description in cursor.description] if cursor.description else []
+        self.pages = []
+        self.exhausted = cursor.description is None  # Statements that return no rows
+        self.truncated = False  # More rows exist than max_rows
+        self.closed = False
+
+    @property
+    def row_count(self):
+        # Rows read so far; the total once exhausted is True
+        return sum(len(page) for page in self.pages)
+
+    def has_page(self, number):
+        return number < len(self.pages) or (not self.exhausted and not self.closed and number == len(self.pages))
+
+    def page(self, number):
+        # Rows of page number (0-based), reading from the cursor if it has not been read yet
+        if number < len(self.pages):
+            return self.pages[number]  # Without taking the lock, which a running query may hold
+        with self.database.lock:
+            self.database.begin()
+            return self.read(number)
+
+    def read(self, number):
+        # page() without resetting a cancel; the caller holds the database lock
+        while len(self.pages) <= number and not self.exhausted:
+            if self.closed:
+                raise ValueError("This result was replaced by a newer query; run it again to see more rows.")
+            size = min(self.database.page_size, self.database.max_rows - self.row_count)
+            with span("sql.fetch", page=len(self.pages)) as fetch_span:
+                rows = self.database.run(lambda: self.cursor.fetchmany(size))
+                fetch_span["rows"] = len(rows)
+            if rows:
+                self.pages.append(rows)
+            if len(rows) < size:
+                self.exhausted = True
+            elif self.row_count >= self.database.max_rows:
+                self.truncated = self.database.run(self.cursor.fetchone) is not None
+                self.exhausted = True
+        if self.exhausted:
+            self.close()
+        return self.pages[number] if number < len(self.pages) else []
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.cursor.close()
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+def get_read_only_database(db_path):
+    # The shared read-only connection for db_path, opened on first use
+    db_path = os.path.abspath(db_path)
+    with _databases_lock:
+        database = _databases.get(db_path)
+        if database is None:
+            database = _databases[db_path] = ReadOnlyDatabase(db_path)
+        return database
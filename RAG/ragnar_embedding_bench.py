@@ -0,0 +1,117 @@
+# RAGnar embedding benchmark: passages per second and retrieval recall for each embedding backend and vector precision.
+#
+#   python ragnar_embedding_bench.py /path/to/docs
+#   python ragnar_embedding_bench.py /path/to/docs --backends torch torch_int8 onnx --workers 1 4 --sample 5000 --json
+#
+# Passages are taken from the folder exactly as they would be indexed and held-out passages serve as queries.
+# Recall@k is measured against exact search over fp32 "torch" embeddings, so the reference row reads 1.000.
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from ragnar_core import (
+    EMBED_BATCH_SIZE, EMBEDDING_BACKENDS, VECTOR_CODECS, MultiProcessEncoder, get_embedding_backend, build_faiss_index,
+    iter_batches, iter_knowledge_base_files, iter_chunked_files
+)
+
+REFERENCE_BACKEND = "torch"
+
+def sample_passages(folder_path, sample_size):
+    texts = []
+    chunked_files = iter_chunked_files(folder_path, list(iter_knowledge_base_files(folder_path)))
+    for _, chunks, _ in chunked_files:
+        texts.extend(chunk["text"] for chunk in chunks)
+        if len(texts) >= sample_size:
+            chunked_files.close()
+            break
+    return texts[:sample_size]
+
+def encode_timed(encoder, texts):
+    # Return (vectors, passages per second); one small call first so lazy initialisation is not counted
+    encoder.encode(texts[:8])
+    started = time.perf_counter()
+    vectors = np.vstack([encoder.encode(batch) for batch in iter_batches(texts, EMBED_BATCH_SIZE)])
+    return vectors, len(texts) / (time.perf_counter() - started)
+
+def search_exact(vectors, queries, k, storage="float32"):
+    # Top-k IDs per query from a flat index storing vectors at the given precision, plus the index size in bytes
+    import faiss
+    index = build_faiss_index("flat", vectors.shape[1], vectors, {"storage": storage})
+    index.add_with_ids(vectors, np.arange(len(vectors), dtype='int64'))
+    _, found = index.search(queries, k)
+    return found, int(faiss.serialize_index(index).size)
+
+def recall_at_k(found, truth):
+    hits = sum(len(set(row.tolist()) & set(expected.tolist()) - {-1}) for row, expected in zip(found, truth))
+    return hits / truth.size
+
+def embedding_backend_report(folder_path, backends=tuple(EMBEDDING_BACKENDS), workers=(1,), sample_size=2000, num_queries=100, k=10):
+    texts = sample_passages(folder_path, sample_size + num_queries)
+    if len(texts) < 2:
+        return []
+    num_queries = min(num_queries, max(1, len(texts) // 10))
+    corpus, queries = texts[num_queries:], texts[:num_queries]
+    k = min(k, len(corpus))
+
+    reference = get_embedding_backend(REFERENCE_BACKEND)
+    reference_vectors, _ = encode_timed(reference, corpus)
+    truth, _ = search_exact(reference_vectors, reference.encode(queries), k)
+
+    rows = []
+    for name in backends:
+        for num_workers in workers:
+            row = {"backend": name, "workers": num_workers, "storage": "float32"}
+            try:
+                started = time.perf_counter()
+                backend = get_embedding_backend(name)
+                row["load_seconds"] = time.perf_counter() - started
+                encoder = MultiProcessEncoder(name, num_workers) if num_workers > 1 else backend
+                try:
+                    vectors, row["docs_per_sec"] = encode_timed(encoder, corpus)
+                finally:
+                    if num_workers > 1:
+                        encoder.close()
+                found, row["index_bytes"] = search_exact(vectors, backend.encode(queries), k)
+                row[f"recall@{k}"] = recall_at_k(found, truth)
+            except Exception as e:  # A backend whose optional dependencies are missing should not stop the report
+                row["error"] = f"{type(e).__name__}: {e}"
+            rows.append(row)
+
+    # Stored precision only affects search, so it is measured on the reference embeddings
+    query_vectors = reference.encode(queries)
+    for storage in VECTOR_CODECS:
+        if storage == "float32":
+            continue
+        found, index_bytes = search_exact(reference_vectors, query_vectors, k, storage)
+        rows.append({"backend": REFERENCE_BACKEND, "workers": 1, "storage": storage, "index_bytes": index_bytes, f"recall@{k}": recall_at_k(found, truth)})
+    return rows
+
+def format_embedding_report(rows):
+    lines = [f"{'backend':<12}{'workers':>8}  {'storage':<9}{'docs/sec':>10}{'recall':>8}{'index MB':>10}"]
+    for row in rows:
+        if "error" in row:
+            lines.append(f"{row['backend']:<12}{row['workers']:>8}  {row['storage']:<9}  {row['error']}")
+            continue
+        recall = next(value for key, value in row.items() if key.startswith("recall@"))
+        docs_per_sec = f"{row['docs_per_sec']:.0f}" if "docs_per_sec" in row else "-"
+        lines.append(f"{row['backend']:<12}{row['workers']:>8}  {row['storage']:<9}{docs_per_sec:>10}{recall:>8.3f}{row['index_bytes'] / 1e6:>10.1f}")
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare RAGnar embedding backends and vector precisions on a knowledge base.")
+    parser.add_argument("folder", help="Knowledge base folder to sample passages from")
+    parser.add_argument("--backends", nargs="+", default=list(EMBEDDING_BACKENDS), choices=list(EMBEDDING_BACKENDS))
+    parser.add_argument("--workers", nargs="+", type=int, default=[1], help="Encoding process counts to try")
+    parser.add_argument("--sample", type=int, default=2000, help="Passages to encode")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args(argv)
+    rows = embedding_backend_report(args.folder, args.backends, args.workers, args.sample, args.queries, args.k)
+    print(json.dumps(rows, indent=2) if args.json else format_embedding_report(rows))
+
+if __name__ == "__main__":
+    main()
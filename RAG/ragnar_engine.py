@@ -0,0 +1,220 @@
+# RAGnar query engine: semantic and Text-to-SQL queries on asyncio, independent of any GUI.
+# Retrieval runs in worker threads through a QueryBatcher, LLM calls are bounded by a semaphore, and identical
+# questions that arrive while one is already being answered share that answer instead of calling the LLM again.
+
+import asyncio
+import re
+import time
+import threading
+from collections import Counter
+
+import openai
+
+from ragnar_core import (
+    MODEL, SEMANTIC_MAX_TOKENS, TEXT2SQL_MAX_TOKENS, QueryBatcher, get_response_cache, get_reranker, retrieve_context,
+    normalize_query, build_semantic_messages, build_text2sql_messages, extract_sql, estimate_tokens, span, add_counts,
+    traced, trace_context
+)
+
+LLM_CONCURRENCY = 8  # Maximum LLM calls in flight per engine
+MODES = ("semantic", "text2sql")
+
+# LLM clients
+class OpenAIChatClient:
+    def __init__(self, model=MODEL):
+        self.model = model
+
+    async def complete(self, messages, max_tokens, temperature=0.7, on_token=None):
+        # Return the reply; with on_token set the completion is streamed and each piece is passed to on_token
+        if on_token:
+            pieces = []
+            stream = await openai.ChatCompletion.acreate(model=self.model, messages=messages, max_tokens=max_tokens, temperature=temperature, stream=True)
+            async for chunk in stream:
+                piece = chunk["choices"][0]["delta"].get("content") if chunk["choices"] else None
+                if piece:
+                    pieces.append(piece)
+                    on_token(piece)
+            return "".join(pieces).strip()
+        response = await openai.ChatCompletion.acreate(
+            model=self.model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature
+        )
+        return response.choices[0].message.content.strip()
+
+class FakeChatClient:
+    # Offline stand-in for the OpenAI API. Replies are deterministic and built from the prompt: Text-to-SQL
+    # prompts get a query against the first table in the schema, semantic prompts list the retrieved sources.
+    # latency and token_delay (seconds) simulate a slow model.
+    model = "fake"
+
+    def __init__(self, latency=0.0, token_delay=0.0):
+        self.latency = latency
+        self.token_delay = token_delay
+        self.calls = 0
+
+    async def complete(self, messages, max_tokens, temperature=0.7, on_token=None):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        answer = fake_answer(messages)
+        if on_token:
+            for piece in re.findall(r'\S+\s*', answer):
+                on_token(piece)
+                await asyncio.sleep(self.token_delay)
+        return answer
+
+def fake_answer(messages):
+    question = messages[-1]["content"]
+    context = "\n".join(message["content"] for message in messages[:-1])
+    tables = re.findall(r'^Table: (\S+)', context, re.MULTILINE)
+    if tables:
+        return f"Here is a query for: {question}\n\n```sql\nSELECT * FROM {tables[0]} LIMIT 10;\n```"
+    sources = re.findall(r'^\[([^\]]+)\]', context, re.MULTILINE)
+    answer = f"Fake answer to: {question}"
+    if sources:
+        answer += "\n\nSources: " + "; ".join(sources)
+    return answer
+
+# Engine
+class QueryEngine:
+    def __init__(self, llm=None, retriever=None, database=None, max_concurrency=LLM_CONCURRENCY, response_cache=True, reranker=True):
+        # database is a DatabaseSchema; each Text-to-SQL prompt gets only the tables relevant to its question.
+        # reranker=True uses the shared cross-encoder when RERANK_ENABLED is set; pass a reranker or None to override.
+        self.llm = llm if llm is not None else OpenAIChatClient()
+        self.reranker = get_reranker() if reranker is True else reranker or None
+        self.batcher = None
+        self.retriever = retriever
+        self.database = database
+        self.response_cache = get_response_cache() if response_cache is True else response_cache or None
+        self.max_concurrency = max_concurrency
+        self.semaphore = None  # Created on first use, inside the engine's event loop
+        self.inflight = {}
+        self.counters = Counter()
+
+    @property
+    def retriever(self):
+        return self.batcher.retriever if self.batcher else None
+
+    @retriever.setter
+    def retriever(self, retriever):
+        self.batcher = QueryBatcher(retriever) if retriever is not None else None
+
+    async def query(self, mode, question, on_token=None, trace=None):
+        # Answer a question in "semantic" or "text2sql" mode (a leading "!" as used by the GUI is accepted).
+        # Returns a dict with the answer plus the retrieved passages or the extracted SQL.
+        # The query is traced; pass trace to record into a trace the caller finishes itself, as the GUI does so
+        # that rendering and SQL execution are part of it.
+        mode = mode.lstrip('!')
+        if mode not in MODES:
+            raise ValueError("Invalid mode selected.")
+        self.counters["queries"] += 1
+        if trace is None:
+            with traced("query", mode=mode, question_chars=len(question)):
+                return await self.shared_query(mode, question, on_token)
+        with trace_context(trace):
+            return await self.shared_query(mode, question, on_token)
+
+    async def shared_query(self, mode, question, on_token=None):
+        # Coalesce on everything that determines the prompt: the same question against the same knowledge base or schema
+        key = (mode, normalize_query(question), id(self.batcher) if mode == "semantic" else id(self.database))
+        task = self.inflight.get(key)
+        if task is not None:
+            self.counters["coalesced"] += 1
+            with span("coalesced"):
+                result = await asyncio.shield(task)
+            if on_token:
+                on_token(result["answer"])
+            return result
+        run = self.semantic_query if mode == "semantic" else self.text2sql_query
+        task = asyncio.ensure_future(run(question, on_token))
+        self.inflight[key] = task
+        task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def semantic_query(self, question, on_token=None):
+        passages = []
+        if self.batcher is not None:
+            passages = await asyncio.to_thread(retrieve_context, self.batcher, question, self.reranker)
+        answer = await self.complete(build_semantic_messages(question, passages), SEMANTIC_MAX_TOKENS, on_token, similar=True)
+        return {"mode": "semantic", "answer": answer, "passages": passages}
+
+    async def text2sql_query(self, question, on_token=None):
+        schema = None
+        if self.database is not None:
+            with span("schema"):
+                schema = await asyncio.to_thread(self.database.describe, question)
+        answer = await self.complete(build_text2sql_messages(question, schema), TEXT2SQL_MAX_TOKENS, on_token)
+        return {"mode": "text2sql", "answer": answer, "sql": extract_sql(answer)}
+
+    async def complete(self, messages, max_tokens, on_token=None, temperature=0.7, similar=False):
+        # Call the LLM through the response cache, with at most max_concurrency calls in flight.
+        # The cache is best effort: a lookup or store that fails is counted and the query carries on without it.
+        # similar allows near-duplicate matching, which embeds the question; only semantic queries, whose
+        # embedding model is already loaded, ask for it.
+        params = {"max_tokens": max_tokens, "temperature": temperature}
+        if self.response_cache is not None:
+            with span("response_cache") as cache_span:
+                try:
+                    cached = await asyncio.to_thread(self.response_cache.get, self.llm.model, messages, params, similar)
+                except Exception:
+                    self.counters["response_cache_errors"] += 1
+                    cached = None
+                    cache_span["error"] = True
+                cache_span["hit"] = cached is not None
+            if cached is not None:
+                self.counters["response_cache_hits"] += 1
+                if on_token:
+                    on_token(cached)
+                return cached
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self.semaphore:
+            self.counters["llm_calls"] += 1
+            # Token counts are estimated from the text, the same way passages are packed into the prompt
+            prompt_tokens = sum(estimate_tokens(message["content"]) for message in messages)
+            with span("llm", model=self.llm.model, prompt_tokens=prompt_tokens) as llm_span:
+                started = time.perf_counter()
+                stream = on_token
+                if on_token:
+                    def stream(piece):
+                        llm_span.setdefault("first_token_ms", round((time.perf_counter() - started) * 1000, 3))
+                        on_token(piece)
+                answer = await self.llm.complete(messages, max_tokens, temperature, stream)
+                llm_span["completion_tokens"] = estimate_tokens(answer)
+            add_counts(prompt_tokens=prompt_tokens, completion_tokens=llm_span["completion_tokens"])
+        if self.response_cache is not None:
+            try:
+                await asyncio.to_thread(self.response_cache.put, self.llm.model, messages, params, answer, similar)
+            except Exception:
+                self.counters["response_cache_errors"] += 1
+        return answer
+
+    def stats(self):
+        stats = {"engine": dict(self.counters), "in_flight": len(self.inflight)}
+        if self.batcher is not None:
+            stats["retrieval"] = self.batcher.stats()
+        if self.reranker is not None:
+            stats["reranker"] = self.reranker.stats()
+        if self.response_cache is not None:
+            stats["response_cache"] = self.response_cache.stats()
+        return stats
+
+class EngineThread:
+    # Runs an engine's event loop on a daemon thread so synchronous code (Qt worker threads, HTTP handler threads)
+    # can submit queries and block on the result
+    def __init__(self, engine):
+        self.engine = engine
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="ragnar-engine", daemon=True)
+        self.thread.start()
+
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def query(self, mode, question, on_token=None, timeout=None, trace=None):
+        return self.submit(self.engine.query(mode, question, on_token, trace)).result(timeout)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
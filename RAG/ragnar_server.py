@@ -0,0 +1,126 @@
+# RAGnar HTTP service: serves the query engine to many concurrent users, without the GUI.
+#
+#   python ragnar_server.py --knowledge-base /path/to/docs --database /path/to/db.sqlite --port 8000
+#   python ragnar_server.py --knowledge-base /path/to/docs --fake-llm   (offline, no API key needed)
+#   python ragnar_server.py --import-csv sales.csv customers.csv         (Text-to-SQL over CSV files)
+#
+# Endpoints:
+#   POST /query   {"mode": "semantic" | "text2sql", "question": "..."} -> {"mode", "answer", "passages" | "sql"}
+#   GET  /health  -> which resources are loaded
+#   GET  /stats   -> engine, retrieval and cache counters
+#   GET  /metrics -> time per stage, query and token counters in the Prometheus text format
+#   GET  /traces  -> the most recent query traces, with the timing of every stage
+
+import argparse
+import json
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from ragnar_core import load_knowledge_base, DatabaseSchema, get_tracer, import_csv_files, CSV_DATABASE_PATH
+from ragnar_engine import QueryEngine, EngineThread, FakeChatClient, OpenAIChatClient
+
+MAX_REQUEST_BYTES = 64 * 1024
+QUERY_TIMEOUT = 120  # Seconds
+
+class RagnarRequestHandler(BaseHTTPRequestHandler):
+    # One handler thread per request; each blocks on the shared engine thread, which bounds and coalesces LLM calls
+    engine_thread = None
+
+    def do_GET(self):
+        engine = self.engine_thread.engine
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok", "knowledge_base": engine.retriever is not None, "database": engine.database is not None})
+        elif self.path == "/stats":
+            self.send_json(200, engine.stats())
+        elif self.path in ("/metrics", "/traces") and get_tracer() is None:
+            self.send_json(404, {"error": "Tracing is disabled."})
+        elif self.path == "/metrics":
+            self.send_body(200, get_tracer().prometheus().encode("utf-8"), "text/plain; version=0.0.4")
+        elif self.path == "/traces":
+            self.send_json(200, get_tracer().recent_traces())
+        else:
+            self.send_json(404, {"error": f"Unknown path: {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/query":
+            self.send_json(404, {"error": f"Unknown path: {self.path}"})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_REQUEST_BYTES:
+            self.send_json(413, {"error": "Request body too large."})
+            return
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+            mode, question = request["mode"], request["question"].strip()
+        except (ValueError, KeyError, AttributeError, TypeError):
+            self.send_json(400, {"error": "Expected a JSON body with 'mode' and 'question'."})
+            return
+        if not question:
+            self.send_json(400, {"error": "Please type a message."})
+            return
+        try:
+            self.send_json(200, self.engine_thread.query(mode, question, timeout=QUERY_TIMEOUT))
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+        except Exception as e:
+            self.send_json(502, {"error": str(e)})
+
+    def send_json(self, status, payload):
+        self.send_body(status, json.dumps(payload).encode("utf-8"), "application/json")
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        sys.stderr.write("%s - %s\n" % (self.address_string(), format % args))
+
+def create_server(engine, host="127.0.0.1", port=8000):
+    # Build (but do not start) an HTTP server around an engine; call serve_forever() on the result
+    handler = type("BoundRagnarRequestHandler", (RagnarRequestHandler,), {"engine_thread": EngineThread(engine)})
+    return ThreadingHTTPServer((host, port), handler)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve RAGnar semantic search and Text-to-SQL over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--knowledge-base", help="Folder of PDF, DOCX and CSV files for semantic mode")
+    parser.add_argument("--database", help="SQLite database for Text-to-SQL mode")
+    parser.add_argument("--import-csv", nargs="+", metavar="CSV", help=f"Import CSV files as tables of --database (default {CSV_DATABASE_PATH}) before serving")
+    parser.add_argument("--fake-llm", action="store_true", help="Answer with a local fake model instead of OpenAI")
+    parser.add_argument("--fake-latency", type=float, default=0.0, help="Seconds the fake model takes per reply")
+    parser.add_argument("--concurrency", type=int, default=None, help="Maximum LLM calls in flight")
+    parser.add_argument("--no-response-cache", action="store_true", help="Do not read or write the LLM response cache")
+    args = parser.parse_args(argv)
+
+    llm = FakeChatClient(latency=args.fake_latency) if args.fake_llm else OpenAIChatClient()
+    options = {"response_cache": not args.no_response_cache}
+    if args.concurrency:
+        options["max_concurrency"] = args.concurrency
+    engine = QueryEngine(llm=llm, **options)
+    if args.knowledge_base:
+        retriever, changes = load_knowledge_base(args.knowledge_base)
+        if changes["failed"]:
+            print(f"Failed to extract {len(changes['failed'])} files: {', '.join(changes['failed'])}", file=sys.stderr)
+        engine.retriever = retriever
+    if args.import_csv:
+        args.database = args.database or CSV_DATABASE_PATH
+        for csv_path, table in import_csv_files(args.import_csv, args.database).items():
+            print(f"Imported {csv_path} as table {table}")
+    if args.database:
+        engine.database = DatabaseSchema.load(args.database)
+
+    server = create_server(engine, args.host, args.port)
+    print(f"RAGnar serving on http://{args.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# RAGnar startup benchmark: how long until the window appears and until the first question is answered.
+#
+#   python ragnar_startup_bench.py                      (Text-to-SQL first query, no embedding model needed)
+#   python ragnar_startup_bench.py --knowledge-base /path/to/docs --runs 5 --json
+#
+# Each run starts a fresh interpreter (`RAGnar.py --startup-probe`) so import and model loading costs are measured
+# cold, the way a user sees them. The fake LLM answers instantly, so the numbers are RAGnar's own overhead.
+# Use --offscreen to run without a display.
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "RAGnar.py")
+CORE_PATH = os.path.dirname(APP_PATH)
+
+def time_import(module, env):
+    # Seconds for a fresh interpreter to import module and exit
+    started = time.time()
+    subprocess.run([sys.executable, "-c", f"import {module}"], cwd=CORE_PATH, env=env, check=True)
+    return time.time() - started
+
+def run_probe(folder_path, env):
+    command = [sys.executable, APP_PATH, "--startup-probe"] + ([folder_path] if folder_path else [])
+    started = time.time()
+    completed = subprocess.run(command, cwd=CORE_PATH, env=env, check=True, capture_output=True, text=True)
+    marks = json.loads(completed.stdout.strip().splitlines()[-1])
+    return {"time_to_window": marks["window_shown"] - started, "time_to_first_query": marks["first_query_done"] - started}
+
+def summarize(samples):
+    return {"median": statistics.median(samples), "min": min(samples), "max": max(samples)}
+
+def startup_benchmark(folder_path=None, runs=5, offscreen=False):
+    env = dict(os.environ)
+    if offscreen:
+        env["QT_QPA_PLATFORM"] = "offscreen"
+    imports = [time_import("ragnar_core", env) for _ in range(runs)]
+    probes = [run_probe(folder_path, env) for _ in range(runs)]
+    return {
+        "first_query_mode": "semantic" if folder_path else "text2sql",
+        "runs": runs,
+        "import_ragnar_core": summarize(imports),
+        "time_to_window": summarize([probe["time_to_window"] for probe in probes]),
+        "time_to_first_query": summarize([probe["time_to_first_query"] for probe in probes]),
+    }
+
+def format_startup_report(report):
+    lines = [f"{report['runs']} runs, first query in {report['first_query_mode']} mode (seconds)",
+             f"{'measure':<22}{'median':>9}{'min':>9}{'max':>9}"]
+    for name in ("import_ragnar_core", "time_to_window", "time_to_first_query"):
+        stats = report[name]
+        lines.append(f"{name:<22}{stats['median']:>9.3f}{stats['min']:>9.3f}{stats['max']:>9.3f}")
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure RAGnar time-to-window and time-to-first-query.")
+    parser.add_argument("--knowledge-base", help="Answer the first question in semantic mode against this folder")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--offscreen", action="store_true", help="Use Qt's offscreen platform (no display needed)")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args(argv)
+    report = startup_benchmark(args.knowledge_base, args.runs, args.offscreen)
+    print(json.dumps(report, indent=2) if args.json else format_startup_report(report))
+
+if __name__ == "__main__":
+    main()
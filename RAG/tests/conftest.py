@@ -0,0 +1,36 @@
+# Shared fixtures. The tests run ragnar_core against real FAISS and SQLite but with a small hashing encoder in place
+# of the sentence-transformers model, so no model has to be downloaded.
+
+import os
+import sys
+import zlib
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ragnar_core
+
+class HashingEncoder:
+    # Bag-of-words vectors: passages sharing words are close, and identical texts encode identically
+    dim = 64
+
+    def encode(self, texts, normalize=True):
+        vectors = np.zeros((len(texts), self.dim), dtype='float32')
+        for row, text in enumerate(texts):
+            for word in text.lower().split():
+                vectors[row, zlib.crc32(word.encode('utf-8')) % self.dim] += 1
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-9)
+
+@pytest.fixture
+def encoder(monkeypatch):
+    encoder = HashingEncoder()
+    monkeypatch.setattr(ragnar_core, "get_encoder", lambda: encoder)
+    monkeypatch.setattr(ragnar_core, "TRACE_ENABLED", False)
+    return encoder
+
+def write_csv(folder, name, rows):
+    with open(os.path.join(folder, name), 'w', encoding='utf-8') as f:
+        f.write("id,text\n" + "".join(f"{number},{text}\n" for number, text in enumerate(rows)))
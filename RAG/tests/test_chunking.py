@@ -0,0 +1,24 @@
+import re
+
+from ragnar_core import chunk_csv, chunk_text, CHUNK_SIZE
+
+MODEL_MAX_PIECES = 256  # all-MiniLM-L6-v2 truncates its input here
+
+def test_numeric_csv_passages_fit_the_embedding_model(tmp_path):
+    path = tmp_path / "orders.csv"
+    path.write_text("order_id,date,price,sku,quantity\n" + "".join(f"{1000 + n},2024-01-03,19.99,SKU-{8800 + n},3\n" for n in range(500)))
+    passages = list(chunk_csv(str(path), "orders.csv"))
+    assert len(passages) > 1
+    for passage in passages:
+        # Every digit run and punctuation mark is at least one word piece
+        assert len(re.findall(r'\w+|[^\w\s]', passage["text"])) < MODEL_MAX_PIECES
+        assert passage["text"].startswith("order_id,date,price,sku,quantity\n")
+    assert passages[0]["rows"][0] == 0 and passages[-1]["rows"][1] == 500
+    assert all(a["rows"][1] == b["rows"][0] for a, b in zip(passages, passages[1:]))
+
+def test_text_chunks_overlap_and_cover_the_text():
+    text = " ".join(f"w{n}" for n in range(1000))
+    chunks = chunk_text(text)
+    assert all(len(chunk.split()) <= CHUNK_SIZE for chunk, _ in chunks)
+    assert chunks[0][0].split()[0] == "w0" and chunks[-1][0].split()[-1] == "w999"
+    assert text[chunks[1][1]:].startswith(chunks[1][0])
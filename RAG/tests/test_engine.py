@@ -0,0 +1,33 @@
+import asyncio
+import sqlite3
+
+import ragnar_core
+from ragnar_core import ResponseCache, DatabaseSchema
+from ragnar_engine import QueryEngine, FakeChatClient
+
+class FailingCache:
+    def get(self, *args):
+        raise sqlite3.OperationalError("database is locked")
+
+    def put(self, *args):
+        raise sqlite3.OperationalError("database is locked")
+
+    def stats(self):
+        return {}
+
+def test_response_cache_failures_do_not_fail_queries(encoder):
+    engine = QueryEngine(llm=FakeChatClient(), response_cache=FailingCache(), reranker=None)
+    result = asyncio.run(engine.query("semantic", "Who is Ragnar?"))
+    assert result["answer"] == "Fake answer to: Who is Ragnar?"
+    assert engine.counters["response_cache_errors"] == 2 and engine.counters["llm_calls"] == 1
+
+def test_text2sql_queries_never_embed_for_the_response_cache(monkeypatch):
+    def no_embedding_model(*args):
+        raise AssertionError("the embedding model was loaded")
+    monkeypatch.setattr(ragnar_core, "get_embedding_backend", no_embedding_model)
+    cache = ResponseCache(":memory:", similarity=0.95)
+    engine = QueryEngine(llm=FakeChatClient(), response_cache=cache, reranker=None)
+    engine.database = DatabaseSchema([{"name": "orders", "columns": [{"name": "id", "type": "INTEGER", "pk": True}], "foreign_keys": [], "samples": {}}])
+    for _ in range(2):
+        asyncio.run(engine.query("text2sql", "How many orders are there?"))
+    assert engine.counters["llm_calls"] == 1 and not engine.counters["response_cache_errors"]
@@ -0,0 +1,62 @@
+import os
+
+from conftest import write_csv
+from ragnar_core import load_knowledge_base, get_cache_dir, read_manifest, DocumentRetriever
+
+def index_mtime(folder):
+    return os.stat(os.path.join(get_cache_dir(str(folder)), DocumentRetriever.INDEX_FILE)).st_mtime_ns
+
+def test_failed_file_is_not_retried_until_it_changes(tmp_path, encoder):
+    write_csv(tmp_path, "good.csv", ["alpha beta", "gamma delta"])
+    (tmp_path / "bad.pdf").write_bytes(b"not a pdf")
+    retriever, changes = load_knowledge_base(str(tmp_path))
+    assert changes["failed"] == ["bad.pdf"]
+    built = index_mtime(tmp_path)
+
+    retriever, changes = load_knowledge_base(str(tmp_path))
+    assert changes["failed"] == ["bad.pdf"]
+    assert not (changes["added"] or changes["modified"])
+    assert index_mtime(tmp_path) == built
+    assert len(retriever) == 1  # Both rows fit in one passage
+
+    (tmp_path / "bad.pdf").write_bytes(b"still not a pdf")
+    retriever, changes = load_knowledge_base(str(tmp_path))
+    assert changes["modified"] == ["bad.pdf"] and changes["failed"] == ["bad.pdf"]
+
+    retriever, changes = load_knowledge_base(str(tmp_path), rebuild=True)
+    assert "bad.pdf" in changes["added"] and changes["failed"] == ["bad.pdf"]
+
+def test_passage_ids_are_not_reused_after_a_delete(tmp_path, encoder):
+    write_csv(tmp_path, "a.csv", ["alpha beta"])
+    write_csv(tmp_path, "z.csv", ["zebraword gamma"])
+    load_knowledge_base(str(tmp_path))
+    old_ids = {doc_id for entry in read_manifest(get_cache_dir(str(tmp_path)))["files"].values() for doc_id in entry["ids"]}
+
+    os.remove(tmp_path / "z.csv")
+    write_csv(tmp_path, "b.csv", ["delta epsilon"])
+    retriever, changes = load_knowledge_base(str(tmp_path))
+    assert changes["added"] == ["b.csv"] and changes["deleted"] == ["z.csv"]
+    new_ids = read_manifest(get_cache_dir(str(tmp_path)))["files"]["b.csv"]["ids"]
+    assert not set(new_ids) & old_ids
+    assert retriever.retrieve("zebraword", k=3, mode="lexical") == []
+
+    # The deleted passage's postings are compacted away, not just masked
+    assert not len(retriever.lexical.postings("zebraword")[0])
+    retriever, _ = load_knowledge_base(str(tmp_path))
+    assert retriever.retrieve("zebraword", k=3, mode="lexical") == []
+
+def test_csv_that_fails_part_way_leaves_no_passages(tmp_path, encoder):
+    write_csv(tmp_path, "good.csv", ["alpha beta"])
+    rows = [f"row{number} kiwiword" for number in range(15000)]
+    rows[12000] += ",extra field"  # Read after the first CSV_BATCH_ROWS rows have been embedded
+    write_csv(tmp_path, "broken.csv", rows)
+    retriever, changes = load_knowledge_base(str(tmp_path))
+    assert changes["failed"] == ["broken.csv"]
+    assert len(retriever) == 1
+    assert retriever.retrieve("kiwiword", k=3, mode="lexical") == []
+
+def test_csv_passages_are_embedded_while_the_file_is_read(tmp_path, encoder):
+    write_csv(tmp_path, "big.csv", [f"row{number} " + "word " * 9 for number in range(6000)])
+    reports = []
+    load_knowledge_base(str(tmp_path), progress=lambda files_done, total, embedded, eta: reports.append((files_done, embedded)))
+    assert any(files_done == 0 and embedded for files_done, embedded in reports)
@@ -0,0 +1,16 @@
+from ragnar_core import PassageStore
+
+def test_reader_is_not_blocked_by_a_long_write_transaction(tmp_path):
+    path = str(tmp_path / "passages.sqlite")
+    writer = PassageStore(path)
+    writer.add([0], [{"text": "committed"}])
+    writer.commit()
+    reader = PassageStore(path)
+
+    # Enough uncommitted data to spill the writer's page cache to the database file
+    writer.add(range(1, 20001), [{"text": "x" * 500}] * 20000)
+    assert reader.get_many([0]) == {0: {"text": "committed"}}
+    assert len(reader) == 1
+
+    writer.commit()
+    assert len(reader) == 20001
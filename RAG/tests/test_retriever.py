@@ -0,0 +1,121 @@
+import threading
+import time
+
+import numpy as np
+
+from ragnar_core import TrainingBuffer, DocumentRetriever, PassageStore, QueryBatcher, CrossEncoderReranker
+
+def test_training_sample_is_drawn_from_the_whole_stream():
+    buffer = TrainingBuffer(dim=2, sample_size=1000)
+    for batch in range(100):
+        # The first 80 batches come from one cluster and the last 20 from another
+        embeddings = np.full((100, 2), 0.0 if batch < 80 else 1.0, dtype='float32')
+        buffer.add(embeddings, np.arange(batch * 100, (batch + 1) * 100))
+    assert len(buffer) == 10000 and len(buffer.sample) == 1000
+    assert 0.15 < buffer.sample[:, 0].mean() < 0.25
+
+    ids = np.concatenate([ids for _, ids in buffer.chunks(3000)])
+    assert ids.tolist() == list(range(10000))
+    buffer.close()
+
+def test_trained_index_holds_every_passage(encoder):
+    texts = [f"passage {number} word{number % 97} other{number % 89}" for number in range(3000)]
+    retriever = DocumentRetriever(texts, index_type="ivf_flat", encoder=encoder, batch_size=256)
+    assert retriever.index.ntotal == 3000 and retriever.training_buffer is None
+    assert retriever.dense_search(encoder.encode([texts[1234]]), 1) == [[1234]]
+
+def test_hnsw_keeps_removed_vectors_apart_from_new_passages(tmp_path, encoder):
+    # HNSW cannot delete vectors, so a removed passage's vector stays in the index under its old ID
+    store = PassageStore(str(tmp_path / DocumentRetriever.PASSAGES_FILE))
+    retriever = DocumentRetriever(["alpha beta", "zebraword gamma"], index_type="hnsw", store=store, encoder=encoder)
+    retriever.remove_documents([1])
+    retriever.save(str(tmp_path))
+
+    retriever = DocumentRetriever.load(str(tmp_path), mmap=False)
+    assert retriever.add_documents(["delta epsilon"]) == [2]
+    assert retriever.index.ntotal == 3
+    assert 1 not in retriever.dense_search(encoder.encode(["zebraword gamma"]), 2)[0]
+
+class CountingEncoder:
+    def __init__(self, encoder):
+        self.encoder = encoder
+        self.dim = encoder.dim
+        self.calls = []
+
+    def encode(self, texts, normalize=True):
+        self.calls.append(len(texts))
+        return self.encoder.encode(texts, normalize)
+
+def run_in_threads(function, count):
+    # Call function(i) from count threads released together; returns the results or exceptions in order
+    barrier = threading.Barrier(count)
+    outcomes = [None] * count
+
+    def run(i):
+        barrier.wait()
+        try:
+            outcomes[i] = function(i)
+        except Exception as e:
+            outcomes[i] = e
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+def test_query_batcher_shares_one_encode_and_search(encoder, monkeypatch):
+    counting = CountingEncoder(encoder)
+    texts = [f"passage about topic{number} and subject{number % 7}" for number in range(50)]
+    retriever = DocumentRetriever(texts, encoder=counting)
+    expected = {i: retriever.retrieve(f"topic{i} subject{i % 7}", k=i % 3 + 1, mode="dense") for i in range(8)}
+    retriever.result_cache.clear()
+    retriever.embedding_cache.clear()
+    counting.calls = []
+    searches = []
+    dense_search = retriever.dense_search
+    monkeypatch.setattr(retriever, "dense_search", lambda embeddings, k: searches.append(len(embeddings)) or dense_search(embeddings, k))
+
+    batcher = QueryBatcher(retriever, max_batch=8, max_wait_ms=5000)
+    results = run_in_threads(lambda i: batcher.retrieve(f"topic{i} subject{i % 7}", k=i % 3 + 1, mode="dense"), 8)
+    assert counting.calls == [8] and searches == [8]
+    assert batcher.batches == 1 and batcher.queries == 8
+    for i, passages in enumerate(results):
+        assert passages == expected[i] and len(passages) == i % 3 + 1
+
+def test_query_batcher_passes_an_error_to_every_waiter():
+    class FailingRetriever:
+        def retrieve_batch(self, queries, k, mode):
+            raise RuntimeError("index unavailable")
+
+    batcher = QueryBatcher(FailingRetriever(), max_batch=4, max_wait_ms=5000)
+    outcomes = run_in_threads(lambda i: batcher.retrieve(f"question {i}"), 4)
+    assert all(isinstance(outcome, RuntimeError) and str(outcome) == "index unavailable" for outcome in outcomes)
+    assert not batcher.leader_active and not batcher.pending
+
+class SlowCrossEncoder:
+    # Scores later passages higher, after a fixed delay per batch
+    def __init__(self, delay):
+        self.delay = delay
+        self.scoring = threading.Event()
+
+    def predict(self, pairs, batch_size):
+        self.scoring.set()
+        time.sleep(self.delay)
+        return [float(number) for number in range(len(pairs))]
+
+def test_reranker_keeps_first_stage_order_when_the_model_is_busy_past_the_budget():
+    reranker = CrossEncoderReranker(batch_size=8)
+    reranker.model = SlowCrossEncoder(delay=0.5)
+    passages = [{"text": f"passage {number}"} for number in range(4)]
+    first = threading.Thread(target=reranker.rerank, args=("query", passages), kwargs={"budget_ms": 5000})
+    first.start()
+    assert reranker.model.scoring.wait(5)
+
+    started = time.perf_counter()
+    ranked = reranker.rerank("query", passages, budget_ms=100)
+    elapsed = time.perf_counter() - started
+    first.join()
+    assert ranked == passages
+    assert elapsed < 0.4  # The budget covers the wait for the model, not just the scoring
+    assert reranker.stats()["queries"] == 2 and reranker.stats()["partial"] == 1
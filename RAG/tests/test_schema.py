@@ -0,0 +1,35 @@
+import ragnar_core
+from ragnar_core import DatabaseSchema, SCHEMA_TOP_TABLES, SCHEMA_MAX_TABLES
+
+def make_table(name, columns=(), references=()):
+    columns = [{"name": "id", "type": "INTEGER", "pk": True}] + [{"name": column, "type": "TEXT", "pk": False} for column in columns]
+    columns += [{"name": f"{table}_id", "type": "INTEGER", "pk": False} for table in references]
+    return {"name": name, "columns": columns, "samples": {},
+            "foreign_keys": [{"column": f"{table}_id", "table": table, "to": "id"} for table in references]}
+
+def shown_tables(description):
+    return {line[len("Table: "):] for line in description.splitlines() if line.startswith("Table: ")}
+
+def test_question_selects_named_table_and_the_tables_it_references(encoder, monkeypatch):
+    monkeypatch.setattr(ragnar_core, "get_embedding_backend", lambda *args: encoder)
+    tables = [make_table(f"zone{number}_log", [f"reading{number}"]) for number in range(20)]
+    tables += [make_table("customers", ["name", "email"]), make_table("products", ["title", "price"]),
+               make_table("invoices", ["total"], references=["customers", "products"])]
+    schema = DatabaseSchema(tables)
+    assert len(schema) > SCHEMA_TOP_TABLES
+
+    selected = [table["name"] for table in schema.select_tables("What is the total of each invoice?")]
+    assert selected[0] == "invoices"
+    assert {"customers", "products"} <= set(selected)
+    assert len(selected) <= SCHEMA_MAX_TABLES
+    description = schema.describe("What is the total of each invoice?")
+    assert shown_tables(description) == set(selected)
+    assert f"of {len(tables)} tables shown" in description
+
+def test_small_schema_is_sent_whole_without_embedding(monkeypatch):
+    def no_embedding_model(*args):
+        raise AssertionError("the embedding model was loaded")
+    monkeypatch.setattr(ragnar_core, "get_embedding_backend", no_embedding_model)
+    tables = [make_table(f"table{number}", ["value"]) for number in range(SCHEMA_TOP_TABLES)]
+    schema = DatabaseSchema(tables)
+    assert shown_tables(schema.describe("Which table has the most rows?")) == {table["name"] for table in tables}
@@ -0,0 +1,73 @@
+import sqlite3
+
+import pytest
+
+from conftest import write_csv
+from ragnar_core import ReadOnlyDatabase, full_scan_warnings, import_csv_files, limit_query
+
+SLOW_QUERY = "WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n WHERE x < 10000000) SELECT count(*) FROM n"
+
+@pytest.fixture
+def database(tmp_path):
+    db_path = str(tmp_path / "data.db")
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("CREATE TABLE orders (id INTEGER PRIMARY KEY, customer TEXT)")
+        conn.executemany("INSERT INTO orders (customer) VALUES (?)", [(f"customer {n}",) for n in range(50)])
+    database = ReadOnlyDatabase(db_path, max_rows=20)
+    yield database
+    database.close()
+
+def test_limit_query_adds_a_limit_only_where_the_statement_has_none():
+    assert limit_query("SELECT * FROM t;", 100) == "SELECT * FROM t\nLIMIT 101"
+    assert limit_query("SELECT * FROM t -- all rows", 100) == "SELECT * FROM t\nLIMIT 101"
+    assert limit_query("SELECT * FROM t LIMIT 5", 100) == "SELECT * FROM t LIMIT 5"
+    assert limit_query("SELECT * FROM t LIMIT 5 OFFSET 10", 100) == "SELECT * FROM t LIMIT 5 OFFSET 10"
+    assert limit_query("SELECT * FROM t LIMIT ?", 100) == "SELECT * FROM t LIMIT ?"
+    assert limit_query("DELETE FROM t", 100) == "DELETE FROM t"
+
+def test_limit_query_ignores_the_limit_of_a_trailing_subquery():
+    sql = "SELECT * FROM orders WHERE id IN (SELECT id FROM t LIMIT 5)"
+    assert limit_query(sql, 100) == f"{sql}\nLIMIT 101"
+    sql = "SELECT * FROM orders WHERE note = 'LIMIT 5'"
+    assert limit_query(sql, 100) == f"{sql}\nLIMIT 101"
+
+def test_full_scan_warnings_name_only_unindexed_table_scans():
+    warnings = full_scan_warnings(["SCAN orders", "SCAN TABLE customers AS c", "SEARCH items USING INDEX idx (order_id=?)",
+                                   "SCAN orders USING COVERING INDEX idx", "SCAN CONSTANT ROW", "SCAN (subquery-1)"])
+    assert len(warnings) == 2
+    assert "orders" in warnings[0] and "customers" in warnings[1]
+
+def test_execute_pages_and_warns_of_full_scans(database):
+    result = database.execute("SELECT * FROM orders WHERE customer = 'customer 3'")
+    assert result.page(0) == [(4, "customer 3")]
+    assert any("orders" in warning for warning in result.warnings)
+    result = database.execute("SELECT * FROM orders")
+    assert result.row_count == 20 and result.truncated
+
+def test_cancel_between_statements_of_one_execute_is_kept(database, monkeypatch):
+    # The cancel lands after the query plan is read and before the query itself starts
+    def explain_then_cancel(sql):
+        database.cancel()
+        return []
+    monkeypatch.setattr(database, "explain", explain_then_cancel)
+    with pytest.raises(InterruptedError):
+        database.execute(SLOW_QUERY)
+
+def test_cancel_does_not_carry_over_to_the_next_execute(database):
+    database.cancel()
+    assert database.execute("SELECT count(*) FROM orders").page(0) == [(50,)]
+
+def test_csv_import_is_not_locked_out_by_an_open_result(tmp_path):
+    csv_path = str(tmp_path / "notes.csv")
+    write_csv(tmp_path, "notes.csv", [f"note {n}" for n in range(50)])
+    db_path = str(tmp_path / "csv.db")
+    table = import_csv_files([csv_path], db_path)[csv_path]
+    database = ReadOnlyDatabase(db_path, page_size=10)
+    try:
+        result = database.execute(f"SELECT * FROM {table}")
+        assert len(result.page(0)) == 10 and not result.exhausted  # The cursor is still open
+        write_csv(tmp_path, "notes.csv", [f"note {n}" for n in range(60)])
+        import_csv_files([csv_path], db_path)
+        assert database.execute(f"SELECT count(*) FROM {table}").page(0) == [(60,)]
+    finally:
+        database.close()